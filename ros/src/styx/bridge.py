@@ -13,12 +13,22 @@ from std_msgs.msg import Header
 from cv_bridge import CvBridge, CvBridgeError
 
 from styx_msgs.msg import TrafficLight, TrafficLightArray, Lane
+from styx_msgs.msg import FrameDescriptor
+from styx_msgs.lane_compact import LaneCompactNumpy
+from styx_msgs.frame_ring import FrameRing
 import numpy as np
 from PIL import Image as PIL_Image
 from io import BytesIO
 import base64
 
 import math
+import os
+import time
+
+from session_log import SessionRecorder
+
+# camera frames in the shared memory ring before a slot is reused
+FRAME_RING_SLOTS = 8
 
 TYPE = {
     'bool': Bool,
@@ -32,32 +42,74 @@ TYPE = {
     'brake_cmd': BrakeCmd,
     'throttle_cmd': ThrottleCmd,
     'path_draw': Lane,
-    'image':Image
+    'path_compact': LaneCompactNumpy,
+    'image':Image,
+    'frame': FrameDescriptor
 }
 
 
 class Bridge(object):
-    def __init__(self, conf, server):
-        rospy.init_node('styx_server')
+    def __init__(self, conf, server, namespace=''):
+        # several bridges (one per simulator session) may share the node
+        if not rospy.core.is_initialized():
+            rospy.init_node('styx_server')
         self.server = server
+        # all topics and the vehicle frame are prefixed by the namespace (e.g. '/sim0')
+        self.namespace = namespace
+        self.base_link = namespace.strip('/') + '/base_link' if namespace else 'base_link'
         self.vel = 0.
         self.yaw = None
         self.angular_vel = 0.
         self.bridge = CvBridge()
 
+        # optionally record the incoming simulator traffic (see session_log.py)
+        self.recorder = None
+        record_path = rospy.get_param('~record_path', '')
+        if record_path:
+            record_path = os.path.join(record_path, namespace.strip('/'), time.strftime('%Y%m%d-%H%M%S'))
+            self.recorder = SessionRecorder(record_path)
+            rospy.on_shutdown(self.close_recorder)
+            rospy.loginfo('Bridge records session to %s', record_path)
+
+        # optionally pass the camera frames through shared memory (see styx_msgs/frame_ring.py)
+        # and publish only their descriptors on /image_color_shm
+        self.frame_ring = None
+        self.frame_ring_path = rospy.get_param(namespace + '/camera_shm', '')
+        if self.frame_ring_path and namespace:
+            self.frame_ring_path += namespace.replace('/', '_')
+
         self.callbacks = {
             '/vehicle/steering_cmd': self.callback_steering,
             '/vehicle/throttle_cmd': self.callback_throttle,
             '/vehicle/brake_cmd': self.callback_brake,
-        '/final_waypoints': self.callback_path
+        '/final_waypoints': self.callback_path,
+        '/final_waypoints_compact': self.callback_path_compact
         }
 
-        self.subscribers = [rospy.Subscriber(e.topic, TYPE[e.type], self.callbacks[e.topic])
-                            for e in conf.subscribers]
+        # draw the path from either the Lane or the LaneCompact topic, not both
+        compact_lanes = rospy.get_param(namespace + '/compact_lanes', False)
+        skip = 'path_draw' if compact_lanes else 'path_compact'
+        self.subscribers = [rospy.Subscriber(namespace + e.topic, TYPE[e.type], self.callbacks[e.topic])
+                            for e in conf.subscribers if e.type != skip]
 
-        self.publishers = {e.name: rospy.Publisher(e.topic, TYPE[e.type], queue_size=1)
+        self.publishers = {e.name: rospy.Publisher(namespace + e.topic, TYPE[e.type], queue_size=1)
                            for e in conf.publishers}
 
+    def shutdown(self):
+        for subscriber in self.subscribers:
+            subscriber.unregister()
+        for publisher in self.publishers.values():
+            publisher.unregister()
+        self.close_recorder()
+        if self.frame_ring is not None:
+            self.frame_ring.unlink()
+            self.frame_ring = None
+
+    def close_recorder(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
     def create_light(self, x, y, z, yaw, state):
         light = TrafficLight()
 
@@ -104,12 +156,14 @@ class Bridge(object):
         st.speed = self.vel
         return st
 
-    def calc_angular(self, yaw):
+    def calc_angular(self, yaw, now=None):
+        # now allows the replay to pass the recorded time instead of the current one
+        now = rospy.get_time() if now is None else now
         angular_vel = 0.
-        if self.yaw is not None:
-            angular_vel = (yaw - self.yaw)/(rospy.get_time() - self.prev_time)
+        if self.yaw is not None and now > self.prev_time:
+            angular_vel = (yaw - self.yaw)/(now - self.prev_time)
         self.yaw = yaw
-        self.prev_time = rospy.get_time()
+        self.prev_time = now
         return angular_vel
 
     def create_point_cloud_message(self, pts):
@@ -127,16 +181,18 @@ class Bridge(object):
             name,
             "world")
 
-    def publish_odometry(self, data):
+    def publish_odometry(self, data, now=None):
+        if self.recorder is not None:
+            self.recorder.telemetry(rospy.get_time(), data)
         pose = self.create_pose(data['x'], data['y'], data['z'], data['yaw'])
 
         position = (data['x'], data['y'], data['z'])
         orientation = tf.transformations.quaternion_from_euler(0, 0, math.pi * data['yaw']/180.)
-        self.broadcast_transform("base_link", position, orientation)
+        self.broadcast_transform(self.base_link, position, orientation)
 
         self.publishers['current_pose'].publish(pose)
         self.vel = data['velocity']* 0.44704
-        self.angular = self.calc_angular(data['yaw'] * math.pi/180.)
+        self.angular = self.calc_angular(data['yaw'] * math.pi/180., now)
         self.publishers['current_velocity'].publish(self.create_twist(self.vel, self.angular))
 
 
@@ -160,6 +216,8 @@ class Bridge(object):
         self.publishers['lidar'].publish(self.create_point_cloud_message(zip(data['lidar_x'], data['lidar_y'], data['lidar_z'])))
 
     def publish_traffic(self, data):
+        if self.recorder is not None:
+            self.recorder.trafficlights(rospy.get_time(), data)
         x, y, z = data['light_pos_x'], data['light_pos_y'], data['light_pos_z'],
         yaw = [math.atan2(dy, dx) for dx, dy in zip(data['light_pos_dx'], data['light_pos_dy'])]
         status = data['light_state']
@@ -176,12 +234,48 @@ class Bridge(object):
 
     def publish_camera(self, data):
         imgString = data["image"]
-        image = PIL_Image.open(BytesIO(base64.b64decode(imgString)))
+        encoded = base64.b64decode(imgString)
+        if self.recorder is not None:
+            self.recorder.image(rospy.get_time(), encoded)
+        self.publish_camera_encoded(encoded)
+
+    def publish_camera_encoded(self, encoded):
+        # receive time, the tl_detector looks up the pose of the frame by it
+        stamp = rospy.Time.now()
+        image = PIL_Image.open(BytesIO(encoded))
         image_array = np.asarray(image)
 
+        if self.frame_ring_path and self.publish_frame(image_array, stamp):
+            # the Image is only serialized for other subscribers (e.g. rviz, rosbag)
+            if self.publishers['image'].get_num_connections() == 0:
+                return
         image_message = self.bridge.cv2_to_imgmsg(image_array, encoding="rgb8")
+        image_message.header.stamp = stamp
+        image_message.header.frame_id = self.base_link
         self.publishers['image'].publish(image_message)
 
+    def publish_frame(self, image_array, stamp):
+        if self.frame_ring is None:
+            self.frame_ring = FrameRing(self.frame_ring_path, FRAME_RING_SLOTS, image_array.nbytes)
+            rospy.loginfo('Bridge passes camera frames through %s', self.frame_ring_path)
+        if image_array.nbytes > self.frame_ring.slot_size:
+            rospy.logerr('Bridge can not pass a %s camera frame through %s',
+                         image_array.shape, self.frame_ring_path)
+            return False
+        slot, sequence = self.frame_ring.write(image_array, stamp.to_sec())
+
+        frame = FrameDescriptor()
+        frame.header.stamp = stamp
+        frame.header.frame_id = self.base_link
+        frame.ring = self.frame_ring_path
+        frame.slot = slot
+        frame.sequence = sequence
+        frame.height = image_array.shape[0]
+        frame.width = image_array.shape[1]
+        frame.encoding = 'rgb8'
+        self.publishers['frame'].publish(frame)
+        return True
+
     def callback_steering(self, data):
         self.server('steer', data={'steering_angle': str(data.steering_wheel_angle_cmd)})
 
@@ -204,3 +298,7 @@ class Bridge(object):
             z_values.append(z)
 
         self.server('drawline', data={'next_x': x_values, 'next_y': y_values, 'next_z': z_values})
+
+    def callback_path_compact(self, data):
+        self.server('drawline', data={'next_x': data.x.tolist(), 'next_y': data.y.tolist(),
+                                      'next_z': (data.z + 0.5).tolist()})
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+'''
+Synthetic simulator load generator for the styx bridge (server.py).
+
+Connects to the bridge like the Unity simulator does and emits `telemetry`,
+`image`, `lidar`, `obstacle` and `trafficlights` events at configurable rates
+and payload sizes - either synthesized or replayed from a recorded event file.
+Every emit requests a socket.io acknowledgement, so the time until the ack
+arrives is the round trip including the bridge handler. At the end the bridge
+is asked for its handler statistics (CPU time per event, emitted messages,
+outbound backlog) via the `bench_stats` event.
+
+NOTE: requires a python-socketio release providing `socketio.Client` (>= 4.0).
+      The bridge itself pins an older server release, so install the client
+      into a separate virtualenv - the generator does not need ROS at all.
+
+Example (headless, 30 seconds, sim camera at 10Hz):
+    python load_generator.py --duration 30 --image-rate 10 --json before.json
+'''
+
+import argparse
+import base64
+import csv
+import heapq
+import json
+import math
+import random
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image as PIL_Image
+
+try:
+    import socketio
+except ImportError:
+    socketio = None
+
+EVENTS = ('telemetry', 'image', 'lidar', 'obstacle', 'trafficlights')
+# events sent by the bridge back to the simulator
+SERVER_EVENTS = ('steer', 'throttle', 'brake', 'drawline')
+
+
+class EventSynthesizer(object):
+    '''Creates simulator-like payloads for all events handled by the bridge'''
+
+    def __init__(self, args):
+        self.args = args
+        self.route = self.load_route(args.waypoints)
+        self.route_idx = 0
+        width, height = [int(v) for v in args.image_size.split('x')]
+        self.image_payload = self.encode_image(width, height, args.image_quality)
+
+    def load_route(self, path):
+        # x, y, z, yaw (radians) as written by the waypoint csv files in data/
+        if path is None:
+            angles = np.linspace(0., 2. * np.pi, 1000, endpoint=False)
+            return np.stack([100. * np.cos(angles), 100. * np.sin(angles),
+                             np.zeros_like(angles), angles + np.pi / 2.], axis=1)
+        with open(path) as wfile:
+            return np.array([[float(v) for v in row[:4]] for row in csv.reader(wfile)])
+
+    def encode_image(self, width, height, quality):
+        # noise on top of a gradient - compresses similar to a camera frame
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+        noise = np.random.randint(0, 64, (height, width, 3)).astype(np.float32)
+        pixels = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        buf = BytesIO()
+        PIL_Image.fromarray(pixels).save(buf, format='JPEG', quality=quality)
+        return base64.b64encode(buf.getvalue()).decode('ascii')
+
+    def telemetry(self):
+        x, y, z, yaw = self.route[self.route_idx]
+        self.route_idx = (self.route_idx + 1) % len(self.route)
+        return {'x': x, 'y': y, 'z': z, 'yaw': yaw * 180. / math.pi,
+                'velocity': self.args.velocity, 'dbw_enable': True}
+
+    def image(self):
+        return {'image': self.image_payload}
+
+    def lidar(self):
+        pts = np.random.uniform(-50., 50., (3, self.args.lidar_points))
+        return {'lidar_x': pts[0].tolist(), 'lidar_y': pts[1].tolist(), 'lidar_z': pts[2].tolist()}
+
+    def obstacle(self):
+        return {'obstacles': np.random.uniform(-50., 50., (self.args.obstacles, 3)).tolist()}
+
+    def trafficlights(self):
+        count = self.args.lights
+        pos = self.route[np.linspace(0, len(self.route) - 1, count).astype(int)]
+        return {'light_pos_x': pos[:, 0].tolist(), 'light_pos_y': pos[:, 1].tolist(),
+                'light_pos_z': [5.] * count,
+                'light_pos_dx': np.cos(pos[:, 3]).tolist(), 'light_pos_dy': np.sin(pos[:, 3]).tolist(),
+                'light_state': [random.choice((0, 1, 2)) for _ in range(count)]}
+
+
+class LoadStatistics(object):
+    '''Thread safe collection of emit/ack timings per event'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = dict((e, 0) for e in EVENTS)
+        self.skipped = dict((e, 0) for e in EVENTS)
+        self.latencies = dict((e, []) for e in EVENTS)
+        self.received = dict((e, 0) for e in SERVER_EVENTS)
+        self.payload_bytes = dict((e, 0) for e in EVENTS)
+        self.inflight = 0
+        self.max_inflight = 0
+        self.late = 0
+
+    def on_sent(self, event, size):
+        with self.lock:
+            self.sent[event] += 1
+            self.payload_bytes[event] += size
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+
+    def on_ack(self, event, latency):
+        with self.lock:
+            self.inflight -= 1
+            self.latencies[event].append(latency)
+
+    def on_received(self, event):
+        with self.lock:
+            self.received[event] += 1
+
+    def report(self, duration, server_stats):
+        result = {'duration': duration, 'events': {}, 'received': dict(self.received),
+                  'max_inflight': self.max_inflight, 'unacked': self.inflight,
+                  'late_schedules': self.late}
+        for event in EVENTS:
+            lat = np.array(self.latencies[event]) * 1000.
+            entry = {'sent': self.sent[event], 'acked': len(lat), 'skipped': self.skipped[event],
+                     'throughput': len(lat) / duration,
+                     'payload_bytes': self.payload_bytes[event] / max(1, self.sent[event])}
+            if len(lat):
+                entry.update({'latency_ms_p50': np.percentile(lat, 50), 'latency_ms_p95': np.percentile(lat, 95),
+                              'latency_ms_p99': np.percentile(lat, 99), 'latency_ms_max': lat.max()})
+            result['events'][event] = entry
+        if server_stats is not None:
+            handlers = {}
+            for event, (count, cpu) in server_stats['handlers'].items():
+                handlers[event] = {'calls': count, 'cpu_s': cpu, 'cpu_ms_mean': 1000. * cpu / max(1, count)}
+            emitted = server_stats['emitted']
+            result['server'] = {'handlers': handlers, 'emitted': emitted,
+                                'max_backlog': server_stats['max_backlog'], 'backlog': server_stats['backlog'],
+                                # emitted by the bridge but never seen by this client
+                                'dropped': dict((e, emitted.get(e, 0) - self.received.get(e, 0)) for e in emitted)}
+        return result
+
+
+def schedule_synthetic(args, synth, duration):
+    '''Yields (time offset, event, data) in time order for all enabled events'''
+    rates = {'telemetry': args.telemetry_rate, 'image': args.image_rate, 'lidar': args.lidar_rate,
+             'obstacle': args.obstacle_rate, 'trafficlights': args.trafficlights_rate}
+    queue = [(0., event) for event in EVENTS if rates[event] > 0]
+    heapq.heapify(queue)
+    while queue:
+        t, event = heapq.heappop(queue)
+        if t >= duration:
+            continue
+        yield t, event, getattr(synth, event)()
+        heapq.heappush(queue, (t + 1. / rates[event], event))
+
+
+def schedule_replay(path, duration):
+    '''Yields (time offset, event, data) from a json-lines event file'''
+    with open(path) as rfile:
+        for line in rfile:
+            entry = json.loads(line)
+            if entry['t'] >= duration:
+                break
+            yield entry['t'], entry['event'], entry['data']
+
+
+def run(args):
+    if socketio is None or not hasattr(socketio, 'Client'):
+        raise SystemExit('load_generator.py requires python-socketio >= 4.0 (socketio.Client)')
+
+    stats = LoadStatistics()
+    client = socketio.Client()
+    for event in SERVER_EVENTS:
+        client.on(event, (lambda e: lambda *data: stats.on_received(e))(event))
+    # the namespace selects the session of a bridge in multi session mode
+    client.connect(args.url + ('/?ns=' + args.ns if args.ns else ''))
+
+    if args.replay:
+        events = schedule_replay(args.replay, args.duration)
+    else:
+        events = schedule_synthetic(args, EventSynthesizer(args), args.duration)
+    record = open(args.record, 'w') if args.record else None
+
+    # clear counters of previous runs so the server numbers match this run
+    client.call('bench_stats', {'reset': True}, timeout=10)
+    start = time.time()
+    for t, event, data in events:
+        delay = start + t / args.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -0.1:
+            stats.late += 1
+        if record is not None:
+            record.write(json.dumps({'t': t, 'event': event, 'data': data}) + '\n')
+        if stats.inflight >= args.max_inflight:
+            # the bridge can't keep up - don't queue more in the client
+            stats.skipped[event] += 1
+            continue
+        size = len(json.dumps(data))
+        stats.on_sent(event, size)
+        sent_at = time.time()
+        client.emit(event, data, callback=(lambda e, s: lambda *r: stats.on_ack(e, time.time() - s))(event, sent_at))
+
+    # give outstanding acks a chance to arrive
+    deadline = time.time() + args.drain
+    while stats.inflight > 0 and time.time() < deadline:
+        time.sleep(0.01)
+    duration = time.time() - start
+    try:
+        server_stats = client.call('bench_stats', {'reset': False}, timeout=10)
+    except Exception:
+        server_stats = None
+    client.disconnect()
+    if record is not None:
+        record.close()
+    return stats.report(duration, server_stats)
+
+
+def print_report(report):
+    print('Duration {0:.1f}s, max in-flight {1}, unacked {2}, late schedules {3}'.format(
+        report['duration'], report['max_inflight'], report['unacked'], report['late_schedules']))
+    print('{0:<14}{1:>8}{2:>8}{3:>8}{4:>10}{5:>10}{6:>10}{7:>10}{8:>12}'.format(
+        'event', 'sent', 'acked', 'skipped', 'msg/s', 'p50 ms', 'p95 ms', 'max ms', 'bytes/msg'))
+    for event, e in sorted(report['events'].items()):
+        if not e['sent'] and not e['skipped']:
+            continue
+        print('{0:<14}{1:>8}{2:>8}{3:>8}{4:>10.1f}{5:>10.2f}{6:>10.2f}{7:>10.2f}{8:>12.0f}'.format(
+            event, e['sent'], e['acked'], e['skipped'], e['throughput'], e.get('latency_ms_p50', 0.),
+            e.get('latency_ms_p95', 0.), e.get('latency_ms_max', 0.), e['payload_bytes']))
+    server = report.get('server')
+    if server is None:
+        print('No handler statistics received from the bridge')
+        return
+    print('Bridge handler CPU time:')
+    for event, h in sorted(server['handlers'].items()):
+        print('  {0:<14}{1:>8} calls {2:>10.3f}s total {3:>8.3f}ms/call'.format(
+            event, h['calls'], h['cpu_s'], h['cpu_ms_mean']))
+    print('Bridge outbox: max backlog {0}, remaining {1}, emitted {2}, dropped {3}'.format(
+        server['max_backlog'], server['backlog'], server['emitted'], server['dropped']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic simulator load for the styx bridge')
+    parser.add_argument('--url', default='http://localhost:4567')
+    parser.add_argument('--ns', default=None, help='ROS namespace of the session (multi session bridge)')
+    parser.add_argument('--duration', type=float, default=30., help='seconds of load to generate')
+    parser.add_argument('--speed', type=float, default=1., help='time scale of the schedule (2 = twice as fast)')
+    parser.add_argument('--telemetry-rate', type=float, default=50.)
+    parser.add_argument('--image-rate', type=float, default=10.)
+    parser.add_argument('--lidar-rate', type=float, default=0.)
+    parser.add_argument('--obstacle-rate', type=float, default=0.)
+    parser.add_argument('--trafficlights-rate', type=float, default=4.)
+    parser.add_argument('--image-size', default='800x600', help='WIDTHxHEIGHT of the synthetic camera frame')
+    parser.add_argument('--image-quality', type=int, default=75, help='jpeg quality of the camera frame')
+    parser.add_argument('--lidar-points', type=int, default=1000)
+    parser.add_argument('--obstacles', type=int, default=10)
+    parser.add_argument('--lights', type=int, default=8)
+    parser.add_argument('--velocity', type=float, default=25., help='reported vehicle speed in mph')
+    parser.add_argument('--waypoints', default=None, help='waypoint csv the synthetic vehicle follows')
+    parser.add_argument('--max-inflight', type=int, default=100,
+                        help='unacknowledged emits before further events are skipped')
+    parser.add_argument('--drain', type=float, default=5., help='seconds to wait for outstanding acks')
+    parser.add_argument('--replay', default=None, help='json-lines event file to replay instead of synthesizing')
+    parser.add_argument('--record', default=None, help='write the emitted events as json-lines for later replay')
+    parser.add_argument('--json', default=None, help='write the report as json to this file')
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as jfile:
+            json.dump(report, jfile, indent=2, sort_keys=True)
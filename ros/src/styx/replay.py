@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+Replays a session recorded by the bridge (see session_log.py) into the ROS
+graph - in place of the simulator and server.py. The messages are published
+through the same Bridge code as during recording.
+
+Parameters:
+    ~path   session directory written by the bridge (~record_path/<date-time>)
+    ~speed  1.0 = real time, N = N times faster, 0 = as fast as possible
+    ~loop   start over at the end of the session
+'''
+
+import time
+
+import rospy
+
+from bridge import Bridge
+from conf import conf
+from session_log import SessionReader, EVENT_STREAMS
+
+
+class SessionReplayer(object):
+    def __init__(self):
+        # commands of the ROS nodes have no receiver during a replay
+        self.bridge = Bridge(conf, lambda topic, data: None)
+        self.log = SessionReader(rospy.get_param('~path'))
+        self.speed = float(rospy.get_param('~speed', 1.))
+        self.dbw_enable = None
+        rospy.loginfo('SessionReplayer loaded %i events from %s', len(self.log), self.log.path)
+
+        loop = rospy.get_param('~loop', False)
+        self.replay()
+        while loop and not rospy.is_shutdown():
+            self.replay()
+
+    def replay(self):
+        times, streams, rows = self.log.timeline()
+        if 0 == len(times):
+            return
+        handlers = [getattr(self, 'replay_' + stream) for stream in EVENT_STREAMS]
+        start = time.time()
+        for t, stream, row in zip(times, streams, rows):
+            if rospy.is_shutdown():
+                break
+            if self.speed > 0:
+                delay = (t - times[0]) / self.speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            handlers[stream](t, row)
+        rospy.loginfo('SessionReplayer finished after %.1fs (%.1fs recorded)',
+                      time.time() - start, times[-1] - times[0])
+
+    def replay_telemetry(self, t, row):
+        data = self.log.telemetry(row)
+        if data['dbw_enable'] != self.dbw_enable:
+            self.dbw_enable = data['dbw_enable']
+            self.bridge.publish_dbw_status(self.dbw_enable)
+        # angular velocity is derived from the recorded, not the replay time
+        self.bridge.publish_odometry(data, float(t))
+
+    def replay_trafficlights(self, t, row):
+        self.bridge.publish_traffic(self.log.trafficlights(row))
+
+    def replay_image(self, t, row):
+        self.bridge.publish_camera_encoded(self.log.image(row))
+
+
+if __name__ == '__main__':
+    try:
+        SessionReplayer()
+    except rospy.ROSInterruptException:
+        rospy.logerr('Could not start session replay node.')
@@ -8,56 +8,172 @@ import socketio
 import time
 from flask import Flask, render_template
 
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+import rospy
+
 from bridge import Bridge
 from conf import conf
 
 sio = socketio.Server()
 app = Flask(__name__)
-msgs = []
 
-dbw_enable = False
+# CPU time of the calling process (time.clock is CPU time on unix in python 2)
+cpu_time = getattr(time, 'process_time', time.clock)
+
+# Handler statistics, queried by load_generator.py via the 'bench_stats' event
+stats = {}
+
+def reset_stats():
+    stats['handlers'] = {}
+    stats['emitted'] = {}
+    stats['max_backlog'] = 0
+
+reset_stats()
+
+def timed(event):
+    '''Decorator which accumulates call count and CPU time of a handler'''
+    def decorator(handler):
+        def wrapper(sid, data):
+            start = cpu_time()
+            try:
+                return handler(sid, data)
+            finally:
+                entry = stats['handlers'].setdefault(event, [0, 0.])
+                entry[0] += 1
+                entry[1] += cpu_time() - start
+        return wrapper
+    return decorator
+
+
+class Session(object):
+    '''A simulator instance: its own Bridge (in its own ROS namespace) and outbox'''
+
+    def __init__(self, namespace, room=None):
+        self.namespace = namespace
+        # None broadcasts to all clients (single session mode)
+        self.room = room
+        self.msgs = []
+        self.dbw_enable = False
+        self.bridge = Bridge(conf, self.send, namespace)
+
+    def send(self, topic, data):
+        self.msgs.append((topic, data))
+        #sio.emit(topic, data=json.dumps(data), skip_sid=True)
+
+    def flush(self):
+        stats['max_backlog'] = max(stats['max_backlog'], len(self.msgs))
+        for i in range(len(self.msgs)):
+            topic, data = self.msgs.pop(0)
+            if self.room is None:
+                sio.emit(topic, data=data, skip_sid=True)
+            else:
+                sio.emit(topic, data=data, room=self.room)
+            stats['emitted'][topic] = stats['emitted'].get(topic, 0) + 1
+
+
+rospy.init_node('styx_server')
+
+# With ~multi_session every socket.io client gets its own Session in the
+# namespace given by the ns query parameter of the connection (e.g.
+# http://host:4567/?ns=sim3) or else the next free <~namespace_prefix><n>.
+# Otherwise all clients share one Session in the root namespace.
+multi_session = rospy.get_param('~multi_session', False)
+namespace_prefix = rospy.get_param('~namespace_prefix', 'sim')
+sessions = {}
+default_session = None if multi_session else Session('')
+
+def get_session(sid):
+    return sessions.get(sid, default_session)
+
+def free_namespace():
+    used = set(s.namespace for s in sessions.values())
+    idx = 0
+    while '/{0}{1}'.format(namespace_prefix, idx) in used:
+        idx += 1
+    return '/{0}{1}'.format(namespace_prefix, idx)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-
-def send(topic, data):
-    s = 1
-    msgs.append((topic, data))
-    #sio.emit(topic, data=json.dumps(data), skip_sid=True)
-
-bridge = Bridge(conf, send)
+    if not multi_session:
+        return
+    requested = parse_qs(environ.get('QUERY_STRING', '')).get('ns')
+    namespace = '/' + requested[0].strip('/') if requested else free_namespace()
+    if namespace in set(s.namespace for s in sessions.values()):
+        rospy.logerr('Rejecting simulator %s - namespace %s already in use', sid, namespace)
+        return False
+    sessions[sid] = Session(namespace, room=sid)
+    rospy.loginfo('Simulator %s connected in namespace %s', sid, namespace)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    session = sessions.pop(sid, None)
+    if session is not None:
+        session.bridge.shutdown()
+        rospy.loginfo('Simulator %s in namespace %s disconnected', sid, session.namespace)
 
 @sio.on('telemetry')
+@timed('telemetry')
 def telemetry(sid, data):
-    global dbw_enable
-    if data["dbw_enable"] != dbw_enable:
-        dbw_enable = data["dbw_enable"]
-        bridge.publish_dbw_status(dbw_enable)
-    bridge.publish_odometry(data)
-    for i in range(len(msgs)):
-        topic, data = msgs.pop(0)
-        sio.emit(topic, data=data, skip_sid=True)
+    session = get_session(sid)
+    if session is None:
+        return
+    if data["dbw_enable"] != session.dbw_enable:
+        session.dbw_enable = data["dbw_enable"]
+        session.bridge.publish_dbw_status(session.dbw_enable)
+    session.bridge.publish_odometry(data)
+    session.flush()
 
 @sio.on('control')
+@timed('control')
 def control(sid, data):
-    bridge.publish_controls(data)
+    session = get_session(sid)
+    if session is not None:
+        session.bridge.publish_controls(data)
 
 @sio.on('obstacle')
+@timed('obstacle')
 def obstacle(sid, data):
-    bridge.publish_obstacles(data)
+    session = get_session(sid)
+    if session is not None:
+        session.bridge.publish_obstacles(data)
 
 @sio.on('lidar')
+@timed('lidar')
 def obstacle(sid, data):
-    bridge.publish_lidar(data)
+    session = get_session(sid)
+    if session is not None:
+        session.bridge.publish_lidar(data)
 
 @sio.on('trafficlights')
+@timed('trafficlights')
 def trafficlights(sid, data):
-    bridge.publish_traffic(data)
+    session = get_session(sid)
+    if session is not None:
+        session.bridge.publish_traffic(data)
 
 @sio.on('image')
+@timed('image')
 def image(sid, data):
-    bridge.publish_camera(data)
+    session = get_session(sid)
+    if session is not None:
+        session.bridge.publish_camera(data)
+
+@sio.on('bench_stats')
+def bench_stats(sid, data):
+    '''Returns (as socket.io ack) the handler statistics and resets them on request'''
+    all_sessions = list(sessions.values()) + ([default_session] if default_session else [])
+    result = {'handlers': dict(stats['handlers']),
+              'emitted': dict(stats['emitted']),
+              'max_backlog': stats['max_backlog'],
+              'backlog': sum(len(s.msgs) for s in all_sessions)}
+    if data and data.get('reset'):
+        reset_stats()
+    return result
 
 if __name__ == '__main__':
 
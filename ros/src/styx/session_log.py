@@ -0,0 +1,169 @@
+'''
+Columnar on-disk log of the traffic the simulator sends to the styx bridge.
+
+A session is a directory. Every stream is stored column-wise - one raw
+little endian file per column - so a reader can memory-map each column as a
+NumPy array without parsing anything. Encoded camera frames go into one
+append-only blob file, indexed by the offset/length columns of the image
+stream. Row counts are derived from the file sizes, so a session that was
+not closed properly (e.g. the bridge got killed) is still readable - the
+recorder flushes its files at least every FLUSH_INTERVAL seconds, so such a
+session loses at most the events of the last interval.
+
+    index.json            version and column layout of all streams
+    telemetry.<column>    t, x, y, z, yaw, velocity, dbw_enable
+    trafficlights.<col>   t, first, count (rows in the lights stream)
+    lights.<column>       x, y, z, dx, dy, state (one row per light)
+    image.<column>        t, offset, length (bytes in images.blob)
+    images.blob           camera frames as sent by the simulator (jpeg/png)
+'''
+
+import json
+import mmap
+import os
+import time
+
+import numpy as np
+
+VERSION = 1
+BLOB_FILE = 'images.blob'
+INDEX_FILE = 'index.json'
+# seconds between flushes of the recorded files
+FLUSH_INTERVAL = 1.0
+
+STREAMS = {
+    'telemetry': [('t', '<f8'), ('x', '<f8'), ('y', '<f8'), ('z', '<f8'),
+                  ('yaw', '<f8'), ('velocity', '<f8'), ('dbw_enable', 'u1')],
+    'trafficlights': [('t', '<f8'), ('first', '<u8'), ('count', '<u4')],
+    'lights': [('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('dx', '<f8'), ('dy', '<f8'), ('state', 'u1')],
+    'image': [('t', '<f8'), ('offset', '<u8'), ('length', '<u4')],
+}
+
+# streams which are replayed as messages (lights are part of trafficlights)
+EVENT_STREAMS = ('telemetry', 'trafficlights', 'image')
+
+
+class SessionRecorder(object):
+    '''Appends telemetry, traffic light and camera events to a session directory'''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, INDEX_FILE), 'w') as ifile:
+            json.dump({'version': VERSION, 'blob': BLOB_FILE, 'streams': STREAMS}, ifile, indent=2)
+        self.files = {}
+        for stream, columns in STREAMS.items():
+            for name, dtype in columns:
+                self.files[(stream, name)] = open(self.column_path(stream, name), 'ab')
+        self.blob = open(os.path.join(path, BLOB_FILE), 'ab')
+        self.blob_size = self.blob.tell()
+        self.light_count = os.path.getsize(self.column_path('lights', 'x')) // 8
+        self.flushed = time.time()
+
+    def column_path(self, stream, name):
+        return os.path.join(self.path, '{0}.{1}'.format(stream, name))
+
+    def append(self, stream, values):
+        # values is a sequence per column (one row) or array per column (many rows)
+        for (name, dtype), value in zip(STREAMS[stream], values):
+            self.files[(stream, name)].write(np.asarray(value, dtype=dtype).tobytes())
+
+    def telemetry(self, t, data):
+        self.append('telemetry', (t, data['x'], data['y'], data['z'], data['yaw'],
+                                  data['velocity'], data.get('dbw_enable', True)))
+        self.flush_due()
+
+    def trafficlights(self, t, data):
+        count = len(data['light_state'])
+        self.append('lights', (data['light_pos_x'], data['light_pos_y'], data['light_pos_z'],
+                               data['light_pos_dx'], data['light_pos_dy'], data['light_state']))
+        self.append('trafficlights', (t, self.light_count, count))
+        self.light_count += count
+        self.flush_due()
+
+    def image(self, t, encoded):
+        self.blob.write(encoded)
+        self.append('image', (t, self.blob_size, len(encoded)))
+        self.blob_size += len(encoded)
+        self.flush_due()
+
+    def flush_due(self):
+        if time.time() - self.flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        # referenced data first: the frames before the image rows, the lights
+        # before the trafficlights rows pointing to them
+        self.blob.flush()
+        for stream in ('lights', 'image', 'telemetry', 'trafficlights'):
+            for name, dtype in STREAMS[stream]:
+                self.files[(stream, name)].flush()
+        self.flushed = time.time()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.blob.close()
+
+
+class SessionReader(object):
+    '''Memory-maps a session directory written by SessionRecorder'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as ifile:
+            index = json.load(ifile)
+        if index['version'] != VERSION:
+            raise ValueError('unsupported session log version {0}'.format(index['version']))
+        self.columns = {}
+        for stream, columns in index['streams'].items():
+            paths = [os.path.join(path, '{0}.{1}'.format(stream, name)) for name, dtype in columns]
+            # only complete rows count - the last one may be partially written
+            rows = min(os.path.getsize(p) // np.dtype(dtype).itemsize
+                       for p, (name, dtype) in zip(paths, columns))
+            self.columns[stream] = dict((name, self.map_column(p, dtype, rows))
+                                        for p, (name, dtype) in zip(paths, columns))
+        blob_path = os.path.join(path, index['blob'])
+        self.blob = None
+        if os.path.getsize(blob_path) > 0:
+            with open(blob_path, 'rb') as bfile:
+                self.blob = mmap.mmap(bfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def map_column(self, path, dtype, rows):
+        if rows == 0:
+            # np.memmap can't map empty files
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+
+    def __len__(self):
+        return sum(len(self.columns[stream]['t']) for stream in EVENT_STREAMS)
+
+    def timeline(self):
+        '''Returns time, stream index (into EVENT_STREAMS) and row of all events in time order'''
+        times = [np.asarray(self.columns[stream]['t']) for stream in EVENT_STREAMS]
+        streams = [np.full(len(t), i, dtype=np.uint8) for i, t in enumerate(times)]
+        rows = [np.arange(len(t)) for t in times]
+        times, streams, rows = np.concatenate(times), np.concatenate(streams), np.concatenate(rows)
+        # stable sort keeps the recording order of events with equal stamps
+        order = np.argsort(times, kind='mergesort')
+        return times[order], streams[order], rows[order]
+
+    def telemetry(self, row):
+        c = self.columns['telemetry']
+        return {'x': float(c['x'][row]), 'y': float(c['y'][row]), 'z': float(c['z'][row]),
+                'yaw': float(c['yaw'][row]), 'velocity': float(c['velocity'][row]),
+                'dbw_enable': bool(c['dbw_enable'][row])}
+
+    def trafficlights(self, row):
+        first = int(self.columns['trafficlights']['first'][row])
+        last = first + int(self.columns['trafficlights']['count'][row])
+        c = self.columns['lights']
+        return {'light_pos_x': c['x'][first:last].tolist(), 'light_pos_y': c['y'][first:last].tolist(),
+                'light_pos_z': c['z'][first:last].tolist(), 'light_pos_dx': c['dx'][first:last].tolist(),
+                'light_pos_dy': c['dy'][first:last].tolist(), 'light_state': c['state'][first:last].tolist()}
+
+    def image(self, row):
+        offset = int(self.columns['image']['offset'][row])
+        return self.blob[offset:offset + int(self.columns['image']['length'][row])]
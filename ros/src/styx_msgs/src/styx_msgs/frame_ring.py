@@ -0,0 +1,111 @@
+'''
+Ring buffer of camera frames in shared memory, for passing frames between
+processes on the same host without serialization.
+
+The ring is a file (in /dev/shm, i.e. POSIX shared memory) which the writer
+and the readers memory-map. It consists of a file header and a fixed number
+of equally sized slots, each with its own header:
+
+    file header   magic, version, number of slots, slot size (data bytes)
+    slot header   sequence, stamp, height, width, channels
+    slot data     height x width x channels uint8 pixels
+
+Frames are written round-robin. A reader gets the slot and sequence number
+of a frame from a styx_msgs/FrameDescriptor and maps the pixels in place -
+the frame is valid as long as the slot still carries that sequence number
+(the writer sets it to 0 while it overwrites a slot).
+'''
+
+import mmap
+import os
+
+import numpy as np
+
+MAGIC = b'STYXRING'
+VERSION = 1
+HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 64
+
+FILE_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('slots', '<u4'), ('slot_size', '<u8')])
+SLOT_HEADER = np.dtype([('sequence', '<u8'), ('stamp', '<f8'), ('height', '<u4'),
+                        ('width', '<u4'), ('channels', '<u4')])
+
+
+class FrameRing(object):
+    def __init__(self, path, slots=None, slot_size=None):
+        '''Creates the ring (if slots and slot_size are given) or opens an existing one'''
+        self.path = path
+        if slots is not None:
+            with open(path, 'wb') as rfile:
+                rfile.truncate(HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_size))
+        with open(path, 'r+b') as rfile:
+            self.map = mmap.mmap(rfile.fileno(), 0)
+        header = np.ndarray((), dtype=FILE_HEADER, buffer=self.map)
+        if slots is not None:
+            header['magic'] = MAGIC
+            header['version'] = VERSION
+            header['slots'] = slots
+            header['slot_size'] = slot_size
+        elif header['magic'] != MAGIC or header['version'] != VERSION:
+            raise ValueError('{0} is no frame ring (version {1})'.format(path, VERSION))
+        self.slots = int(header['slots'])
+        self.slot_size = int(header['slot_size'])
+        self.headers = [np.ndarray((), dtype=SLOT_HEADER, buffer=self.map, offset=self.slot_offset(slot))
+                        for slot in range(self.slots)]
+        # the next sequence number to write (sequence 0 marks a slot as invalid)
+        self.sequence = max(int(h['sequence']) for h in self.headers) + 1
+
+    def slot_offset(self, slot):
+        return HEADER_SIZE + slot * (SLOT_HEADER_SIZE + self.slot_size)
+
+    def write(self, frame, stamp=0.):
+        '''Copies a height x width (x channels) uint8 frame into the next slot
+
+        Returns:
+            (int, int): slot and sequence number of the frame
+
+        '''
+        frame = np.asarray(frame, dtype=np.uint8)
+        if frame.nbytes > self.slot_size:
+            raise ValueError('frame of {0} bytes exceeds the slot size of {1}'.format(frame.nbytes, self.slot_size))
+        sequence = self.sequence
+        slot = sequence % self.slots
+        header = self.headers[slot]
+        header['sequence'] = 0
+        data = np.ndarray(frame.shape, dtype=np.uint8, buffer=self.map,
+                          offset=self.slot_offset(slot) + SLOT_HEADER_SIZE)
+        data[...] = frame
+        header['stamp'] = stamp
+        header['height'] = frame.shape[0]
+        header['width'] = frame.shape[1]
+        header['channels'] = frame.shape[2] if frame.ndim == 3 else 1
+        header['sequence'] = sequence
+        self.sequence += 1
+        return slot, sequence
+
+    def read(self, slot, sequence):
+        '''Returns the frame of slot as array mapped onto the ring (None if it was overwritten)
+
+        The array is only valid as long as valid(slot, sequence) is true -
+        copy what has to be kept.
+        '''
+        header = self.headers[slot]
+        if not self.valid(slot, sequence):
+            return None
+        shape = (int(header['height']), int(header['width']), int(header['channels']))
+        frame = np.ndarray(shape, dtype=np.uint8, buffer=self.map,
+                           offset=self.slot_offset(slot) + SLOT_HEADER_SIZE)
+        frame.flags.writeable = False
+        return frame
+
+    def valid(self, slot, sequence):
+        return int(self.headers[slot]['sequence']) == sequence
+
+    def close(self):
+        self.headers = []
+        self.map.close()
+
+    def unlink(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,81 @@
+'''
+Conversion between styx_msgs/Lane and the array based styx_msgs/LaneCompact.
+
+LaneCompact keeps position, yaw and velocity of every waypoint in parallel
+float32 arrays - no per waypoint headers and objects. It is used where
+/base_waypoints and /final_waypoints have to be (de)serialized at high rates,
+Lane is still needed by the C++ pure_pursuit node.
+
+Publish and subscribe with LaneCompactNumpy: its arrays are (de)serialized
+as numpy arrays in one piece instead of element by element.
+'''
+
+import math
+
+import numpy as np
+from geometry_msgs.msg import Quaternion
+from rospy.numpy_msg import numpy_msg
+
+from styx_msgs.msg import Lane, LaneCompact, Waypoint
+
+LaneCompactNumpy = numpy_msg(LaneCompact)
+
+
+def lane_to_compact(lane):
+    '''Returns the LaneCompact of a Lane (yaw is taken from the orientation)'''
+    values = np.array([(wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z,
+                        wp.pose.pose.orientation.x, wp.pose.pose.orientation.y,
+                        wp.pose.pose.orientation.z, wp.pose.pose.orientation.w,
+                        wp.twist.twist.linear.x) for wp in lane.waypoints]).reshape(-1, 8)
+    qx, qy, qz, qw = values[:, 3], values[:, 4], values[:, 5], values[:, 6]
+    yaw = np.arctan2(2. * (qw * qz + qx * qy), 1. - 2. * (qy * qy + qz * qz))
+    return array_to_compact(values[:, :3], yaw, values[:, 7], lane.header)
+
+
+def array_to_compact(xyz, yaw, v, header=None):
+    '''Returns the LaneCompact for N x 3 positions, N yaw angles and N velocities'''
+    compact = LaneCompactNumpy()
+    if header is not None:
+        compact.header = header
+    # numpy arrays are serialized without conversion to python lists
+    xyz = np.asarray(xyz, dtype=np.float32)
+    compact.x = np.ascontiguousarray(xyz[:, 0])
+    compact.y = np.ascontiguousarray(xyz[:, 1])
+    compact.z = np.ascontiguousarray(xyz[:, 2])
+    compact.yaw = np.asarray(yaw, dtype=np.float32)
+    compact.v = np.asarray(v, dtype=np.float32)
+    return compact
+
+
+def compact_to_array(compact):
+    '''Returns positions (N x 3), yaw and velocity arrays of a LaneCompact'''
+    xyz = np.column_stack((np.asarray(compact.x, dtype=np.float64), np.asarray(compact.y, dtype=np.float64),
+                           np.asarray(compact.z, dtype=np.float64)))
+    return xyz, np.asarray(compact.yaw, dtype=np.float64), np.asarray(compact.v, dtype=np.float64)
+
+
+def lane_positions(lane):
+    '''Returns the positions (N x 3, read-only) of the waypoints of a Lane, WaypointWindow or LaneCompact'''
+    if hasattr(lane, 'waypoints'):
+        xyz = np.array([(wp.pose.pose.position.x, wp.pose.pose.position.y, wp.pose.pose.position.z)
+                        for wp in lane.waypoints], dtype=np.float64).reshape(-1, 3)
+    else:
+        xyz = compact_to_array(lane)[0]
+    xyz.flags.writeable = False
+    return xyz
+
+
+def compact_to_lane(compact):
+    '''Returns the Lane of a LaneCompact'''
+    lane = Lane()
+    lane.header = compact.header
+    xyz, yaws, velocities = compact_to_array(compact)
+    for (x, y, z), yaw, v in zip(xyz.tolist(), yaws.tolist(), velocities.tolist()):
+        wp = Waypoint()
+        wp.pose.pose.position.x = x
+        wp.pose.pose.position.y = y
+        wp.pose.pose.position.z = z
+        wp.pose.pose.orientation = Quaternion(0., 0., math.sin(yaw / 2.), math.cos(yaw / 2.))
+        wp.twist.twist.linear.x = v
+        lane.waypoints.append(wp)
+    return lane
@@ -0,0 +1,141 @@
+'''
+Background writer of the images and CSV rows tl_detector dumps in debug
+mode, so that collecting data does not block the camera callback.
+
+The images and rows of a sample are queued together and written by one
+thread. It takes all samples waiting in the queue as a batch, keeps the CSV
+files open and flushes them once per batch. If the queue is full, the whole
+sample is dropped (see dropped) instead of waiting for the disk.
+
+The index of the next sample is kept in a small state file in the dump
+folder, so a restart continues numbering without scanning the folder - only
+a folder written before the state file existed is scanned once.
+
+    writer = DebugWriter('./traffic_light_images/')
+    index = writer.take_index()
+    writer.write_sample(images=[('traffic_light_{0}.png'.format(index), bgr_image)],
+                        rows=[('params.csv', (index, dx, dy, dz, state))])
+'''
+
+import os
+import re
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import cv2
+
+STATE_FILE = 'next_index'
+# samples waiting to be written at most
+QUEUE_SIZE = 64
+
+
+def scan_next_index(folder):
+    '''Returns the index after the highest index of the png files in a folder'''
+    next_index = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            match = re.search(r'\d+', name)
+            if name.endswith('.png') and match:
+                next_index = max(next_index, int(match.group(0)) + 1)
+    return next_index
+
+
+class DebugWriter(object):
+    def __init__(self, folder, queue_size=QUEUE_SIZE):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.state_path = os.path.join(folder, STATE_FILE)
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as sfile:
+                self.next_index = int(sfile.read().strip() or 0)
+        else:
+            self.next_index = scan_next_index(folder)
+        self.saved_index = None
+        self.queue = queue.Queue(queue_size)
+        # csv name -> open file
+        self.files = {}
+        # samples dropped because the queue was full, files which failed to be written
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def take_index(self):
+        '''Returns the index of the next sample'''
+        index = self.next_index
+        self.next_index += 1
+        return index
+
+    def write_sample(self, images=(), rows=()):
+        '''Queues the images and CSV rows of a sample
+
+        Args:
+            images: (name, image) for cv2.imwrite - the images must not be modified afterwards
+            rows: (csv name, fields) to append a row to a CSV file
+
+        Names are relative to the folder of the writer (or absolute).
+
+        Returns:
+            bool: False if the sample was dropped
+        '''
+        rows = [(name, ','.join(str(field) for field in fields) + '\n') for name, fields in rows]
+        try:
+            self.queue.put_nowait((list(images), rows))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for sample in batch:
+                if sample is not None:
+                    self.write(sample)
+            for cfile in self.files.values():
+                cfile.flush()
+            self.save_index()
+            if batch[-1] is None:
+                break
+
+    def write(self, sample):
+        images, rows = sample
+        try:
+            for name, image in images:
+                if not cv2.imwrite(os.path.join(self.folder, name), image):
+                    self.failed += 1
+            for name, row in rows:
+                if name not in self.files:
+                    self.files[name] = open(os.path.join(self.folder, name), 'a')
+                self.files[name].write(row)
+        except (IOError, OSError, cv2.error):
+            self.failed += 1
+
+    def save_index(self):
+        next_index = self.next_index
+        if next_index == self.saved_index:
+            return
+        # replaced at once, a crash leaves the old or the new index
+        with open(self.state_path + '.tmp', 'w') as sfile:
+            sfile.write('{0}\n'.format(next_index))
+        os.rename(self.state_path + '.tmp', self.state_path)
+        self.saved_index = next_index
+
+    def close(self):
+        '''Writes everything queued and closes the files'''
+        self.queue.put(None)
+        self.thread.join()
+        for cfile in self.files.values():
+            cfile.close()
+        self.files = {}
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+'''
+Offline evaluation of the traffic light detection on frames dumped by
+tl_detector in debug mode: a folder with traffic_light_<index>.png and
+params.csv, which lists index, camera coordinates (dx, dy, dz) of the light
+and its TrafficLight state per frame.
+
+Every frame goes through the stages of process_traffic_lights - projection
+of the light (light_geometry.py), crop and classification - in a pool of
+processes, without ROS or the simulator. Reported are the latency
+percentiles per stage, the throughput and the confusion matrix of the
+ground truth and the predicted state (frames with a state other than red,
+yellow or green are counted as unlabelled).
+
+Given labelled crops instead (a directory or zip with light_state.csv, see
+labelled_crops.py), only the classify stage is evaluated, one crop per call
+as in tl_detector. That is the default: the crops of
+traffic_light_images/training_data.zip, which quantized.py and the
+validation of a swapped checkpoint use as well.
+
+    python evaluate_detector.py [--config sim_traffic_light_config.yaml] [--classifier cnn|int8|heuristic]
+                                [--calibration grasshopper_calibration.yml] [--workers N] [frames or crops]
+
+The frames shipped in traffic_light_images are no benchmark of the other
+stages: all 147 of them have state 3 (unknown), and their light coordinates
+lie outside the image with either config. So every frame counts as
+unlabelled and invisible, and only the read and project stages are timed.
+Use a fresh debug dump of tl_detector with the config it was recorded with.
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+
+import cv2
+import numpy as np
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, 'light_classification'))
+
+from labelled_crops import STATE_FILE, load_labelled_crops
+from light_geometry import CameraModel
+from mp_util import get_context
+
+STAGES = ('read', 'project', 'crop', 'classify')
+CLASSIFIERS = ('cnn', 'int8', 'heuristic')
+# rows of the confusion matrix: ground truth red, yellow, green, unlabelled
+# columns: predicted red, yellow, green, light not visible
+TRUTH_NAMES = ('red', 'yellow', 'green', 'unlabelled')
+PREDICTED_NAMES = ('red', 'yellow', 'green', 'invisible')
+
+# set up per worker process by init_worker
+worker = {}
+
+
+def read_params(folder):
+    '''Returns (index, (dx, dy, dz), state) of the frames listed in params.csv'''
+    frames = []
+    with open(os.path.join(folder, 'params.csv')) as pfile:
+        for line in pfile:
+            fields = line.split(',')
+            # skip the header line
+            if len(fields) == 5 and fields[0].strip().isdigit():
+                frames.append((int(fields[0]), tuple(float(f) for f in fields[1:4]), int(fields[4])))
+    return frames
+
+
+def camera_model(config_path, calibration_path=None):
+    '''CameraModel and image size of a traffic light config (and camera calibration yaml)'''
+    with open(config_path) as cfile:
+        info = yaml.safe_load(cfile)['camera_info']
+    width, height = info['image_width'], info['image_height']
+    camera = CameraModel(info.get('focal_length_x', 2646), info.get('focal_length_y', 2647),
+                         info.get('focal_center_x', width / 2), info.get('focal_center_y', height / 2),
+                         info.get('image_scale', 8000))
+    if calibration_path:
+        with open(calibration_path) as cfile:
+            calibration = yaml.safe_load(cfile)
+        camera.calibrate(calibration['camera_matrix']['data'], calibration['distortion_coefficients']['data'],
+                         calibration['rectification_matrix']['data'], calibration['projection_matrix']['data'],
+                         calibration['image_width'], calibration['image_height'])
+    return camera, width, height
+
+
+def load_classifier(name, checkpoint):
+    '''Returns a function classifying a batch of 32x32px rgb crops into labels'''
+    if name == 'heuristic':
+        from color_heuristic import classify
+        return lambda crops: classify(crops)[0]
+    if name == 'int8':
+        from quantized import QuantizedClassifier as TrafficLightClassifier
+    else:
+        from tlclassifier import TrafficLightClassifier
+    classifier = TrafficLightClassifier(checkpoint)
+    classifier.warmUp()
+    return classifier.classifyImages
+
+
+def init_worker(ready, folder, config_path, calibration_path, classifier, checkpoint):
+    try:
+        worker['folder'] = folder
+        # crops need no camera
+        if config_path:
+            worker['camera'], worker['width'], worker['height'] = camera_model(config_path, calibration_path)
+        worker['classify'] = load_classifier(classifier, checkpoint)
+    except Exception as e:
+        ready.put(repr(e))
+        raise
+    # the worker is set up - None means no error
+    ready.put(None)
+
+
+def evaluate_frame(frame):
+    '''Runs the stages on a frame, returns (state, predicted label or None, seconds per stage)'''
+    index, point, state = frame
+    camera = worker['camera']
+    seconds = {}
+    start = time.time()
+    image = cv2.imread(os.path.join(worker['folder'], 'traffic_light_{0}.png'.format(index)))
+    image = None if image is None else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    seconds['read'] = time.time() - start
+    if image is None:
+        return state, None, seconds
+    if image.shape[:2] != (worker['height'], worker['width']):
+        image = cv2.resize(image, (worker['width'], worker['height']))
+
+    start = time.time()
+    centers, boxes = camera.project_points([point])
+    visible = camera.visible(boxes, worker['width'], worker['height'])[0]
+    seconds['project'] = time.time() - start
+    if not visible:
+        return state, None, seconds
+
+    start = time.time()
+    crop = cv2.resize(camera.undistort_crop(image, boxes[0]), (32, 32))
+    seconds['crop'] = time.time() - start
+
+    start = time.time()
+    label = int(worker['classify'](crop[np.newaxis])[0])
+    seconds['classify'] = time.time() - start
+    return state, label, seconds
+
+
+def evaluate_crop(crop):
+    '''Classifies a labelled crop (state, 32x32px rgb image), returns (state, predicted label, seconds per stage)'''
+    state, image = crop
+    start = time.time()
+    label = int(worker['classify'](image[np.newaxis])[0])
+    return state, label, {'classify': time.time() - start}
+
+
+def run_pool(function, items, workers, init_args):
+    '''Runs function on the items in workers set up by init_worker, returns the results and the seconds'''
+    ctx = get_context()
+    ready = ctx.Queue()
+    pool = ctx.Pool(workers, init_worker, (ready,) + tuple(init_args))
+    # the models of all workers are loaded before the clock starts
+    for i in range(workers):
+        error = ready.get()
+        if error is not None:
+            pool.terminate()
+            raise RuntimeError('a worker failed to load: {0}'.format(error))
+    start = time.time()
+    results = pool.map(function, items, chunksize=max(1, len(items) // (4 * workers)))
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    return results, elapsed
+
+
+def evaluate(folder, config_path, classifier='cnn', checkpoint=None, calibration_path=None, workers=None):
+    '''Evaluates all stages on the frames of a debug dump, returns the confusion matrix'''
+    frames = read_params(folder)
+    workers = workers or multiprocessing.cpu_count()
+    checkpoint = checkpoint or os.path.join(HERE, 'light_classification/tensor/linux_tensor0.999')
+    results, elapsed = run_pool(evaluate_frame, frames, workers,
+                                (folder, config_path, calibration_path, classifier, checkpoint))
+    print('{0} frames of {1}, {2} classifier, {3} workers'.format(len(frames), folder, classifier, workers))
+    return report(results, elapsed, 'frames')
+
+
+def evaluate_crops(path, classifier='cnn', checkpoint=None, workers=None):
+    '''Evaluates the classify stage on labelled crops (see labelled_crops.py), returns the confusion matrix'''
+    images, labels = load_labelled_crops(path)
+    workers = workers or multiprocessing.cpu_count()
+    checkpoint = checkpoint or os.path.join(HERE, 'light_classification/tensor/linux_tensor0.999')
+    results, elapsed = run_pool(evaluate_crop, list(zip(labels.tolist(), images)), workers,
+                                (path, None, None, classifier, checkpoint))
+    print('{0} labelled crops of {1}, {2} classifier, {3} workers'.format(len(labels), path, classifier, workers))
+    return report(results, elapsed, 'crops')
+
+
+def is_crops(path):
+    '''True for labelled crops (zip or directory with light_state.csv), False for a folder of frames'''
+    return zipfile.is_zipfile(path) or os.path.exists(os.path.join(path, STATE_FILE))
+
+
+def report(results, elapsed, unit):
+    '''Prints throughput, latency per stage and the confusion matrix of (state, label, seconds) results'''
+    print('throughput: {0:.1f} {1}/s'.format(len(results) / max(elapsed, 1e-9), unit))
+    print('{0:>10} {1:>8} {2:>10} {3:>10} {4:>10}'.format('stage', unit, 'p50 [ms]', 'p90 [ms]', 'p99 [ms]'))
+    for stage in STAGES:
+        times = [1000. * seconds[stage] for state, label, seconds in results if stage in seconds]
+        if times:
+            p50, p90, p99 = np.percentile(times, (50, 90, 99))
+            print('{0:>10} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f}'.format(stage, len(times), p50, p90, p99))
+
+    confusion = np.zeros((len(TRUTH_NAMES), len(PREDICTED_NAMES)), dtype=np.int64)
+    for state, label, seconds in results:
+        confusion[state if state in (0, 1, 2) else 3, 3 if label is None else label] += 1
+    print('confusion matrix (rows: ground truth, columns: predicted)')
+    print('{0:>12}'.format('') + ''.join('{0:>11}'.format(name) for name in PREDICTED_NAMES))
+    for name, row in zip(TRUTH_NAMES, confusion):
+        print('{0:>12}'.format(name) + ''.join('{0:>11}'.format(count) for count in row))
+    labelled = confusion[:3, :3]
+    if labelled.sum():
+        print('accuracy on {0} labelled visible {1}: {2:.4f}'.format(
+            labelled.sum(), unit, np.trace(labelled) / float(labelled.sum())))
+    else:
+        print('no labelled visible frames - do the frames match the config? (see evaluate_detector.py)')
+    return confusion
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline evaluation of projection, crop and classification')
+    parser.add_argument('path', nargs='?', default=os.path.join(HERE, 'traffic_light_images/training_data.zip'),
+                        help='folder of frames (params.csv) or labelled crops (zip or folder with light_state.csv)')
+    parser.add_argument('--config', default=os.path.join(HERE, 'sim_traffic_light_config.yaml'),
+                        help='traffic light config with the camera_info of the frames')
+    parser.add_argument('--calibration', help='camera calibration yaml to undistort the crops with')
+    parser.add_argument('--classifier', choices=CLASSIFIERS, default='cnn')
+    parser.add_argument('--checkpoint', help='checkpoint of the LeNet model (cnn and int8)')
+    parser.add_argument('--workers', type=int, help='processes (default: number of cpus)')
+    args = parser.parse_args()
+    if is_crops(args.path):
+        evaluate_crops(args.path, args.classifier, args.checkpoint, args.workers)
+    else:
+        evaluate(args.path, args.config, args.classifier, args.checkpoint, args.calibration, args.workers)
@@ -0,0 +1,170 @@
+'''
+Streaming augmentation of the training images of tlclassifier.py.
+
+Instead of storing 14 augmented copies of every image and oversampling the
+rare colors by duplicates, the batches are drawn on the fly: every batch has
+the same number of images of each color and every image gets one of the 14
+augmentations at random - the original, rotated by +/-15 or +/-90 degree, or
+shifted by 2px to the bottom right / top left, each of them also flipped
+left-right.
+
+Worker threads prepare the batches ahead while the training step runs, so
+memory stays at one copy of the dataset plus the prefetched batches. The
+batch arrays are allocated once and reused - a batch is valid until the
+next one is taken.
+
+    generator = BatchGenerator(images, labels, batch_size=128)
+    for batch_x, batch_y in generator.batches(steps):
+        ...
+    generator.close()
+'''
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import scipy.ndimage
+
+# the transformations, each one also flipped left-right
+TRANSFORMS = (None, ('rotate', 15.), ('rotate', 90.), ('shift', 2.),
+              ('rotate', -15.), ('rotate', -90.), ('shift', -2.))
+AUGMENTATIONS = 2 * len(TRANSFORMS)
+
+
+def augment(images, variants, out=None):
+    '''Applies augmentation variant (0..13) to each image of a N x 32 x 32 x 3 batch
+
+    Returns the float32 result, which is written to out if given (may be images itself)
+    '''
+    if out is None:
+        out = np.empty(np.shape(images), dtype=np.float32)
+    if out is not images:
+        out[...] = images
+    transforms = np.asarray(variants) // 2
+    for transform in range(1, len(TRANSFORMS)):
+        selected = np.flatnonzero(transforms == transform)
+        if 0 == len(selected):
+            continue
+        kind, amount = TRANSFORMS[transform]
+        if kind == 'rotate' and amount % 90. == 0.:
+            # a quarter turn moves whole pixels - same result as scipy.ndimage.rotate
+            out[selected] = np.rot90(out[selected], int(amount // 90.), axes=(1, 2))
+        elif kind == 'rotate':
+            # on all selected images at once
+            out[selected] = scipy.ndimage.rotate(out[selected], amount, axes=(2, 1),
+                                                 reshape=False, mode='nearest')
+        else:
+            # shift by whole pixels, the border pixels repeated (mode='nearest' of scipy.ndimage.shift)
+            shift = int(amount)
+            padded = np.pad(out[selected], ((0, 0), (abs(shift),) * 2, (abs(shift),) * 2, (0, 0)), mode='edge')
+            start = abs(shift) - shift
+            out[selected] = padded[:, start:start + out.shape[1], start:start + out.shape[2]]
+    flipped = np.flatnonzero(np.asarray(variants) % 2 == 1)
+    out[flipped] = out[flipped, :, ::-1]
+    return out
+
+
+class BatchGenerator(object):
+    def __init__(self, images, labels, batch_size=128, augmented=True, workers=2, prefetch=4, seed=0):
+        """Draws class balanced (augmented) batches in background threads
+
+        Args:
+            images: N x 32 x 32 x 3 images (e.g. the memory map of image_cache.py)
+            labels: N labels (0=red, 1=yellow, 2=green)
+            batch_size: images per batch, split evenly between the colors
+            augmented: apply a random augmentation to every image
+            workers: threads preparing batches
+            prefetch: batches prepared ahead at most
+
+        """
+        self.images = images
+        self.labels = np.asarray(labels)
+        self.batch_size = batch_size
+        self.augmented = augmented
+        self.classes = [np.flatnonzero(self.labels == label) for label in np.unique(self.labels)]
+        self.queue = queue.Queue(prefetch)
+        # batch buffers: prefetched ones, one per worker and the one in use
+        self.free = queue.Queue()
+        for i in range(prefetch + workers + 1):
+            self.free.put((np.empty((batch_size,) + self.images.shape[1:], dtype=np.float32),
+                           np.empty(batch_size, dtype=self.labels.dtype)))
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.random = np.random.RandomState(seed)
+        # per class: a permutation of its images and the position in it
+        self.orders = [[self.random.permutation(members), 0] for members in self.classes]
+        self.workers = [threading.Thread(target=self.run) for i in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def sample(self):
+        '''Returns indices and augmentation variants of the next batch'''
+        counts = np.full(len(self.classes), self.batch_size // len(self.classes))
+        counts[:self.batch_size % len(self.classes)] += 1
+        indices = []
+        with self.lock:
+            # the first classes get the remainder - rotate it between the batches
+            counts = counts[self.random.permutation(len(counts))]
+            for order, count in zip(self.orders, counts):
+                while count > 0:
+                    # every image of a class is used once before any is used again
+                    taken = order[0][order[1]:order[1] + count]
+                    indices.extend(taken)
+                    count -= len(taken)
+                    order[1] += len(taken)
+                    if order[1] == len(order[0]):
+                        order[0] = self.random.permutation(order[0])
+                        order[1] = 0
+            indices = np.array(indices)[self.random.permutation(len(indices))]
+            variants = self.random.randint(AUGMENTATIONS if self.augmented else 1, size=len(indices))
+        return indices, variants
+
+    def take(self, source):
+        '''Returns the next item of a queue, None once the generator is closed'''
+        while not self.stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def run(self):
+        while not self.stop.is_set():
+            batch = self.take(self.free)
+            if batch is None:
+                break
+            images, labels = batch
+            indices, variants = self.sample()
+            # sorted reads are faster on a memory map
+            order = np.argsort(indices)
+            images[order] = self.images[indices[order]]
+            np.take(self.labels, indices, out=labels)
+            if self.augmented:
+                augment(images, variants, out=images)
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def batches(self, steps):
+        '''Yields steps batches (images float32, labels), each valid until the next is taken'''
+        batch = None
+        for step in range(steps):
+            if batch is not None:
+                self.free.put(batch)
+            batch = self.queue.get()
+            yield batch
+        if batch is not None:
+            self.free.put(batch)
+
+    def close(self):
+        self.stop.set()
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,247 @@
+'''
+Pool of worker processes classifying traffic light images with the LeNet
+model of tlclassifier.py - one TensorFlow session per worker, so
+classification scales with the number of cores instead of running in the
+(GIL bound) callback thread of tl_detector.
+
+The images are scaled to 32x32px in the calling process and passed through
+slots of a shared memory array; only request id and slot travel through the
+request queue. A worker takes all requests which are waiting and classifies
+them as one batch. The results are delivered asynchronously by request id.
+
+If a worker dies, the pool fails (see error): the waiting requests and all
+later ones get no result (None) instead of blocking the caller. A hung worker
+only costs RESULT_TIMEOUT per call - its requests and, once it holds all
+slots, the new ones get None as well.
+
+    pool = ClassifierPool(2, './light_classification/tensor/linux_tensor0.999')
+    request_id = pool.submit(image)
+    label = pool.result(request_id)     # 0=red, 1=yellow, 2=green
+    probabilities = pool.result(pool.submit(image), probabilities=True)
+'''
+
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+# TensorFlow free - the parent process doesn't load TensorFlow before it starts the workers
+from mp_util import get_context
+from resize import resizeImage
+
+IMAGE_SHAPE = (32, 32, 3)
+IMAGE_SIZE = 32 * 32 * 3
+
+# images a worker classifies in one session run at most
+MAX_BATCH = 32
+# seconds between the checks whether the workers are alive
+POLL_INTERVAL = 0.2
+# seconds result() waits by default
+RESULT_TIMEOUT = 5.
+
+
+def worker_main(graph_path, images, requests, results):
+    # TensorFlow is only needed in the workers
+    try:
+        from tlclassifier import TrafficLightClassifier
+        classifier = TrafficLightClassifier(graph_path)
+        classifier.warmUp()
+    except Exception as e:
+        results.put(('failed', str(e)))
+        return
+    results.put(('ready', None))
+    slots = np.frombuffer(images, dtype=np.uint8).reshape((-1,) + IMAGE_SHAPE)
+    while True:
+        batch = [requests.get()]
+        while batch[-1] is not None and len(batch) < MAX_BATCH:
+            try:
+                batch.append(requests.get_nowait())
+            except Exception:
+                break
+        stop = batch[-1] is None
+        batch = [request for request in batch if request is not None]
+        if batch:
+            probabilities = classifier.classifyImagesProbabilities(slots[[slot for request_id, slot in batch]])
+            for (request_id, slot), row in zip(batch, probabilities):
+                results.put((request_id, [float(p) for p in row]))
+        if stop:
+            break
+
+
+class ClassifierPool(object):
+    def __init__(self, size, graph_path, slots=None):
+        self.size = size
+        ctx = get_context()
+        slots = slots or 4 * size
+        self.images = ctx.RawArray('B', slots * IMAGE_SIZE)
+        self.slots = np.frombuffer(self.images, dtype=np.uint8).reshape((-1,) + IMAGE_SHAPE)
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [ctx.Process(target=worker_main, args=(graph_path, self.images,
+                                                              self.requests, self.results))
+                        for i in range(size)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        self.lock = threading.Lock()
+        # submit blocks while all slots are in use
+        self.free_slots = threading.Semaphore(slots)
+        self.slot_list = list(range(slots))
+        self.next_id = 0
+        # request id -> [slot, event, probabilities, callback]
+        self.pending = {}
+        # set once all workers loaded their model (or one of them failed, see error)
+        self.ready_count = 0
+        self.ready = threading.Event()
+        self.error = None
+        self.closing = False
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def submit(self, image, callback=None, timeout=RESULT_TIMEOUT):
+        '''Queues an image for classification
+
+        Args:
+            image: rgb image of any size
+            callback: called with request id and label once the image is classified
+            timeout: seconds to wait for a free slot
+
+        Returns:
+            int: request id (None if no slot got free in time or the pool failed)
+
+        '''
+        image = resizeImage(image)
+        deadline = time.time() + timeout
+        # a dead or hung worker keeps the slots of its requests - don't wait for them forever
+        while not self.free_slots.acquire(False):
+            if self.error is not None or time.time() > deadline:
+                return None
+            time.sleep(0.001)
+        with self.lock:
+            if self.error is not None:
+                self.free_slots.release()
+                return None
+            slot = self.slot_list.pop()
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = [slot, threading.Event(), None, callback]
+        self.slots[slot] = image
+        self.requests.put((request_id, slot))
+        return request_id
+
+    def result(self, request_id, timeout=RESULT_TIMEOUT, probabilities=False):
+        '''Waits for and returns the label (or the probabilities of red, yellow and green) of a request
+
+        Returns None on timeout, if the pool failed or for a request id of None.
+        '''
+        if request_id is None:
+            return None
+        with self.lock:
+            entry = self.pending.get(request_id)
+        if entry is None:
+            # the pool failed meanwhile
+            return None
+        entry[1].wait(timeout)
+        with self.lock:
+            if not entry[1].is_set():
+                # timed out - the collector drops the result once it arrives
+                entry[3] = lambda request_id, label: None
+                return None
+            self.pending.pop(request_id, None)
+        if entry[2] is None:
+            return None
+        if probabilities:
+            return entry[2]
+        return int(np.argmax(entry[2]))
+
+    def classify(self, image):
+        return self.classify_all([image])[0]
+
+    def classify_all(self, images, probabilities=False):
+        '''Submits the images and waits for their results, all of it within RESULT_TIMEOUT'''
+        deadline = time.time() + RESULT_TIMEOUT
+        request_ids = [self.submit(image, timeout=max(0., deadline - time.time())) for image in images]
+        return [self.result(request_id, max(0., deadline - time.time()), probabilities)
+                for request_id in request_ids]
+
+    def classify_batch(self, images):
+        '''Classifies the images in parallel and returns their labels in order (None if not classified)'''
+        return self.classify_all(images)
+
+    def classify_probabilities_batch(self, images):
+        '''Classifies the images in parallel and returns their probabilities (N x 3) in order
+
+        Returns None if not all of the images were classified.
+        '''
+        probabilities = self.classify_all(images, probabilities=True)
+        if any(row is None for row in probabilities):
+            return None
+        return np.array(probabilities).reshape(-1, 3)
+
+    def check_workers(self):
+        '''Fails the pool if a worker died - everybody waiting gets no result'''
+        dead = [worker for worker in self.workers if not worker.is_alive()]
+        if not dead or self.closing or self.error is not None:
+            return
+        self.error = 'classifier worker {0} died (exit code {1})'.format(dead[0].pid, dead[0].exitcode)
+        self.ready.set()
+        with self.lock:
+            waiting = list(self.pending.values())
+            self.pending = {}
+        for entry in waiting:
+            entry[1].set()
+            self.free_slots.release()
+
+    def collect(self):
+        while True:
+            try:
+                request_id, value = self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if self.closing:
+                    break
+                self.check_workers()
+                continue
+            if request_id == 'ready':
+                self.ready_count += 1
+                if self.ready_count == self.size:
+                    self.ready.set()
+                continue
+            if request_id == 'failed':
+                self.error = value
+                self.ready.set()
+                continue
+            with self.lock:
+                entry = self.pending.get(request_id)
+                if entry is None:
+                    # the pool failed meanwhile
+                    continue
+                entry[2] = value
+                self.slot_list.append(entry[0])
+                callback = entry[3]
+                if callback is not None:
+                    # nobody waits for the result
+                    del self.pending[request_id]
+            self.free_slots.release()
+            entry[1].set()
+            if callback is not None:
+                callback(request_id, int(np.argmax(value)))
+
+    def close(self):
+        self.closing = True
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join(RESULT_TIMEOUT)
+            if worker.is_alive():
+                # hung
+                worker.terminate()
+        # the collector stops once the results are drained - not by a message, a
+        # killed worker may have left the lock of the results queue taken
+        self.collector.join()
@@ -0,0 +1,87 @@
+'''
+Cheap first stage of the traffic light classification: counts the bright,
+saturated pixels of a 32x32px rgb crop per hue range of the three light
+colors. A crop with enough of them, nearly all in one range, is classified
+without the CNN - everything else is escalated to it.
+
+The hue ranges are the ones of the lit lamps in the simulator crops of
+traffic_light_images/training_data.zip. Evaluate on labelled crops with:
+
+    python color_heuristic.py [crops (directory or zip, see labelled_crops.py)]
+'''
+
+import os
+import sys
+
+import numpy as np
+
+# hue ranges [deg] of red (wraps around 0), yellow and green lamps
+HUE_RANGES = (((340., 360.), (0., 20.)), ((40., 80.),), ((100., 160.),))
+MIN_VALUE = 200.
+MIN_SATURATION = 0.4
+# lamp pixels needed for full confidence
+MIN_PIXELS = 6
+# crops classified with less confidence are escalated to the CNN
+MIN_CONFIDENCE = 0.8
+
+
+def rgb_to_hsv(images):
+    '''Returns hue [deg], saturation [0, 1] and value [0, 255] of rgb images (any leading shape)'''
+    rgb = np.asarray(images, dtype=np.float32)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    value = rgb.max(axis=-1)
+    delta = value - rgb.min(axis=-1)
+    saturation = np.where(value > 0, delta / np.maximum(value, 1.), 0.)
+    safe_delta = np.maximum(delta, 1e-6)
+    hue = np.where(value == r, ((g - b) / safe_delta) % 6.,
+                   np.where(value == g, (b - r) / safe_delta + 2., (r - g) / safe_delta + 4.)) * 60.
+    return hue, saturation, value
+
+
+def lamp_pixels(images):
+    '''Returns the number of lamp pixels per crop and color (N x 3)'''
+    hue, saturation, value = rgb_to_hsv(images)
+    lit = (value >= MIN_VALUE) & (saturation >= MIN_SATURATION)
+    counts = []
+    for ranges in HUE_RANGES:
+        in_range = np.zeros(hue.shape, dtype=bool)
+        for low, high in ranges:
+            in_range |= (hue >= low) & (hue < high)
+        counts.append((lit & in_range).reshape(len(hue), -1).sum(axis=1))
+    return np.stack(counts, axis=1)
+
+
+def classify(images):
+    '''Classifies a batch of 32x32px rgb crops
+
+    Returns:
+        (labels, confidences): label (0=red, 1=yellow, 2=green) and confidence [0, 1] per crop
+
+    '''
+    counts = lamp_pixels(images).astype(np.float32)
+    total = counts.sum(axis=1)
+    labels = np.argmax(counts, axis=1)
+    # share of the winning color, scaled down for small blobs
+    confidences = counts.max(axis=1) / np.maximum(total, 1.) * np.minimum(total / MIN_PIXELS, 1.)
+    return labels, confidences
+
+
+def evaluate(crops_path):
+    '''Prints escalation rate and accuracy of the confident crops'''
+    from labelled_crops import load_labelled_crops
+    images, labels = load_labelled_crops(crops_path)
+    predicted, confidences = classify(images)
+    confident = confidences >= MIN_CONFIDENCE
+    print('{0} labelled crops of {1}'.format(len(labels), crops_path))
+    print('escalated to the CNN: {0:.4f}'.format(1. - np.mean(confident)))
+    print('accuracy of the confident crops: {0:.4f}'.format(np.mean(predicted[confident] == labels[confident])))
+    for label, name in enumerate(('red', 'yellow', 'green')):
+        selected = labels == label
+        print('{0:>8}: escalated {1:.4f}, accuracy {2:.4f} of the confident crops'.format(
+            name, 1. - np.mean(confident[selected]),
+            np.mean(predicted[selected & confident] == label) if np.any(selected & confident) else 0.))
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    evaluate(sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, '../traffic_light_images/training_data.zip'))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+'''
+Removal of near-duplicate training crops (e.g. consecutive frames of the
+same light dumped by tl_detector) before training.
+
+Every 32x32px crop gets a 64 bit perceptual hash: the signs of the 8x8 lowest
+frequencies of the DCT of its gray image against their median, computed for
+all crops by two matrix products. Crops of the same color whose hashes
+differ in at most max_distance bits are clustered around the first crop of
+the cluster (leader clustering), only the first crop of each cluster is kept.
+
+    kept = deduplicate(images, labels, max_distance=4)    # indices of the kept crops
+
+Run on a training folder, it reports how much the set shrinks per color and,
+with --train, the test accuracy and training time of trainCNN with and
+without deduplication of the training split (validation and test keep all
+crops):
+
+    python deduplication.py [--distance 4] [--train] folder
+'''
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+HASH_SIZE = 8
+MAX_DISTANCE = 4
+# bits set per byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def dct_matrix(size):
+    '''Orthonormal DCT-II matrix, dct(x) = D x'''
+    k = np.arange(size)[:, np.newaxis]
+    n = np.arange(size)[np.newaxis, :]
+    matrix = np.sqrt(2. / size) * np.cos(np.pi * (2 * n + 1) * k / (2. * size))
+    matrix[0] /= np.sqrt(2.)
+    return matrix.astype(np.float32)
+
+
+def perceptual_hashes(images):
+    '''Returns the 64 bit perceptual hash (uint64) of each image of a N x H x W x 3 batch'''
+    gray = np.dot(np.asarray(images, dtype=np.float32), np.array([0.299, 0.587, 0.114], dtype=np.float32))
+    rows = dct_matrix(gray.shape[1])[:HASH_SIZE]
+    columns = dct_matrix(gray.shape[2])[:HASH_SIZE]
+    # the lowest frequencies of the 2d dct of all images
+    low = np.matmul(np.matmul(rows, gray), columns.T).reshape(len(gray), -1)
+    # the mean (first coefficient) would dominate the median
+    median = np.median(low[:, 1:], axis=1)
+    bits = np.packbits(low > median[:, np.newaxis], axis=1)
+    return bits.view('>u8').ravel().astype(np.uint64)
+
+
+def hamming_distances(hashes, reference):
+    '''Number of differing bits of each hash and the reference hash'''
+    difference = np.bitwise_xor(hashes, np.uint64(reference))
+    return POPCOUNT[difference.view(np.uint8)].reshape(len(hashes), -1).sum(axis=1)
+
+
+def cluster(hashes, labels, max_distance=MAX_DISTANCE):
+    '''Returns the index of the leader of its cluster for every hash
+
+    A cluster has one label - the first hash not in a cluster yet starts a new
+    one, which takes all remaining hashes of its label within max_distance bits.
+    '''
+    labels = np.asarray(labels)
+    leaders = np.zeros(len(labels), dtype=np.int64)
+    for label in np.unique(labels):
+        remaining = np.flatnonzero(labels == label)
+        while len(remaining):
+            near = hamming_distances(hashes[remaining], hashes[remaining[0]]) <= max_distance
+            leaders[remaining[near]] = remaining[0]
+            remaining = remaining[~near]
+    return leaders
+
+
+def deduplicate(images, labels, max_distance=MAX_DISTANCE):
+    '''Returns the sorted indices of the crops kept - the first one of each cluster of near-duplicates'''
+    leaders = cluster(perceptual_hashes(images), labels, max_distance)
+    return np.flatnonzero(leaders == np.arange(len(leaders)))
+
+
+def report(labels, kept):
+    '''Prints the number of crops before and after deduplication per color'''
+    labels = np.asarray(labels)
+    for label, name in enumerate(('red', 'yellow', 'green')):
+        total = np.count_nonzero(labels == label)
+        if total:
+            left = np.count_nonzero(labels[kept] == label)
+            print('{0:>8}: {1:>6} of {2:>6} kept ({3:.1%})'.format(name, left, total, left / float(total)))
+    print('{0:>8}: {1:>6} of {2:>6} kept ({3:.1%})'.format('all', len(kept), len(labels),
+                                                          len(kept) / float(max(len(labels), 1))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Near-duplicate removal of the training crops')
+    parser.add_argument('folder', help='training images in red, yellow and green subfolders')
+    parser.add_argument('--distance', type=int, default=MAX_DISTANCE,
+                        help='bits two hashes of near-duplicates differ in at most')
+    parser.add_argument('--train', action='store_true',
+                        help='compare the training with and without deduplication')
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tensorflow as tf
+    from tlclassifier import loadCustomImages, trainCNN
+    images, labels = loadCustomImages(args.folder)
+    report(labels, deduplicate(images, labels, args.distance))
+    if args.train:
+        results = []
+        for distance in (None, args.distance):
+            with tf.Graph().as_default():
+                results.append(trainCNN(images, labels, max_distance=distance))
+        for name, result in zip(('all crops', 'deduplicated'), results):
+            print('{0:>14}: test accuracy {1:.4f}, {2} epochs in {3:.0f}s'.format(
+                name, result['test_accuracy'], result['epochs'], result['seconds']))
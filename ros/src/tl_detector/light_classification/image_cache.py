@@ -0,0 +1,125 @@
+'''
+Cache of the training images of tlclassifier.py, scaled to the 32x32px rgb
+the CNN expects.
+
+The images are decoded and scaled in a pool of processes once and stored as
+uint8 arrays (images.npy N x 32 x 32 x 3, labels.npy N) in the cache folder,
+next to manifest.json, which maps the path of every image to its mtime and
+row. Later runs memory-map the arrays and decode only new or modified files.
+
+    cache = ImageCache('./training/.image_cache')
+    images, labels = cache.load([(path, label), ...])
+
+    images, labels = load_folder('./training')    # red, yellow and green subfolders
+'''
+
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+IMAGE_SHAPE = (32, 32, 3)
+MANIFEST = 'manifest.json'
+IMAGES = 'images.npy'
+LABELS = 'labels.npy'
+
+
+def decode_image(path):
+    '''Reads an image scaled to 32x32px rgb (alpha removed) as uint8 array'''
+    # same scaling as resizeImage of tlclassifier.py
+    import scipy.misc
+    return np.asarray(scipy.misc.imresize(scipy.misc.imread(path), IMAGE_SHAPE[:2])[:, :, :3], dtype=np.uint8)
+
+
+def load_folder(folder, cache_dir=None):
+    '''Returns images and labels of the training images in red, yellow and green subfolders
+
+    The label is given by the path (0=red, 1=yellow, 2=green), the cache is
+    cache_dir (default <folder>/.image_cache). TensorFlow free, unlike
+    loadCustomImages of tlclassifier.py which calls it.
+    '''
+    cache_dir = cache_dir or os.path.join(folder, '.image_cache')
+    files = []
+    for subdir, dirs, names in os.walk(folder):
+        if os.path.abspath(subdir).startswith(os.path.abspath(cache_dir)):
+            continue
+        for name in names:
+            if name.endswith(('.png', '.jpg', '.jpeg')):
+                path = os.path.join(subdir, name)
+                for label, color in enumerate(('red', 'yellow', 'green')):
+                    if -1 != path.find(color):
+                        files.append((path, label))
+                        break
+    return ImageCache(cache_dir).load(files)
+
+
+class ImageCache(object):
+    def __init__(self, folder):
+        self.folder = folder
+        # path -> [mtime, row]
+        self.manifest = {}
+        self.images = np.zeros((0,) + IMAGE_SHAPE, dtype=np.uint8)
+        self.labels = np.zeros(0, dtype=np.int32)
+        if os.path.exists(os.path.join(folder, MANIFEST)):
+            with open(os.path.join(folder, MANIFEST)) as mfile:
+                self.manifest = json.load(mfile)
+            self.images = np.load(os.path.join(folder, IMAGES), mmap_mode='r+')
+            self.labels = np.load(os.path.join(folder, LABELS))
+
+    def load(self, files, processes=None):
+        '''Returns images (N x 32 x 32 x 3 uint8) and labels of (path, label) pairs
+
+        Files which are not cached yet or were modified since are decoded in
+        processes (default: one per cpu) and added to the cache.
+        '''
+        files = [(os.path.abspath(path), label) for path, label in files]
+        mtimes = dict((path, os.path.getmtime(path)) for path, label in files)
+        stale = [(path, label) for path, label in files
+                 if path not in self.manifest or self.manifest[path][0] != mtimes[path]]
+        if stale:
+            pool = multiprocessing.Pool(processes)
+            try:
+                decoded = pool.map(decode_image, [path for path, label in stale],
+                                   chunksize=max(1, len(stale) // (4 * (processes or multiprocessing.cpu_count()))))
+            finally:
+                pool.close()
+                pool.join()
+            self.store(stale, decoded, mtimes)
+        rows = np.array([self.manifest[path][1] for path, label in files], dtype=np.int64)
+        if np.array_equal(rows, np.arange(len(self.labels))):
+            # all cached images in order - no copy of the memory map
+            return self.images, self.labels
+        return self.images[rows], self.labels[rows]
+
+    def store(self, files, decoded, mtimes):
+        new = [(path, label) for path, label in files if path not in self.manifest]
+        if new:
+            # grow the arrays - the cached rows are copied, not decoded again
+            if not os.path.isdir(self.folder):
+                os.makedirs(self.folder)
+            count = len(self.labels)
+            images = np.lib.format.open_memmap(os.path.join(self.folder, IMAGES + '.tmp'), mode='w+',
+                                               dtype=np.uint8, shape=(count + len(new),) + IMAGE_SHAPE)
+            images[:count] = self.images
+            labels = np.zeros(count + len(new), dtype=np.int32)
+            labels[:count] = self.labels
+            for row, (path, label) in enumerate(new, count):
+                self.manifest[path] = [None, row]
+            images.flush()
+            del images
+            self.images = None
+            os.rename(os.path.join(self.folder, IMAGES + '.tmp'), os.path.join(self.folder, IMAGES))
+            self.images = np.load(os.path.join(self.folder, IMAGES), mmap_mode='r+')
+            self.labels = labels
+        for (path, label), image in zip(files, decoded):
+            row = self.manifest[path][1]
+            self.images[row] = image
+            self.labels[row] = label
+            self.manifest[path][0] = mtimes[path]
+        self.images.flush()
+        np.save(os.path.join(self.folder, LABELS), self.labels)
+        # the manifest is written last - an interrupted run decodes its files again
+        with open(os.path.join(self.folder, MANIFEST + '.tmp'), 'w') as mfile:
+            json.dump(self.manifest, mfile)
+        os.rename(os.path.join(self.folder, MANIFEST + '.tmp'), os.path.join(self.folder, MANIFEST))
@@ -0,0 +1,92 @@
+'''
+Reads the labelled traffic light crops tl_detector dumps in debug mode: a
+directory (or a zip file of it, like traffic_light_images/training_data.zip)
+with 32x32px images traffic_light_cropped<index>.png and light_state.csv,
+which lists index and TrafficLight state of every crop.
+
+The crops are returned in rgb order, as the classifier gets them at runtime.
+'''
+
+import os
+import random
+import zipfile
+
+import cv2
+import numpy as np
+
+STATE_FILE = 'light_state.csv'
+# TrafficLight states RED, YELLOW and GREEN are also the labels of the classifier
+LABELS = (0, 1, 2)
+
+
+class CropSource(object):
+    '''Lists and reads the files of a crop directory or zip file'''
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else None
+        self.path = path
+        if self.zip is not None:
+            self.files = dict((os.path.basename(name), name) for name in self.zip.namelist())
+        else:
+            self.files = dict((name, os.path.join(path, name)) for name in os.listdir(path))
+
+    def read(self, name):
+        if self.zip is not None:
+            return self.zip.read(self.files[name])
+        with open(self.files[name], 'rb') as cfile:
+            return cfile.read()
+
+
+def read_states(source):
+    '''Returns (index, state) of all crops listed in light_state.csv'''
+    entries = []
+    for line in source.read(STATE_FILE).decode('ascii').splitlines():
+        fields = line.split(',')
+        # skip the header line
+        if len(fields) == 2 and fields[0].strip().isdigit():
+            entries.append((int(fields[0]), int(fields[1])))
+    return entries
+
+
+def crop_name(source, index):
+    # the debug dump of tl_detector appends a second .png
+    for name in ('traffic_light_cropped{0}.png'.format(index), 'traffic_light_cropped{0}.png.png'.format(index)):
+        if name in source.files:
+            return name
+    return None
+
+
+def decode_crop(data):
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    if image.shape[:2] != (32, 32):
+        image = cv2.resize(image, (32, 32))
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def load_labelled_crops(path, count=None, seed=0):
+    '''Loads the labelled crops of a directory or zip file
+
+    Args:
+        path: crop directory or zip file
+        count: number of randomly chosen crops to load (None loads all)
+        seed: seed of the random choice, the same seed gives the same crops
+
+    Returns:
+        (images, labels): N x 32 x 32 x 3 uint8 array and N labels (0=red, 1=yellow, 2=green)
+
+    '''
+    source = CropSource(path)
+    entries = [(index, state) for index, state in read_states(source)
+               if state in LABELS and crop_name(source, index) is not None]
+    if count is not None and count < len(entries):
+        entries = random.Random(seed).sample(entries, count)
+    images = []
+    labels = []
+    for index, state in entries:
+        image = decode_crop(source.read(crop_name(source, index)))
+        if image is not None:
+            images.append(image)
+            labels.append(state)
+    return np.array(images, dtype=np.uint8).reshape(-1, 32, 32, 3), np.array(labels, dtype=np.int32)
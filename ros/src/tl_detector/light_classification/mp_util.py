@@ -0,0 +1,26 @@
+'''
+Process context of the pools whose workers run TensorFlow (classifier_pool.py,
+sweep.py and evaluate_detector.py).
+
+TensorFlow is not fork-safe: a forked child inherits the threads' locks of a
+parent which has initialized TensorFlow in whatever state they were and may
+hang. Python 3 starts the workers as fresh interpreters (spawn). Python 2 -
+the ROS Kinetic target - can only fork, so there the parent must not import
+TensorFlow before it creates the pool; the pools import it in the workers
+only (see resize.py).
+
+    pool = get_context().Pool(workers, init_worker, args)
+'''
+
+import multiprocessing
+import sys
+import warnings
+
+
+def get_context():
+    '''Returns the multiprocessing context for workers running TensorFlow (spawn, fork on python 2)'''
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn')
+    if 'tensorflow' in sys.modules:
+        warnings.warn('TensorFlow is imported before the worker processes are forked - they may hang')
+    return multiprocessing
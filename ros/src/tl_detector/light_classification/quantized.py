@@ -0,0 +1,186 @@
+'''
+Int8 post-training quantization of the LeNet traffic light classifier.
+
+The weights of a checkpoint (see Lenet in tlclassifier.py) are quantized
+symmetrically per output channel: w ~ scale[c] * q[c] with q in [-127, 127].
+The activations are quantized per image before every conv and fc layer, the
+biases stay float32. The quantized model is stored next to the checkpoint
+(<checkpoint>.int8.npz) and runs in NumPy - TensorFlow is only needed once
+for the conversion.
+
+The weights stay int8 in memory, a quarter of the float32 checkpoint. The
+products are accumulated in int32 (exact, 1075 inputs of fc1 * 127 * 127 are
+far from an overflow) and scaled back to float32 per layer. NumPy's integer
+matmul doesn't use BLAS, so the int8 model is smaller, not faster: a crop
+takes several times as long as with the float32 model in TensorFlow - see
+the latency printed below. That is why tl_detector doesn't classify with it;
+the module is an offline report of what int8 weights cost in accuracy (and
+is used by sweep.py and evaluate_detector.py --classifier int8).
+
+Convert and compare with the float model on the labelled crops:
+
+    python quantized.py [checkpoint] [crops (directory or zip, see labelled_crops.py)]
+'''
+
+import os
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+LAYERS = (('conv1_W', 'conv1_B'), ('conv2_W', 'conv2_B'), ('fc1_W', 'fc1_b'),
+          ('fc2_W', 'fc2_b'), ('fc3_W', 'fc3_b'), ('fc4_W', 'fc4_b'))
+SUFFIX = '.int8.npz'
+
+
+def read_checkpoint(graph_path):
+    '''Returns the float32 weights and biases of the LeNet checkpoint by name'''
+    import tensorflow as tf
+    reader = tf.train.NewCheckpointReader(graph_path)
+    return dict((name, reader.get_tensor(name)) for layer in LAYERS for name in layer)
+
+
+def quantize(weights):
+    '''Quantizes weights per output channel (last axis) to int8, returns (q, scale)'''
+    flat = weights.reshape(-1, weights.shape[-1])
+    scale = np.abs(flat).max(axis=0) / 127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def convert(graph_path, path=None):
+    '''Quantizes a checkpoint and stores it as npz (default <checkpoint>.int8.npz)'''
+    path = path or graph_path + SUFFIX
+    arrays = {}
+    for name, value in read_checkpoint(graph_path).items():
+        if name.endswith('_W'):
+            arrays[name], arrays[name + '_scale'] = quantize(value)
+        else:
+            arrays[name] = value.astype(np.float32)
+    np.savez(path, **arrays)
+    return path
+
+
+def quantize_activations(x):
+    '''Quantizes every image of a batch (first axis) with its own scale, returns (q as int32, scale)'''
+    axes = tuple(range(1, x.ndim))
+    scale = np.abs(x).max(axis=axes, keepdims=True) / 127.
+    scale[scale == 0] = 1.
+    return np.clip(np.round(x / scale), -127, 127).astype(np.int32), scale.astype(np.float32)
+
+
+def windows(x, size):
+    '''im2col of a NHWC batch: N x H' x W' x (size * size * C) for a VALID convolution'''
+    n, h, w, c = x.shape
+    x = np.ascontiguousarray(x)
+    s = x.strides
+    patches = as_strided(x, (n, h - size + 1, w - size + 1, size, size, c), (s[0], s[1], s[2], s[1], s[2], s[3]))
+    return patches.reshape(n, h - size + 1, w - size + 1, size * size * c)
+
+
+def max_pool(x):
+    n, h, w, c = x.shape
+    return x.reshape(n, h // 2, 2, w // 2, 2, c).max(axis=(2, 4))
+
+
+class QuantizedLenet(object):
+    '''Int8 inference of the LeNet of tlclassifier.py (dropout is inactive at inference)'''
+
+    def __init__(self, arrays):
+        self.layers = []
+        for weight, bias in LAYERS:
+            q = arrays[weight]
+            self.layers.append((q.reshape(-1, q.shape[-1]), arrays[weight + '_scale'], arrays[bias], q.shape))
+        # resident size of the model: int8 weights, float32 scales and biases
+        self.nbytes = sum(array.nbytes for layer in self.layers for array in layer[:3])
+
+    def layer(self, x, index):
+        # x: N x ... x K float32, the result of the K x M int8 layer in float32
+        q, w_scale, bias, shape = self.layers[index]
+        xq, x_scale = quantize_activations(x)
+        # int32 accumulation of the int8 products
+        return np.dot(xq, q).astype(np.float32) * (x_scale * w_scale) + bias
+
+    def logits(self, images):
+        x = np.asarray(images, dtype=np.float32)
+        for index in (0, 1):
+            size = self.layers[index][3][0]
+            x = max_pool(np.maximum(self.layer(windows(x, size), index), 0.))
+        x = x.reshape(len(x), -1)
+        for index in (2, 3, 4):
+            x = np.maximum(self.layer(x, index), 0.)
+        return self.layer(x, 5)
+
+
+class QuantizedClassifier(object):
+    '''TrafficLightClassifier interface on top of the int8 model (converts the checkpoint on first use)'''
+
+    def __init__(self, filepath):
+        self.path = os.path.abspath(filepath)
+        # (re)convert if the checkpoint is newer than its int8 model
+        if (not os.path.exists(self.path + SUFFIX) or
+            os.path.getmtime(self.path + SUFFIX) < os.path.getmtime(self.path + '.index')):
+            convert(self.path)
+        with np.load(self.path + SUFFIX) as arrays:
+            self.model = QuantizedLenet(dict((name, arrays[name]) for name in arrays.files))
+
+    def classifyImage(self, img):
+        from resize import resizeImage
+        return self.classifyImages([resizeImage(img)])[0]
+
+    def classifyImages(self, images):
+        return np.argmax(self.model.logits(images), axis=1)
+
+    def classifyImagesProbabilities(self, images):
+        logits = self.model.logits(images)
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def warmUp(self):
+        self.classifyImages(np.zeros((1, 32, 32, 3), dtype=np.float32))
+
+    def close(self):
+        pass
+
+
+def time_per_crop(classify, images, batch):
+    start = time.time()
+    for offset in range(0, len(images), batch):
+        classify(images[offset:offset + batch])
+    return (time.time() - start) / len(images)
+
+
+def report(graph_path, crops_path):
+    '''Prints accuracy, agreement, latency and size of the float and the int8 model'''
+    from labelled_crops import load_labelled_crops
+    from tlclassifier import TrafficLightClassifier
+    images, labels = load_labelled_crops(crops_path)
+    float_model = TrafficLightClassifier(graph_path)
+    float_model.warmUp()
+    int8_path = convert(graph_path)
+    int8_model = QuantizedClassifier(graph_path)
+    int8_model.warmUp()
+    float_bytes = sum(value.nbytes for value in read_checkpoint(graph_path).values())
+
+    print('{0} labelled crops of {1}'.format(len(labels), crops_path))
+    print('{0:>8} {1:>12} {2:>10} {3:>16} {4:>16}'.format('model', 'weights [kB]', 'accuracy',
+                                                           'batch 1 [ms]', 'batch 64 [ms]'))
+    predictions = {}
+    for name, model, nbytes in (('float32', float_model, float_bytes),
+                                ('int8', int8_model, int8_model.model.nbytes)):
+        predictions[name] = np.concatenate([model.classifyImages(images[offset:offset + 256])
+                                            for offset in range(0, len(images), 256)])
+        print('{0:>8} {1:>12.1f} {2:>10.4f} {3:>16.3f} {4:>16.3f}'.format(
+            name, nbytes / 1024., np.mean(predictions[name] == labels),
+            1000. * time_per_crop(model.classifyImages, images[:200], 1),
+            1000. * time_per_crop(model.classifyImages, images, 64)))
+    print('int8 agrees with float32 on {0:.4f} of the crops, stored in {1}'.format(
+        np.mean(predictions['int8'] == predictions['float32']), int8_path))
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    report(sys.argv[1] if len(sys.argv) > 1 else os.path.join(here, 'tensor/linux_tensor0.999'),
+           sys.argv[2] if len(sys.argv) > 2 else os.path.join(here, '../traffic_light_images/training_data.zip'))
@@ -0,0 +1,14 @@
+'''
+Scaling of traffic light crops to the 32x32px rgb input of the LeNet of
+tlclassifier.py - without TensorFlow, so that processes which only prepare
+crops (tl_detector with a classifier pool, the int8 classifier of
+quantized.py) don't have to load it.
+'''
+
+import scipy.misc
+
+
+#Used for Classification
+#Scales an image to the 32x32px the CNN expects and removes the alpha channel
+def resizeImage(img):
+    return scipy.misc.imresize(img, (32,32))[:,:,:3]
@@ -0,0 +1,105 @@
+'''
+Temporal filter of the traffic light states: a hidden Markov model per light
+which fuses the class probabilities of every classified camera frame with
+the cycle of the lights (green -> yellow -> red -> green) and the time
+between the frames.
+
+Between two frames the belief of a light is propagated with the transition
+probabilities of a continuous-time Markov chain - a light leaves its state
+after a mean duration, and only in the direction of the cycle. Every other
+change (e.g. red -> yellow) is possible at a small rate only, so a single
+misclassified frame cannot flip a confident belief, while an expected change
+is accepted after one or two frames. A state is reported as soon as its
+posterior crosses the threshold.
+
+    light_filter = LightStateFilter()
+    label = light_filter.update(light_idx, probabilities, stamp)   # 0=red, 1=yellow, 2=green, None
+'''
+
+import numpy as np
+
+# labels of the states are the TrafficLight states RED, YELLOW and GREEN
+RED, YELLOW, GREEN = 0, 1, 2
+# state a light changes to after RED, YELLOW and GREEN
+NEXT_STATE = (GREEN, RED, YELLOW)
+# mean time [s] a light stays RED, YELLOW and GREEN
+MEAN_DURATIONS = (10., 3., 10.)
+# rate [1/s] of changes against the cycle (misassociated lights, restarts)
+JUMP_RATE = 0.01
+# weight of the classifier probabilities in the observation likelihood,
+# the rest is uniform - a softmax is overconfident on unusual crops
+TRUST = 0.9
+# posterior a state needs to be reported
+THRESHOLD = 0.9
+# beliefs of lights not seen for longer [s] are forgotten
+MAX_AGE = 60.
+
+
+def generator(durations=MEAN_DURATIONS, jump_rate=JUMP_RATE):
+    '''Returns the 3 x 3 rate matrix of the light cycle (rows sum up to zero)'''
+    rates = np.full((3, 3), jump_rate)
+    for state, duration in enumerate(durations):
+        rates[state, NEXT_STATE[state]] = 1. / duration
+        rates[state, state] = 0.
+        rates[state, state] = -rates[state].sum()
+    return rates
+
+
+class LightStateFilter(object):
+    def __init__(self, durations=MEAN_DURATIONS, jump_rate=JUMP_RATE, trust=TRUST, threshold=THRESHOLD):
+        # transition matrix for any time step: expm(rates * dt) by eigendecomposition
+        values, vectors = np.linalg.eig(generator(durations, jump_rate))
+        self.eigenvalues = values
+        self.eigenvectors = vectors
+        self.inverse_eigenvectors = np.linalg.inv(vectors)
+        self.trust = trust
+        self.threshold = threshold
+        # light -> [belief, stamp of the last update, reported label]
+        self.lights = {}
+
+    def transition(self, dt):
+        '''Returns the matrix of the probabilities to go from state (row) to state (column) in dt seconds'''
+        matrix = np.real(self.eigenvectors.dot(np.diag(np.exp(self.eigenvalues * dt)))
+                         .dot(self.inverse_eigenvectors))
+        matrix = np.maximum(matrix, 0.)
+        return matrix / matrix.sum(axis=1, keepdims=True)
+
+    def update(self, light, probabilities, stamp):
+        '''Fuses the classification of a frame into the belief of a light
+
+        Args:
+            light: key of the light (e.g. its index)
+            probabilities: probabilities of red, yellow and green from the classifier
+            stamp (float): time of the frame [s]
+
+        Returns:
+            int: the label whose posterior crossed the threshold last (None if none did yet)
+
+        '''
+        self.forget(stamp)
+        entry = self.lights.get(light)
+        if entry is None:
+            entry = self.lights[light] = [np.full(3, 1. / 3.), stamp, None]
+        belief, last_stamp = entry[0], entry[1]
+        # frames may arrive out of order, they are fused without prediction then
+        dt = stamp - last_stamp
+        if dt > 0.:
+            belief = belief.dot(self.transition(dt))
+            entry[1] = stamp
+        likelihood = self.trust * np.asarray(probabilities, dtype=np.float64) + (1. - self.trust) / 3.
+        belief = belief * likelihood
+        belief /= belief.sum()
+        entry[0] = belief
+        label = int(np.argmax(belief))
+        if belief[label] >= self.threshold:
+            entry[2] = label
+        return entry[2]
+
+    def posterior(self, light):
+        '''Returns the belief of a light (None if it was never updated)'''
+        entry = self.lights.get(light)
+        return None if entry is None else entry[0]
+
+    def forget(self, stamp):
+        for light in [light for light, entry in self.lights.items() if stamp - entry[1] > MAX_AGE]:
+            del self.lights[light]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+'''
+Hyperparameter sweep of the traffic light CNN (trainCNN of tlclassifier.py).
+
+Trials of learning rate, epochs, batch size, keep probability of the dropout
+and widths of the LeNet layers (conv1, conv2, fc1, fc2, fc3) are drawn at
+random from SPACE (or all combinations of it with --grid) and trained in a
+pool of processes. Each process limits TensorFlow to --threads threads, so
+the trials don't fight for the cpus. Per trial the test accuracy, training
+time, number of weights and the inference latency (one crop and a batch of
+crops with the float model, one crop with the int8 model of quantized.py)
+are appended to results.csv in the output folder, next to the checkpoints
+of the trials. At the end the trials reaching --min-accuracy are listed
+smallest model first.
+
+    python sweep.py [--trials N | --grid] [--workers N] [--threads N] [--min-accuracy 0.97]
+                    [--output ./sweep] folder
+'''
+
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from mp_util import get_context
+
+# the first value of each setting is the one of the shipped graph
+SPACE = (('rate', (0.0005, 0.0002, 0.001, 0.002)),
+         ('epochs', (30, 15)),
+         ('batchsize', (128, 64, 256)),
+         ('keep_probability', (0.6, 0.5, 0.8)),
+         ('widths', ((32, 43, 84, 42, 21), (16, 32, 64, 32, 16), (16, 24, 42, 21, 12),
+                     (8, 16, 32, 16, 8), (6, 12, 24, 12, 6))))
+RESULTS = ('test_accuracy', 'validation_accuracy', 'epochs_run', 'seconds', 'parameters',
+           'latency_ms', 'batch_latency_ms', 'int8_latency_ms')
+# crops of a batch for batch_latency_ms (a few lights per frame)
+LATENCY_BATCH = 8
+LATENCY_RUNS = 50
+
+# set up per worker process by init_worker
+worker = {}
+
+
+def draw_trials(grid=False, count=20, seed=0):
+    '''Returns the settings (dicts) of the trials - all combinations or count random ones'''
+    names = [name for name, values in SPACE]
+    combinations = list(itertools.product(*[values for name, values in SPACE]))
+    if not grid:
+        combinations = random.Random(seed).sample(combinations, min(count, len(combinations)))
+    return [dict(zip(names, values)) for values in combinations]
+
+
+def init_worker(folder, output, threads):
+    import tensorflow as tf
+    from tlclassifier import loadCustomImages
+    worker['output'] = output
+    # the parent filled the cache, nothing is decoded here
+    worker['images'], worker['labels'] = loadCustomImages(folder)
+    worker['config'] = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+
+
+def latency(classify, images):
+    '''Median milliseconds of classifying images'''
+    classify(images)
+    times = []
+    for i in range(LATENCY_RUNS):
+        start = time.time()
+        classify(images)
+        times.append(time.time() - start)
+    return 1000. * np.median(times)
+
+
+def run_trial(trial):
+    '''Trains and times a trial (index, settings), returns (index, settings, results)'''
+    import tensorflow as tf
+    from quantized import QuantizedClassifier
+    from tlclassifier import TrafficLightClassifier, trainCNN
+    index, settings = trial
+    folder = os.path.join(worker['output'], 'trial{0}'.format(index))
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with tf.Graph().as_default():
+        trained = trainCNN(worker['images'], worker['labels'], tensor_folder=folder,
+                           config=worker['config'], **settings)
+    crops = np.asarray(worker['images'][:LATENCY_BATCH], dtype=np.float32)
+    classifier = TrafficLightClassifier(trained['checkpoint'], settings['widths'], worker['config'])
+    results = {'test_accuracy': float(trained['test_accuracy']),
+               'validation_accuracy': float(trained['validation_accuracy']),
+               'epochs_run': trained['epochs'], 'seconds': trained['seconds'],
+               'parameters': trained['parameters'],
+               'latency_ms': latency(classifier.classifyImages, crops[:1]),
+               'batch_latency_ms': latency(classifier.classifyImages, crops)}
+    classifier.close()
+    results['int8_latency_ms'] = latency(QuantizedClassifier(trained['checkpoint']).classifyImages, crops[:1])
+    return index, settings, results
+
+
+def format_value(value):
+    if isinstance(value, tuple):
+        return '/'.join(str(v) for v in value)
+    if isinstance(value, float):
+        return '{0:.6g}'.format(value)
+    return str(value)
+
+
+def sweep(folder, output, trials, workers=None, threads=None, min_accuracy=0.97):
+    # not tlclassifier - the parent doesn't import TensorFlow (see mp_util.py)
+    from image_cache import load_folder
+    workers = workers or multiprocessing.cpu_count()
+    threads = threads or max(1, multiprocessing.cpu_count() // workers)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    # decode the images once before the workers read the cache
+    load_folder(folder)
+    names = [name for name, values in SPACE]
+    print('{0} trials, {1} workers with {2} threads each'.format(len(trials), workers, threads))
+
+    rows = []
+    pool = get_context().Pool(workers, init_worker, (folder, output, threads))
+    try:
+        with open(os.path.join(output, 'results.csv'), 'w') as rfile:
+            rfile.write(','.join(('trial',) + tuple(names) + RESULTS) + '\n')
+            for index, settings, results in pool.imap_unordered(run_trial, enumerate(trials)):
+                row = [index] + [settings[name] for name in names] + [results[name] for name in RESULTS]
+                rows.append(row)
+                rfile.write(','.join(format_value(value) for value in row) + '\n')
+                rfile.flush()
+                print('trial {0} ({1}/{2}): accuracy {3:.4f}, {4:.0f}s, {5} weights, {6:.2f}ms'.format(
+                    index, len(rows), len(trials), results['test_accuracy'], results['seconds'],
+                    results['parameters'], results['latency_ms']))
+    finally:
+        pool.close()
+        pool.join()
+
+    # smallest, then fastest model of the ones reaching the accuracy
+    columns = ['trial'] + names + list(RESULTS)
+    good = [row for row in rows if row[columns.index('test_accuracy')] >= min_accuracy]
+    good.sort(key=lambda row: (row[columns.index('parameters')], row[columns.index('latency_ms')]))
+    print('{0} of {1} trials reach a test accuracy of {2}'.format(len(good), len(rows), min_accuracy))
+    print(' '.join('{0:>16}'.format(name) for name in columns))
+    for row in good:
+        print(' '.join('{0:>16}'.format(format_value(value)) for value in row))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of the traffic light CNN')
+    parser.add_argument('folder', help='training images in red, yellow and green subfolders')
+    parser.add_argument('--output', default='./sweep', help='folder of results.csv and the checkpoints')
+    parser.add_argument('--grid', action='store_true', help='train all combinations of the settings')
+    parser.add_argument('--trials', type=int, default=20, help='random trials (without --grid)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='processes (default: number of cpus)')
+    parser.add_argument('--threads', type=int, help='TensorFlow threads per process (default: cpus / workers)')
+    parser.add_argument('--min-accuracy', type=float, default=0.97)
+    args = parser.parse_args()
+    sweep(args.folder, args.output, draw_trials(args.grid, args.trials, args.seed),
+          args.workers, args.threads, args.min_accuracy)
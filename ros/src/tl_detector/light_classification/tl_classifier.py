@@ -1,11 +1,149 @@
+import os
+import threading
+import time
+
+import numpy as np
 from styx_msgs.msg import TrafficLight
-from tlclassifier import TrafficLightClassifier
+
+GRAPH_PATH = './light_classification/tensor/linux_tensor0.999'
+VALIDATION_PATH = './traffic_light_images/training_data.zip'
+
+# TrafficLight states of the labels of TrafficLightClassifier
+LIGHTS = (TrafficLight.RED, TrafficLight.YELLOW, TrafficLight.GREEN)
+
+# every n-th crop the color heuristic is confident about is also classified
+# by the CNN, to keep track of their agreement
+CASCADE_AUDIT_RATE = 20
 
 class TLClassifier(object):
-    def __init__(self):
-        #TODO load classifier
-        self.classifier = self.classifier = TrafficLightClassifier('./light_classification/tensor/linux_tensor0.999')
-        pass
+    def __init__(self, workers=0, on_ready=None, graph_path=GRAPH_PATH,
+                 validation_path=VALIDATION_PATH, validation_size=64, min_accuracy=0.9, cascade=False):
+        """Starts loading the classifier in the background
+
+        Args:
+            workers (int): number of worker processes to classify in (see classifier_pool.py),
+                           0 classifies in the calling thread
+            on_ready (callable): called with this classifier once loading is done
+                                 (ready is False if loading failed, see error)
+            graph_path (str): checkpoint of the LeNet model
+            validation_path (str): labelled crops (see labelled_crops.py) a new checkpoint
+                                   has to classify before it is swapped in
+            validation_size (int): number of crops used for the validation
+            min_accuracy (float): accuracy a new checkpoint needs on the validation crops
+            cascade (bool): classify with the color heuristic first and escalate only the crops
+                            it is not confident about to the CNN (see color_heuristic.py)
+
+        """
+        self.classifier = None
+        self.pool = None
+        self.workers = workers
+        self.on_ready = on_ready
+        self.graph_path = graph_path
+        self.validation_path = validation_path
+        self.validation_size = validation_size
+        self.min_accuracy = min_accuracy
+        self.cascade = cascade
+        self.cascade_stats = {'crops': 0, 'escalated': 0, 'audited': 0, 'agreed': 0}
+        self.validation = None
+        # held while classifying - a swap waits for running classifications
+        self.lock = threading.Lock()
+        self.swap_lock = threading.Lock()
+        # lights are UNKNOWN until the model is loaded and warmed up
+        self.ready = False
+        self.load_time = None
+        self.error = None
+        self.loader = threading.Thread(target=self.load)
+        self.loader.daemon = True
+        self.loader.start()
+
+    def load(self):
+        start = time.time()
+        try:
+            self.classifier, self.pool = self.create(self.graph_path)
+            self.ready = True
+        except Exception as e:
+            self.error = e
+        self.load_time = time.time() - start
+        if self.on_ready is not None:
+            self.on_ready(self)
+
+    def create(self, graph_path):
+        """Loads and warms up a checkpoint in-process or in a worker pool
+
+        Returns:
+            (TrafficLightClassifier, ClassifierPool): one of them is None
+
+        """
+        # TensorFlow gets imported here, off the startup path of the node
+        if self.workers > 0:
+            from classifier_pool import ClassifierPool
+            pool = ClassifierPool(self.workers, graph_path)
+            pool.ready.wait()
+            if pool.error is not None:
+                pool.close()
+                raise RuntimeError(pool.error)
+            return None, pool
+        from tlclassifier import TrafficLightClassifier
+        classifier = TrafficLightClassifier(graph_path)
+        classifier.warmUp()
+        return classifier, None
+
+    def swap(self, graph_path):
+        """Loads another checkpoint next to the current one, validates it and swaps it in
+
+        Classification goes on with the current checkpoint while the new one
+        loads; the current one is closed after the swap.
+
+        Returns:
+            (bool, str): success and a description of the outcome
+
+        """
+        if not self.ready:
+            return False, 'the classifier is still loading'
+        with self.swap_lock:
+            start = time.time()
+            try:
+                classifier, pool = self.create(graph_path)
+            except Exception as e:
+                return False, 'failed to load {0}: {1}'.format(graph_path, e)
+            accuracy = self.validate(classifier, pool)
+            if accuracy is not None and accuracy < self.min_accuracy:
+                self.close(classifier, pool)
+                return False, 'rejected {0} with accuracy {1:.3f} on {2} validation crops'\
+                              .format(graph_path, accuracy, len(self.validation[1]))
+            with self.lock:
+                old_classifier, old_pool = self.classifier, self.pool
+                self.classifier, self.pool = classifier, pool
+                self.graph_path = graph_path
+            # no classification uses the old checkpoint anymore
+            self.close(old_classifier, old_pool)
+            if accuracy is None:
+                return True, 'swapped in {0} after {1:.1f}s without validation crops'\
+                             .format(graph_path, time.time() - start)
+            return True, 'swapped in {0} after {1:.1f}s with accuracy {2:.3f}'\
+                         .format(graph_path, time.time() - start, accuracy)
+
+    def validate(self, classifier, pool):
+        """Returns the accuracy on the validation crops (None if there are none)"""
+        if self.validation is None:
+            if not os.path.exists(self.validation_path):
+                return None
+            from labelled_crops import load_labelled_crops
+            self.validation = load_labelled_crops(self.validation_path, self.validation_size)
+        images, labels = self.validation
+        if 0 == len(labels):
+            return None
+        if pool is not None:
+            predicted = pool.classify_batch(images)
+        else:
+            predicted = classifier.classifyImages(images)
+        return float(np.mean(np.asarray(predicted) == labels))
+
+    def close(self, classifier, pool):
+        if classifier is not None:
+            classifier.close()
+        if pool is not None:
+            pool.close()
 
     def get_classification(self, image):
         """Determines the color of the traffic light in the image
@@ -17,12 +155,104 @@ class TLClassifier(object):
             int: ID of traffic light color (specified in styx_msgs/TrafficLight)
 
         """
-        if self.classifier is None:
-          #path = os.path.abspath('./tensor/linux_tensor0.999')
-          #rospy.logwarn("Tensor_path {0}".format(path))
-          self.classifier = TrafficLightClassifier('./light_classification/tensor/linux_tensor0.999')
-        
-        lights = (TrafficLight.RED, TrafficLight.YELLOW, TrafficLight.GREEN)
-        return lights[self.classifier.classifyImage(image)]
-        #TODO implement light color prediction
-        return TrafficLight.UNKNOWN
+        if not self.ready:
+            return TrafficLight.UNKNOWN
+        if self.cascade:
+            return self.classify_cascade([image])[0]
+        with self.lock:
+            if self.pool is not None:
+                # no label if the pool failed
+                label = self.pool.classify(image)
+                return TrafficLight.UNKNOWN if label is None else LIGHTS[label]
+            return LIGHTS[self.classifier.classifyImage(image)]
+
+    def get_classifications(self, images):
+        """Determines the color of the traffic lights in several images (in parallel with workers)
+
+        Args:
+            images (list of cv::Mat): images containing one traffic light each
+
+        Returns:
+            list of int: ID of traffic light color per image (specified in styx_msgs/TrafficLight)
+
+        """
+        if not self.ready:
+            return [TrafficLight.UNKNOWN for image in images]
+        if self.cascade:
+            return self.classify_cascade(images)
+        with self.lock:
+            if self.pool is not None:
+                return [TrafficLight.UNKNOWN if label is None else LIGHTS[label]
+                        for label in self.pool.classify_batch(images)]
+            return [LIGHTS[self.classifier.classifyImage(image)] for image in images]
+
+    def get_classification_probabilities(self, image):
+        """Determines the probabilities of the colors of the traffic light in the image
+
+        Args:
+            image (cv::Mat): image containing the traffic light
+
+        Returns:
+            numpy.array: probabilities of red, yellow and green (the order of LIGHTS),
+                         None while the classifier is not ready
+
+        """
+        probabilities = self.get_classifications_probabilities([image])
+        return None if probabilities is None else probabilities[0]
+
+    def get_classifications_probabilities(self, images):
+        """Determines the probabilities of the colors of the traffic lights in several images as one batch
+
+        Returns:
+            numpy.array: N x 3 probabilities of red, yellow and green (the order of LIGHTS),
+                         None while the classifier is not ready or if the pool failed
+
+        """
+        if not self.ready:
+            return None
+        if self.cascade:
+            return self.cascade_probabilities(images)
+        with self.lock:
+            if self.pool is not None:
+                return self.pool.classify_probabilities_batch(images)
+            from resize import resizeImage
+            return self.classifier.classifyImagesProbabilities([resizeImage(image) for image in images])
+
+    def classify_cascade(self, images):
+        """Classifies with the color heuristic and escalates the uncertain crops to the CNN"""
+        return [LIGHTS[label] for label in np.argmax(self.cascade_probabilities(images), axis=1)]
+
+    def cascade_probabilities(self, images):
+        """Probabilities (N x 3) of the color heuristic, of the CNN for the uncertain crops
+
+        The confidence of the heuristic is the probability of its label, the
+        rest is split between the other two colors.
+        """
+        from color_heuristic import classify, MIN_CONFIDENCE
+        from resize import resizeImage
+        crops = np.array([resizeImage(image) for image in images])
+        labels, confidences = classify(crops)
+        probabilities = np.tile(((1. - confidences) / 2.)[:, np.newaxis], (1, 3))
+        probabilities[np.arange(len(crops)), labels] = confidences
+        stats = self.cascade_stats
+        cnn = []
+        for i in range(len(crops)):
+            stats['crops'] += 1
+            if confidences[i] < MIN_CONFIDENCE:
+                stats['escalated'] += 1
+                cnn.append(i)
+            elif stats['crops'] % CASCADE_AUDIT_RATE == 0:
+                stats['audited'] += 1
+                cnn.append(i)
+        if cnn:
+            with self.lock:
+                if self.pool is not None:
+                    cnn_probabilities = self.pool.classify_probabilities_batch(crops[cnn])
+                else:
+                    cnn_probabilities = self.classifier.classifyImagesProbabilities(crops[cnn])
+            # the heuristic decides if the pool failed
+            for i, row in zip(cnn, [] if cnn_probabilities is None else cnn_probabilities):
+                if confidences[i] >= MIN_CONFIDENCE:
+                    stats['agreed'] += int(np.argmax(row) == labels[i])
+                probabilities[i] = row
+        return probabilities
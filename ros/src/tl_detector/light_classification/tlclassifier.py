@@ -5,7 +5,6 @@ Created on 24.02.2018
 github: www.github/mitschen/CarND-Capstone/ros/src/tl_detector/light_classification
 '''
 
-import random
 ############################################################################
 #NOTE: not available in the Udacity environment of CarND-Capstone
 ############################################################################
@@ -13,8 +12,10 @@ import random
 import numpy as np
 import tensorflow as tf
 import os
-import scipy.ndimage  
+import time
 import scipy.misc
+#Used for Classification, TensorFlow free (see resize.py)
+from resize import resizeImage
 
 
 default_graph_path = './tensor/linux_tensor0.999'
@@ -22,19 +23,22 @@ default_graph_path = './tensor/linux_tensor0.999'
 #Used for Training & Classification
 #Reusing the LeNet architecture from the TrafficSignClassifier with
 #some small adaptation. I've added an additional FC 
-def Lenet(features, keep_prob):
+#The widths (conv1, conv2, fc1, fc2, fc3) can be changed to try smaller
+#models (see sweep.py) - a checkpoint only fits the widths it was trained with
+LENET_WIDTHS = (32, 43, 84, 42, 21)
+def Lenet(features, keep_prob, widths=LENET_WIDTHS):
     mu = 0.
     sigma = 0.1
+    conv1Cnt, conv2Cnt, fc1Cnt, fc2Cnt, fc3Cnt = widths
     
-    
-    conv1W       = tf.Variable(tf.truncated_normal(shape=(5,5,3,32), mean = mu, stddev = sigma), name='conv1_W')
-    conv1B       = tf.Variable(tf.zeros(32), name = 'conv1_B')
+    conv1W       = tf.Variable(tf.truncated_normal(shape=(5,5,3,conv1Cnt), mean = mu, stddev = sigma), name='conv1_W')
+    conv1B       = tf.Variable(tf.zeros(conv1Cnt), name = 'conv1_B')
     conv1        = tf.nn.conv2d(features, conv1W, (1,1,1,1), padding='VALID') + conv1B
     conv1        = tf.nn.relu(conv1)
     conv1        = tf.nn.max_pool(conv1, ksize=(1,2,2,1), strides=(1,2,2,1), padding='VALID')
     
-    conv2W       = tf.Variable(tf.truncated_normal(shape=(5,5,32,43), mean = mu, stddev = sigma), name='conv2_W')
-    conv2B       = tf.Variable(tf.zeros(43), name = 'conv2_B')
+    conv2W       = tf.Variable(tf.truncated_normal(shape=(5,5,conv1Cnt,conv2Cnt), mean = mu, stddev = sigma), name='conv2_W')
+    conv2B       = tf.Variable(tf.zeros(conv2Cnt), name = 'conv2_B')
     conv2        = tf.nn.conv2d(conv1, conv2W, (1,1,1,1), padding='VALID') + conv2B
     conv2        = tf.nn.relu(conv2)
     conv2        = tf.nn.max_pool(conv2, ksize=(1,2,2,1), strides=(1,2,2,1), padding='VALID')
@@ -42,7 +46,6 @@ def Lenet(features, keep_prob):
     fc0 = tf.contrib.layers.flatten(conv2)
     noOut = int(fc0.get_shape()[1])
     #84
-    fc1Cnt = 84
     fc1W = tf.Variable(tf.truncated_normal(shape=(noOut, fc1Cnt), mean = mu, stddev = sigma), name='fc1_W')
     fc1B = tf.Variable(tf.zeros(fc1Cnt), name='fc1_b')
     
@@ -51,7 +54,6 @@ def Lenet(features, keep_prob):
     fc1 = tf.nn.dropout(fc1, keep_prob)
     
     #42
-    fc2Cnt = 42
     fc2W = tf.Variable(tf.truncated_normal(shape=(fc1Cnt, fc2Cnt), mean = mu, stddev = sigma), name='fc2_W')
     fc2B = tf.Variable(tf.zeros(fc2Cnt), name='fc2_b')
     
@@ -59,7 +61,7 @@ def Lenet(features, keep_prob):
     fc2    = tf.nn.relu(fc2)
     fc2    = tf.nn.dropout(fc2, keep_prob)
     
-    fc3Cnt = 21
+    #21
     fc3W = tf.Variable(tf.truncated_normal(shape=(fc2Cnt, fc3Cnt), mean = mu, stddev = sigma), name='fc3_W')
     fc3B = tf.Variable(tf.zeros(fc3Cnt), name='fc3_b')
 
@@ -86,43 +88,32 @@ def Lenet(features, keep_prob):
 
 
 #Used for Training
-#Expects a folderpath. The function will iterate through all subfolders and 
-#searching for image files.
-#As a result it returns a list of lists containing
+#Expects a folderpath. The function will iterate through all subfolders and
+#searching for image files. The label is given by the path (red, yellow or green).
+#The images are decoded and scaled to 32x32px in parallel processes once and
+#cached in cache_dir (default <filepath>/.image_cache, see image_cache.py),
+#later calls only decode new or modified files.
+#Returns the images as N x 32 x 32 x 3 uint8 array and the labels (0=red, ..., 2=green)
+def loadCustomImages(filepath, cache_dir=None):
+    from image_cache import load_folder
+    return load_folder(filepath, cache_dir)
+
+#Used for Training
+#Same as loadCustomImages but returns a list of lists containing
 #[ RED-Img, YELLOW-Img, GREEN-Img ]
 #Img contains the image element as well as the label (0=red, ..., 2=green)
 #All images getting scaled to 32x32px and the alpha is removed from the image
 #Returns a list of dataarrays of image elements
 def importCustomImages(filepath):
     resultingImages = [ ]
-    data = [ [], [], [] ]
-    redCnt = 0
-    yelCnt = 0
-    greCnt = 0
-    for subdir, dir, files in os.walk(filepath):
-        for file in files :
-            if file.endswith((".png", ".jpg", ".jpeg")):
-                fqp = os.path.join(subdir, file)
-                if -1 != fqp.find("red"):
-                    data[0].append((fqp, 0))
-                    redCnt += 1
-                elif -1 != fqp.find("yellow"):
-                    data[1].append( (fqp, 1) )
-                    yelCnt += 1
-                elif -1 != fqp.find("green"):
-                    data[2].append( (fqp, 2) )
-                    greCnt +=1
-    
+    images, labels = loadCustomImages(filepath)
+    colorVal = [ "red", "yellow", "green"]
     for i in range(3):
-        if 0!=len(data[i]):
-          newImages = []
-          for file in data[i]:
-            #resize to 32/32 px and remove alphachannel if availble as well
-            newImages.append( (np.array(scipy.misc.imresize(scipy.misc.imread(file[0]), (32,32))[:,:,:3], dtype=np.float32)
-                                        , file[1]) )
+        selected = np.flatnonzero(labels == i)
+        if 0!=len(selected):
+          newImages = [(np.array(images[j], dtype=np.float32), i) for j in selected]
           resultingImages.append(newImages)
-          colorVal = [ "red", "yellow", "green"]
-          print("Total of {0} samples for {1}".format(len(newImages), colorVal[newImages[0][1]] ))
+          print("Total of {0} samples for {1}".format(len(newImages), colorVal[i]))
     return resultingImages
 
 #Used for Training 
@@ -140,51 +131,6 @@ def normalizeZeroMeanData(dataarray):
         data[0] /= 128.
     return dataarray
 
-#Used for Training
-#Expects list of dataarrays of image elements - makes sure that all labels are
-#given with same numbers. Therefore this function randomly chooses an
-#element e.g. yellow and appends it  
-def dataNormalizeCnts(val):
-    val.sort(key = lambda x : len(x), reverse=True)
-    fillUpTo = len(val[0])
-    for i in range (1, len(val)):
-        while len(val[i]) < fillUpTo:
-            val[i].append(random.choice(val[i]))
-    return val
-
-#Used for Training
-#Expects a dataarray of image elements and applies some augmentation on these images.
-#In details - each image is appended with
-# flipped l-r-
-# rotated +/-15 degree
-# rotated +/-90 degree
-# shifted 2,2 px to lower, right/ upper left
-# This function will result in 14 times more pictures
-def dataAugmentation(dataarray):
-    resultingData = []
-    #each image is now
-    #turned for 15 degreed to the right and to the left
-    #shifted by 2 px to the bottom right / top left
-    #for each of this images, the x axis is turned
-    for data in dataarray:
-        img = data[0]
-        label = data[1]
-        resultingData.append(data)
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-        resultingData.append( (scipy.ndimage.interpolation.rotate(img, 15., reshape=False, mode='nearest'), label))
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-        resultingData.append( (scipy.ndimage.interpolation.rotate(img, 90., reshape=False, mode='nearest'), label))
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-        resultingData.append( (scipy.ndimage.interpolation.shift(img,  (2., 2., 0.), mode='nearest'), label) )
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-        resultingData.append( (scipy.ndimage.interpolation.rotate(img, -15., reshape=False, mode='nearest'), label))
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-        resultingData.append( (scipy.ndimage.interpolation.rotate(img, -90., reshape=False, mode='nearest'), label))
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-        resultingData.append( (scipy.ndimage.interpolation.shift(img,  (-2., -2., 0.), mode='nearest'), label) )
-        resultingData.append( (np.fliplr(resultingData[-1][0]), label) )
-    return resultingData
-
 #For Verification only
 #Uses the LeNet architecture in combination with a given tensor-graph (flepath) 
 #and verifies the matching rate on a dataarray of image elements.
@@ -217,131 +163,227 @@ def loadCNNAndVerify(filepath, val):
     print("Total accuracy of {0} samples is {1:.3f}".format(num_examples, total_accuracy / num_examples))
         
         
+#Used for Training
+#Expects the labels of a dataset and splits its indices per label into
+#training (52%), validation (12%) and test (36%) indices, so each of them
+#holds every color in the same proportion. The images are assigned randomly
+#(seed) - but never an augmented copy of a test image to the training.
+def splitData(labels, seed=0):
+    randomState = np.random.RandomState(seed)
+    training, validation, test = [], [], []
+    for label in np.unique(labels):
+        selected = randomState.permutation(np.flatnonzero(labels == label))
+        noTraining = int(len(selected) * 0.52)
+        noValidation = int(len(selected) * 0.12)
+        training.extend(selected[:noTraining])
+        validation.extend(selected[noTraining:noTraining+noValidation])
+        test.extend(selected[noTraining+noValidation:])
+    return np.array(training, dtype=np.int64), np.array(validation, dtype=np.int64), np.array(test, dtype=np.int64)
+
+#Used for Training
+#Yields the batches of one epoch of a training set (float32 images, labels)
+#in a new random order (permutation of randomState). The batches are copied
+#into the same preallocated arrays - each one is valid until the next is taken.
+def shuffledBatches(training_x, training_y, batchsize, randomState):
+    batch_x = np.empty((batchsize,) + training_x.shape[1:], dtype=np.float32)
+    batch_y = np.empty(batchsize, dtype=training_y.dtype)
+    order = randomState.permutation(len(training_y))
+    for start in range(0, len(order), batchsize):
+        indices = order[start:start+batchsize]
+        np.take(training_x, indices, axis=0, out=batch_x[:len(indices)])
+        np.take(training_y, indices, out=batch_y[:len(indices)])
+        yield batch_x[:len(indices)], batch_y[:len(indices)]
+
+#Used for Training
+#Runs an accuracy operation batchwise over a (float32) dataset and returns
+#the accuracy of all of it - the batches are views, nothing is copied
+def evaluateAccuracy(sess, accuracy, feed, data_x, data_y, batchsize):
+    input_layer, inputY, keep_prob = feed
+    total_accuracy = 0.
+    for offset in range(0, len(data_y), batchsize):
+        batch_x, batch_y = data_x[offset:offset+batchsize], data_y[offset:offset+batchsize]
+        total_accuracy += len(batch_y) * sess.run(accuracy, feed_dict={
+            input_layer: batch_x,
+            inputY: batch_y,
+            keep_prob: 1.})
+    return total_accuracy / max(len(data_y), 1)
+
 #For Training only
 #This is the main-function which trains the CNN (LeNet)
-#As input it expects a dataaray of image elements. From this array
-#it will chose a subset of training/ validation and test-data
+#As input it expects the images and labels of loadCustomImages. From these
+#it will chose a subset of training/ validation and test-data (see splitData).
+#With augmented, the training batches are drawn and augmented on the fly in
+#background threads (see augmentation.py) - each batch holds the same number of
+#red, yellow and green images, and an epoch sees as many images as the 14 times
+#augmented training set would hold with every color oversampled to the count
+#of the most frequent one. Without, each epoch runs over the training images
+#in a new order.
+#The weights of the epoch with the best validation accuracy are kept in
+#./tensor/best - after patience epochs without improvement the training stops
+#and the test accuracy is calculated for the best weights.
 #If the training results in an accuracy of about 90%, the function writes
-#the tensor-graph (& weights) to the ./tensor folder.
-def trainCNN(data):
-    rate = 0.0005
-    epochs = 30
-    batchsize = 128
-    keep_probability = 0.6
+#the tensor-graph (& weights) to the ./tensor folder (tensor_folder).
+#The hyperparameters and the widths of the LeNet can be given (see sweep.py),
+#the defaults are the ones of the shipped graph. config is the ConfigProto of
+#the session, e.g. to limit its threads.
+#With max_distance, near-duplicates (see deduplication.py) are removed from the
+#training split - the validation and test data keep all images.
+#Returns a dict of the test and best validation accuracy, the epochs run, the
+#training time in seconds, the number of weights and the best checkpoint
+def trainCNN(images, labels, augmented=True, patience=5, rate=0.0005, epochs=30, batchsize=128,
+             keep_probability=0.6, widths=LENET_WIDTHS, tensor_folder='./tensor', config=None,
+             max_distance=None):
+    from augmentation import AUGMENTATIONS, BatchGenerator
     
     input_layer  = tf.placeholder(tf.float32, (None, 32, 32, 3))
     inputY = tf.placeholder(tf.int32, (None))
-    labels = tf.one_hot(inputY, 3)
+    onehot = tf.one_hot(inputY, 3)
     keep_prob = tf.placeholder(tf.float32)
     
-    logits = Lenet(input_layer, keep_prob)
+    logits = Lenet(input_layer, keep_prob, widths)
+    parameters = sum(int(np.prod(v.get_shape().as_list())) for v in tf.trainable_variables())
     
-    cost = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=labels))
+    cost = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=logits, labels=onehot))
     optimizer = tf.train.AdamOptimizer(learning_rate=rate).minimize(cost)
     
     # Accuracy
-    correct_pred = tf.equal(tf.argmax(logits, 1), tf.argmax(labels, 1))
+    correct_pred = tf.equal(tf.argmax(logits, 1), tf.argmax(onehot, 1))
     accuracy = tf.reduce_mean(tf.cast(correct_pred, tf.float32))
+    feed = (input_layer, inputY, keep_prob)
     
     # Initializing the variables
     init = tf. global_variables_initializer()
-    ############################################################################
-    #NOTE: not available in the Udacity environment of CarND-Capstone
-    ############################################################################
-    #in_samples, in_labels = sklearn.utils.shuffle(np.array(data)[...,0],np.array(data)[...,1])
-    #Instead do not shuffle
-    in_samples, in_labels = np.array(data)[...,0],np.array(data)[...,1]
-    
-    noTraining = int(len(in_samples) * 0.52)
-    noValidation = int(len(in_samples) * 0.12)
-    noTest = int(len(in_samples) * 0.36)
+    saver = tf.train.Saver()
+    best_path = os.path.join(tensor_folder, 'best')
 
     #Split the samples into training/verification and test
     #Please note: i've trained always from the scratch - so it didn't
     #             really hurt to chose the test-data always again
-    training_x = in_samples[:noTraining].tolist()
-    training_y = in_labels[:noTraining].tolist()
-    validation_x = in_samples[noTraining:noTraining+noValidation].tolist()
-    validation_y = in_labels[noTraining:noTraining+noValidation].tolist()
-    test_x = in_samples[noTraining+noValidation:].tolist()
-    test_y = in_labels[noTraining+noValidation:].tolist()
+    #All sets are contiguous arrays of the dtype of the placeholders, so
+    #feeding them doesn't convert anything
+    labels = np.asarray(labels, dtype=np.int32)
+    training, validation, test = splitData(labels)
+    if max_distance is not None:
+        from deduplication import deduplicate
+        kept = training[deduplicate(images[training], labels[training], max_distance)]
+        print("Deduplicated training data: {0} of {1} images kept".format(len(kept), len(training)))
+        training = kept
+    validation_x = np.ascontiguousarray(images[validation], dtype=np.float32)
+    validation_y = labels[validation]
+    test_x = np.ascontiguousarray(images[test], dtype=np.float32)
+    test_y = labels[test]
+    training_y = labels[training]
     
-    print("Training {0} Validation {1} Test {2} - {3}".format(noTraining, noValidation, noTest, len(data)), str(type(training_x)))
-    print(training_x[0].shape)
+    if augmented:
+        counts = np.bincount(training_y)
+        counts = counts[counts > 0]
+        steps = int(np.ceil(AUGMENTATIONS * len(counts) * counts.max() / float(batchsize)))
+        #the batches are prepared ahead while the optimizer runs
+        generator = BatchGenerator(images[training], training_y, batchsize)
+        epochBatches = lambda: generator.batches(steps)
+    else:
+        steps = int(np.ceil(len(training) / float(batchsize)))
+        training_x = np.ascontiguousarray(images[training], dtype=np.float32)
+        randomState = np.random.RandomState(0)
+        epochBatches = lambda: shuffledBatches(training_x, training_y, batchsize, randomState)
+    print("Training {0} Validation {1} Test {2} - {3}, {4} batches per epoch".format(
+        len(training), len(validation), len(test), len(labels), steps))
     
     # Launch the graph
-    with tf.Session() as sess:
+    with tf.Session(config=config) as sess:
         sess.run(init)
+        best_acc = -1.
+        best_epoch = 0
+        epochs_run = 0
+        start = time.time()
  
-        for epoch in range(epochs):
-            stopLoop = False
-            batchIdx = 0
-            #each epoch, shuffle the training data again
-            ############################################################################
-            #NOTE: not available in the Udacity environment of CarND-Capstone
-            ############################################################################
-#             training_x, training_y = sklearn.utils.shuffle(training_x, training_y)
-            while(not stopLoop):
-                start = batchIdx * batchsize
-                end = min((batchIdx+1) * batchsize, len(training_x))
-                batch_x = training_x[start: end]
-                batch_y = training_y[start:end]
-                stopLoop = end==len(training_x)
-                sess.run(optimizer, feed_dict={
-                    input_layer: batch_x,
-                    inputY: batch_y,
-                    keep_prob: keep_probability})
-     
-                batchIdx += 1
-            #do validation check after each epoch    
-            valid_acc = sess.run(accuracy, feed_dict={
-                input_layer: validation_x[:],
-                inputY: validation_y[:],
-                keep_prob : 1.})
-            print('Epoch {:>2}, Validation Accuracy: {:.6f}'.format(epoch+1, valid_acc))
+        try:
+            for epoch in range(epochs):
+                epochs_run = epoch + 1
+                epoch_start = time.time()
+                for batch_x, batch_y in epochBatches():
+                    sess.run(optimizer, feed_dict={
+                        input_layer: batch_x,
+                        inputY: batch_y,
+                        keep_prob: keep_probability})
+                #do validation check after each epoch    
+                valid_acc = evaluateAccuracy(sess, accuracy, feed, validation_x, validation_y, batchsize)
+                print('Epoch {:>2}, Validation Accuracy: {:.6f} ({:.1f}s)'.format(
+                    epoch+1, valid_acc, time.time() - epoch_start))
+                if valid_acc > best_acc:
+                    best_acc, best_epoch = valid_acc, epoch
+                    saver.save(sess, best_path)
+                elif epoch - best_epoch >= patience:
+                    print('No improvement since epoch {0}, stopping'.format(best_epoch+1))
+                    break
+        finally:
+            if augmented:
+                generator.close()
+        if 0 == epochs_run:
+            #without training the initial weights are the best ones
+            saver.save(sess, best_path)
+        seconds = time.time() - start
+        print('Training took {:.1f}s'.format(seconds))
      
-        # Calculate Test Accuracy
-        test_acc = sess.run(accuracy, feed_dict={
-            input_layer: test_x[:],
-            inputY: test_y[:],
-            keep_prob: 1.})
+        # Calculate Test Accuracy of the best epoch
+        saver.restore(sess, best_path)
+        test_acc = evaluateAccuracy(sess, accuracy, feed, test_x, test_y, batchsize)
         print('Testing Accuracy: {}'.format(test_acc))
         if(test_acc > 0.9):
-            tf.train.Saver().save(sess, './tensor/linux_tensor{:.3f}'.format(test_acc))
+            saver.save(sess, os.path.join(tensor_folder, 'linux_tensor{:.3f}'.format(test_acc)))
+    return {'test_accuracy': test_acc, 'validation_accuracy': best_acc, 'epochs': epochs_run,
+            'seconds': seconds, 'parameters': parameters, 'checkpoint': best_path}
     
     
 class TrafficLightClassifier(object):
-    def __init__(self, filepath = default_graph_path):
+    #widths must be the ones the graph was trained with (see Lenet), config
+    #is the ConfigProto of the session
+    def __init__(self, filepath = default_graph_path, widths = LENET_WIDTHS, config = None):
         self.path = os.path.abspath(filepath)
 #         print(filepath)
 #         print(tf.__version__)
-        self.session = None 
-        self.x = tf.placeholder(tf.float32, (None, 32, 32, 3))
-        self.rate = tf.constant(1.)
-        self.classifier = tf.argmax(Lenet(self.x, self.rate), 1)
-        self.session = tf.InteractiveSession()
-        tf.train.Saver().restore(self.session, self.path)
+        #own graph and session - several classifiers may exist side by side
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.x = tf.placeholder(tf.float32, (None, 32, 32, 3))
+            self.rate = tf.constant(1.)
+            logits = Lenet(self.x, self.rate, widths)
+            self.classifier = tf.argmax(logits, 1)
+            self.probabilities = tf.nn.softmax(logits)
+            self.session = tf.Session(graph=self.graph, config=config)
+            tf.train.Saver().restore(self.session, self.path)
                 
     def classifyImageFromPath(self, path):
         return self.classifyImage(scipy.misc.imread(path))
     
     def classifyImage(self, img):
-        ##resize
-        image = np.array(scipy.misc.imresize(img, (32,32))[:,:,:3], dtype=np.float32)
+        #our tensor expects an array
+        return self.classifyImages([resizeImage(img)])[0]
+
+    #Expects a batch of 32x32px rgb images (see resizeImage) and returns
+    #the label (0=red, ..., 2=green) of each of them
+    def classifyImages(self, images):
         ##normalize
         #As mentioned above (see normalizeZeroMeanData) don't do that
         #for traffic lights
 #         image -= 128.
 #         image = image.astype(np.float32) / 128.
+        images = np.asarray(images, dtype=np.float32)
+        return self.session.run(self.classifier, feed_dict={self.x:images})
 
-        #our tensor expects an array
-        image = [image]
+    #Same as classifyImages but returns the softmax probabilities of
+    #red, yellow and green (N x 3) instead of the labels
+    def classifyImagesProbabilities(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        return self.session.run(self.probabilities, feed_dict={self.x:images})
 
-        #start interactive session if not yet existing
-        if self.session is None:
-            self.session = tf.InteractiveSession()
-            tf.train.Saver().restore(self.session, self.path)
-        return self.session.run(self.classifier, feed_dict={self.x:image})[0]
+    #The first run of a session allocates its memory and is a lot slower than
+    #the following ones - do it on a dummy image before the first real one
+    def warmUp(self):
+        self.classifyImages(np.zeros((1, 32, 32, 3), dtype=np.float32))
+
+    def close(self):
+        self.session.close()
      
 # used for Training, Verification and testing    
 if __name__ == '__main__':
@@ -359,19 +401,13 @@ if __name__ == '__main__':
     tensor_sourcepath=default_graph_path#'../tensor/linux_tensor0.999'
     if train:
         #read tl-images and apply labels
-        val = importCustomImages(img_sourcefolder)
-        #adjust the number of element counts so that each
-        #traffic light occurs the same time
-        val = dataNormalizeCnts(val)
-        #concatenate all images from a list of lists to a list of images
-        val = np.concatenate(val)
+        images, labels = loadCustomImages(img_sourcefolder)
         #Don't do normalization!!!!
-        #val = normalizeZeroMeanData(val)
-        #Apply augmentation to the dataset
-        val = dataAugmentation(val)
-        if 0!=len(val):
+        #The augmentation and the equal count of each traffic light
+        #are applied on the fly per batch - see trainCNN
+        if 0!=len(labels):
           #start training
-          trainCNN(val)
+          trainCNN(images, labels)
         else:
           print("No data for training")
         exit(0)
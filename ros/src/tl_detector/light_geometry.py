@@ -0,0 +1,127 @@
+'''
+Projection of traffic light positions into the camera image of the vehicle.
+
+The camera looks along the heading of the vehicle, roll and pitch of the
+pose are ignored (they are unreliable in the bag files), so the rotation
+into the vehicle frame is a rotation by -yaw. All lights are projected in
+one pass:
+
+    camera = CameraModel(2646, 2647, 366, 614, 8000)
+    points, centers, boxes = camera.project(light_positions, vehicle_position, yaw)
+    visible = camera.visible(boxes, 800, 600)
+
+With a calibration (sensor_msgs/CameraInfo) the lights are projected into the
+rectified image. The undistortion maps of the complete image are computed
+once, but only the crops of the lights are remapped:
+
+    camera.calibrate(info.K, info.D, info.R, info.P, info.width, info.height)
+    crop = camera.undistort_crop(image, boxes[0])
+'''
+
+import cv2
+import numpy as np
+
+# smallest edge length [px] of a crop the classifier gets
+MIN_CROP_SIZE = 32
+
+
+class CameraModel(object):
+    def __init__(self, f_x, f_y, c_x, c_y, image_scale, camera_z=1.0):
+        """Pinhole camera with the intrinsics of the traffic light config
+
+        Args:
+            f_x, f_y: focal length [px]
+            c_x, c_y: focal center [px]
+            image_scale: edge length [px] of a light crop at 1m distance
+            camera_z: height [m] of the camera above the pose of the vehicle
+
+        """
+        self.f_x = float(f_x)
+        self.f_y = float(f_y)
+        self.c_x = float(c_x)
+        self.c_y = float(c_y)
+        self.image_scale = float(image_scale)
+        self.camera_z = camera_z
+        # undistortion maps (see calibrate), None for an ideal pinhole camera
+        self.map_x = None
+        self.map_y = None
+
+    @property
+    def calibrated(self):
+        return self.map_x is not None
+
+    def calibrate(self, K, D, R, P, width, height):
+        """Uses the calibration of a sensor_msgs/CameraInfo
+
+        The intrinsics are taken from the projection matrix P, i.e. lights are
+        projected into the rectified image, and the maps from rectified to raw
+        pixels are precomputed for crops of width x height px images.
+        """
+        K = np.array(K, dtype=np.float64).reshape(3, 3)
+        R = np.array(R, dtype=np.float64).reshape(3, 3)
+        P = np.array(P, dtype=np.float64).reshape(3, 4)
+        self.f_x, self.f_y = P[0, 0], P[1, 1]
+        self.c_x, self.c_y = P[0, 2], P[1, 2]
+        self.map_x, self.map_y = cv2.initUndistortRectifyMap(K, np.array(D, dtype=np.float64), R, P[:, :3],
+                                                             (int(width), int(height)), cv2.CV_32FC1)
+
+    def to_camera(self, positions, position, yaw):
+        """Returns the N x 3 camera coordinates (right, down, forward) of N x 3 world positions"""
+        d = np.asarray(positions, dtype=np.float64).reshape(-1, 3) - \
+            (position[0], position[1], position[2] + self.camera_z)
+        s_y = np.sin(yaw)
+        c_y = np.cos(yaw)
+        # forward and left axis of the vehicle
+        forward = c_y * d[:, 0] + s_y * d[:, 1]
+        left = -s_y * d[:, 0] + c_y * d[:, 1]
+        return np.stack((-left, -d[:, 2], forward), axis=1)
+
+    def project(self, positions, position, yaw):
+        """Projects N lights into the image
+
+        Args:
+            positions: N x 3 world positions of the lights
+            position: (x, y, z) world position of the vehicle
+            yaw: heading of the vehicle [rad]
+
+        Returns:
+            (points, centers, boxes): N x 3 camera coordinates, N x 2 image centers (x, y)
+                                      and N x 4 crops (x_from, y_from, x_to, y_to) in px,
+                                      lights behind the camera get empty crops
+
+        """
+        points = self.to_camera(positions, position, yaw)
+        centers, boxes = self.project_points(points)
+        return points, centers, boxes
+
+    def project_points(self, points):
+        """Projects N x 3 camera coordinates, returns N x 2 image centers and N x 4 crops (see project)"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        depth = points[:, 2]
+        ahead = depth > 0.
+        # lights behind the camera are projected from a point far ahead to keep the math finite
+        depth = np.where(ahead, depth, 1e9)
+        edge = np.where(ahead, np.round(self.image_scale / depth), 0).astype(np.int64)
+        centers = np.stack((np.round(self.f_x * (points[:, 0] / depth) + self.c_x),
+                            np.round(self.f_y * (points[:, 1] / depth) + self.c_y)), axis=1).astype(np.int64)
+        start = centers - (edge // 2)[:, np.newaxis]
+        boxes = np.concatenate((start, start + edge[:, np.newaxis]), axis=1)
+        return centers, boxes
+
+    def visible(self, boxes, image_width, image_height):
+        """Returns which crops are large enough and completely inside the image"""
+        boxes = np.asarray(boxes)
+        return ((boxes[:, 2] - boxes[:, 0] >= MIN_CROP_SIZE) &
+                (boxes[:, 0] >= 0) & (boxes[:, 2] < image_width) &
+                (boxes[:, 1] >= 0) & (boxes[:, 3] < image_height))
+
+    def undistort_crop(self, image, box):
+        """Returns the rectified crop (x_from, y_from, x_to, y_to) of a raw image
+
+        Without calibration the crop is cut out of the image as it is.
+        """
+        x_from, y_from, x_to, y_to = box
+        if self.map_x is None:
+            return image[y_from:y_to, x_from:x_to]
+        return cv2.remap(image, self.map_x[y_from:y_to, x_from:x_to], self.map_y[y_from:y_to, x_from:x_to],
+                         cv2.INTER_LINEAR)
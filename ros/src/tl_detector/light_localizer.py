@@ -0,0 +1,129 @@
+'''
+Search for traffic lights in a camera frame, for the site where the light
+poses of /vehicle/traffic_lights are missing or wrong.
+
+Only a horizontal band of the frame is searched (the lights are above the
+road, below the sky), at a reduced resolution. Lit lamps are the bright,
+saturated pixels of the red, yellow and green hue ranges. Their connected
+blobs of lamp size and roundish shape are the candidates. Sunlit housings or
+soil have the same colors, so a candidate also has to be a lot brighter than
+the two unlit lamps above and/or below it, which is checked by box sums of
+an integral image. Each remaining lamp is turned into a square region of the
+size of the whole light - a lamp is a third of its housing - and the best few
+regions are classified as one batch.
+
+    localizer = LightLocalizer(800, 600)
+    boxes = localizer.propose(rgb_image)    # N x 4 (x_from, y_from, x_to, y_to), best first
+'''
+
+import cv2
+import numpy as np
+
+# searched rows as fraction of the image height
+BAND = (0.1, 0.6)
+# the band is searched at 1 / DOWNSCALE resolution
+DOWNSCALE = 2
+# hue ranges (OpenCV hue 0..180) of red (wraps around 0), yellow and green lamps
+HUE_RANGES = (((0, 10), (160, 180)), ((15, 35),), ((40, 95),))
+MIN_VALUE = 200
+MIN_SATURATION = 90
+# lamp diameter [px of the full image]
+MIN_LAMP = 4
+MAX_LAMP = 60
+# share of the bounding box of a blob covered by it (a disc covers 0.79)
+MIN_FILL = 0.45
+# distance of the lamps of a light in lamp diameters
+LAMP_DISTANCE = 1.2
+# the unlit lamps of red (top lamp), yellow and green (bottom lamp) in lamp distances
+UNLIT_LAMPS = ((1, 2), (-1, 1), (-2, -1))
+# mean value of a lit lamp (its core is saturated) and by how much it
+# exceeds its unlit lamps at least
+MIN_LAMP_VALUE = 235.
+MIN_CONTRAST = 100.
+# edge of a light crop in lamp diameters
+CROP_SCALE = 3.4
+# regions classified per frame at most
+MAX_CANDIDATES = 4
+
+
+class LightLocalizer(object):
+    def __init__(self, image_width, image_height, band=BAND, downscale=DOWNSCALE,
+                 max_candidates=MAX_CANDIDATES):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.top = int(band[0] * image_height)
+        self.bottom = int(band[1] * image_height)
+        self.downscale = downscale
+        self.max_candidates = max_candidates
+
+    def lamp_masks(self, band):
+        '''Returns the lamp pixel mask of each color (red, yellow, green) of a downscaled rgb band'''
+        hsv = cv2.cvtColor(band, cv2.COLOR_RGB2HSV)
+        lit = cv2.inRange(hsv, (0, MIN_SATURATION, MIN_VALUE), (180, 255, 255))
+        masks = []
+        for ranges in HUE_RANGES:
+            mask = np.zeros(lit.shape, dtype=np.uint8)
+            for low, high in ranges:
+                mask |= cv2.inRange(hsv[:, :, 0], low, high - 1)
+            masks.append(mask & lit)
+        return masks
+
+    def box_mean(self, integral, x, y, radius):
+        '''Mean of the square of radius around (x, y) by the integral image, None if outside'''
+        x0, y0 = int(round(x - radius)), int(round(y - radius))
+        x1, y1 = int(round(x + radius)) + 1, int(round(y + radius)) + 1
+        if x0 < 0 or y0 < 0 or x1 >= integral.shape[1] or y1 >= integral.shape[0]:
+            return None
+        total = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+        return total / float((x1 - x0) * (y1 - y0))
+
+    def contrast(self, integral, color, x, y, diameter):
+        '''Returns how much brighter the lamp at (x, y) is than the unlit lamps of its light'''
+        radius = 0.35 * diameter
+        lamp = self.box_mean(integral, x, y, radius)
+        if lamp is None or lamp < MIN_LAMP_VALUE:
+            return 0.
+        contrast = lamp
+        for offset in UNLIT_LAMPS[color]:
+            unlit = self.box_mean(integral, x, y + offset * LAMP_DISTANCE * diameter, radius)
+            # an unlit lamp outside of the band does not count against the lamp
+            if unlit is not None:
+                contrast = min(contrast, lamp - unlit)
+        return contrast
+
+    def propose(self, image):
+        '''Proposes the regions of lit traffic lights in a rgb frame
+
+        Returns:
+            N x 4 int array of square crops (x_from, y_from, x_to, y_to) inside the image,
+            the lamps with the highest contrast first
+        '''
+        band = image[self.top:self.bottom]
+        small = cv2.resize(band, (band.shape[1] // self.downscale, band.shape[0] // self.downscale),
+                           interpolation=cv2.INTER_AREA)
+        integral = cv2.integral(cv2.cvtColor(small, cv2.COLOR_RGB2HSV)[:, :, 2])
+        candidates = []
+        for color, mask in enumerate(self.lamp_masks(small)):
+            count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            # label 0 is the background
+            for width, height, area, (x, y) in zip(stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT],
+                                                   stats[1:, cv2.CC_STAT_AREA], centroids[1:]):
+                diameter = max(width, height) * self.downscale
+                if (diameter < MIN_LAMP or diameter > MAX_LAMP or
+                        area < MIN_FILL * width * height or max(width, height) > 2 * min(width, height)):
+                    continue
+                contrast = self.contrast(integral, color, x, y, diameter / float(self.downscale))
+                if contrast < MIN_CONTRAST:
+                    continue
+                edge = int(round(CROP_SCALE * diameter))
+                x_center = x * self.downscale
+                # the crop is centered on the middle lamp
+                y_center = self.top + (y + sum(UNLIT_LAMPS[color]) / 3. * LAMP_DISTANCE *
+                                       diameter / float(self.downscale)) * self.downscale
+                x_from = int(round(x_center - edge / 2.))
+                y_from = int(round(y_center - edge / 2.))
+                candidates.append((contrast, x_from, y_from, x_from + edge, y_from + edge))
+        candidates.sort(reverse=True)
+        boxes = [box[1:] for box in candidates
+                 if box[1] >= 0 and box[2] >= 0 and box[3] <= self.image_width and box[4] <= self.image_height]
+        return np.array(boxes[:self.max_candidates], dtype=np.int64).reshape(-1, 4)
@@ -0,0 +1,86 @@
+'''
+History of the vehicle poses, to look up the pose at the time a camera
+frame was taken instead of the latest one.
+
+The poses are stored in a fixed-size ring of arrays. Every pose is written
+twice, at i and i + capacity, so the poses of the ring are always one
+contiguous, ordered slice and a lookup is a binary search on the stamps.
+Between two poses the position is interpolated linearly and the yaw along
+the shorter arc (the slerp of two rotations about the z axis).
+
+    history = PoseHistory()
+    history.append(stamp, x, y, z, yaw)
+    x, y, z, yaw = history.at(frame_stamp)
+'''
+
+import math
+
+import numpy as np
+
+# poses kept, about 5s of /current_pose at 50Hz
+CAPACITY = 256
+
+
+def wrap_angle(angle):
+    '''Maps angles to [-pi, pi)'''
+    return (angle + math.pi) % (2. * math.pi) - math.pi
+
+
+class PoseHistory(object):
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.stamps = np.zeros(2 * capacity)
+        # x, y, z, yaw
+        self.poses = np.zeros((2 * capacity, 4))
+        # the poses are self.poses[self.start:self.start + self.count]
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, stamp, x, y, z, yaw):
+        '''Adds a pose, poses older than the latest one are dropped
+
+        Returns:
+            bool: whether the pose was added
+        '''
+        if self.count and stamp <= self.stamps[self.start + self.count - 1]:
+            return False
+        if self.count < self.capacity:
+            index = self.start + self.count
+            self.count += 1
+        else:
+            # overwrite the oldest pose
+            index = self.start + self.capacity
+            self.start = (self.start + 1) % self.capacity
+        for i in (index % self.capacity, index % self.capacity + self.capacity):
+            self.stamps[i] = stamp
+            self.poses[i] = (x, y, z, yaw)
+        return True
+
+    def span(self):
+        '''Returns the stamps of the oldest and the latest pose (None if empty)'''
+        if not self.count:
+            return None
+        return self.stamps[self.start], self.stamps[self.start + self.count - 1]
+
+    def at(self, stamp):
+        '''Returns the pose (x, y, z, yaw) at a stamp (None if empty)
+
+        Stamps outside of the history get the oldest or the latest pose.
+        '''
+        if not self.count:
+            return None
+        stamps = self.stamps[self.start:self.start + self.count]
+        poses = self.poses[self.start:self.start + self.count]
+        i = int(np.searchsorted(stamps, stamp))
+        if i == 0:
+            return tuple(poses[0])
+        if i == self.count:
+            return tuple(poses[-1])
+        t = (stamp - stamps[i - 1]) / (stamps[i] - stamps[i - 1])
+        before, after = poses[i - 1], poses[i]
+        x, y, z = before[:3] + t * (after[:3] - before[:3])
+        yaw = wrap_angle(before[3] + t * wrap_angle(after[3] - before[3]))
+        return x, y, z, yaw
@@ -1,12 +1,21 @@
 #!/usr/bin/env python
 import rospy
-from std_msgs.msg import Int32
+from std_msgs.msg import Int32, Bool
 from geometry_msgs.msg import PoseStamped, Pose
 from styx_msgs.msg import TrafficLightArray, TrafficLight
-from styx_msgs.msg import Lane
-from sensor_msgs.msg import Image
+from styx_msgs.msg import Lane, WaypointWindow
+from styx_msgs.msg import FrameDescriptor
+from styx_msgs.lane_compact import LaneCompactNumpy, lane_positions
+from styx_msgs.frame_ring import FrameRing
+from sensor_msgs.msg import Image, CameraInfo
+from std_srvs.srv import Trigger, TriggerResponse
 from cv_bridge import CvBridge
-from light_classification.tl_classifier import TLClassifier
+from light_classification.tl_classifier import TLClassifier, GRAPH_PATH, LIGHTS
+from light_classification.state_filter import LightStateFilter, THRESHOLD
+from light_geometry import CameraModel
+from pose_history import PoseHistory
+from debug_writer import DebugWriter
+from light_localizer import LightLocalizer
 import tf
 import cv2
 import yaml
@@ -14,23 +23,51 @@ import math
 from tf.transformations import euler_from_quaternion
 import numpy as np
 import os
-import re
 
 STATE_COUNT_THRESHOLD = 3
+# seconds a filtered red light is held while no frame observes it
+HOLD_TIMEOUT = 3.
 IMAGE_DUMP_FOLDER = "./traffic_light_images/"
 
 class TLDetector(object):
-    def __init__(self):
-        rospy.init_node('tl_detector')
+    def __init__(self, bus=None):
+        # with a bus the node runs as component of composed_nodes.py
+        ros = rospy if bus is None else bus
+        if bus is None:
+            rospy.init_node('tl_detector')
 
         self.pose = None
+        # recent poses - a camera frame is projected with the pose at its stamp
+        self.pose_history = PoseHistory()
         self.waypoints = None
+        self.waypoint_segments = None
         self.cur_wp_idx = 0
+        # position of self.waypoints in the complete route (tiled mode)
+        self.waypoints_offset = 0
+        self.waypoints_total = None
         self.camera_image = None
+        # stamp [s] of self.camera_image (0 if the frame is not stamped)
+        self.camera_stamp = 0.
+        # camera frame mapped from the shared memory ring (/image_color_shm)
+        self.camera_frame = None
+        # (slot, sequence) of self.camera_frame in the ring
+        self.camera_frame_slot = None
+        # set if the frame was overwritten before its light crops were copied
+        self.camera_frame_torn = False
+        self.frame_ring = None
         self.lights = []
-
-        sub1 = rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
-        sub2 = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
+        self.light_positions = np.zeros((0, 3))
+
+        # composed, the positions of a waypoint message are computed once and shared
+        self.lane_positions = getattr(ros, 'waypoint_positions', lane_positions)
+        sub1 = ros.Subscriber('current_pose', PoseStamped, self.pose_cb)
+        # in tiled mode the loader only publishes a window of the route
+        if ros.get_param('waypoint_loader/tiled', False):
+            sub2 = ros.Subscriber('base_waypoints_window', WaypointWindow, self.waypoints_window_cb)
+        elif ros.get_param('compact_lanes', False):
+            sub2 = ros.Subscriber('base_waypoints_compact', LaneCompactNumpy, self.waypoints_compact_cb)
+        else:
+            sub2 = ros.Subscriber('base_waypoints', Lane, self.waypoints_cb)
 
         '''
         /vehicle/traffic_lights provides you with the location of the traffic light in 3D map space and
@@ -45,12 +82,35 @@ class TLDetector(object):
         self.last_state = TrafficLight.UNKNOWN
         self.last_wp = -1
         self.state_count = 0
+        # light visible in the last frame and its class probabilities (None if not classified)
+        self.light_idx = None
+        self.light_probabilities = None
+        # [light, waypoint, stamp of the last observation] of the last filtered red light
+        self.held_red = None
+        # with ~state_filter the light states are estimated by a HMM over the classified
+        # frames (see light_classification/state_filter.py) instead of the STATE_COUNT_THRESHOLD debouncing
+        self.state_filter = None
+        if ros.get_param('~state_filter', True):
+            self.state_filter = LightStateFilter(threshold=ros.get_param('~state_threshold', THRESHOLD))
         self.bridge = CvBridge()
-        self.light_classifier = TLClassifier()
+        # the classifier loads in the background - /tl_classifier_ready is latched once it is done
+        self.classifier_ready_pub = ros.Publisher('tl_classifier_ready', Bool, queue_size=1, latch=True)
+        self.classifier_ready_pub.publish(Bool(False))
+        # classify in ~classifier_workers processes (0 = in the callback thread)
+        self.light_classifier = TLClassifier(ros.get_param('~classifier_workers', 0), self.classifier_ready_cb,
+                                             ros.get_param('~classifier_path', GRAPH_PATH),
+                                             cascade=ros.get_param('~classifier_cascade', False))
+        # a new checkpoint is swapped in by ~reload_classifier (after setting ~classifier_path)
+        # or, with ~watch_classifier, as soon as the checkpoint at ~classifier_path changes
+        self.get_param = ros.get_param
+        self.reload_service = ros.Service('~reload_classifier', Trigger, self.reload_classifier_cb)
+        self.watched_checkpoint = self.get_checkpoint_version()
+        if ros.get_param('~watch_classifier', False):
+            ros.Timer(rospy.Duration(2.), self.watch_classifier_cb)
         self.listener = tf.TransformListener()
 
         # Load configuration
-        config_string = rospy.get_param("/traffic_light_config")
+        config_string = ros.get_param("traffic_light_config")
         self.config = yaml.load(config_string)
 
         # Initialization of a bunch of camera-related parameters
@@ -76,9 +136,19 @@ class TLDetector(object):
             self.camera_c_y = self.config['camera_info']['focal_center_y']
         else:
             self.camera_c_y = self.image_height / 2
-
-        #Do not set a value here - this will be identified automatically
-        self.next_image_idx = None
+        self.camera = CameraModel(self.camera_f_x, self.camera_f_y, self.camera_c_x, self.camera_c_y,
+                                  self.image_scale, self.camera_z)
+        # the calibration of the site camera (camera_info_publisher) replaces the intrinsics above
+        self.camera_info_ignored = False
+        sub7 = ros.Subscriber('camera_info', CameraInfo, self.camera_info_cb)
+        # with ~search_lights (site) the lights are searched in the frame instead of
+        # projected from /vehicle/traffic_lights, whose poses may be missing or wrong
+        self.light_localizer = None
+        if ros.get_param('~search_lights', False):
+            self.light_localizer = LightLocalizer(self.image_width, self.image_height)
+
+        #Do not set a value here - the index is kept by the debug writer
+        self.debug_writer = None
               
               
         self.internal_counter = 0#used to count for debugging purpose
@@ -88,20 +158,19 @@ class TLDetector(object):
         #         enable only if you know what you're doing 
         self.debugmode = False #set to true to store the misclassified images
         if self.debugmode:
-          self.next_image_idx = 0
-          for root, dirs, files in os.walk(IMAGE_DUMP_FOLDER):
-            for file in files:
-              if file.endswith(".png"):
-                num = int(re.search(r'\d+', os.path.join(root, file)).group(0))
-                self.next_image_idx = num if num > self.next_image_idx else self.next_image_idx
-          self.next_image_idx += 1
+          # images and csv rows are written in the background, off the camera callback
+          self.debug_writer = DebugWriter(IMAGE_DUMP_FOLDER)
       
-        sub3 = rospy.Subscriber('/vehicle/traffic_lights', TrafficLightArray, self.traffic_cb)
-        sub6 = rospy.Subscriber('/image_color', Image, self.image_cb)
+        sub3 = ros.Subscriber('vehicle/traffic_lights', TrafficLightArray, self.traffic_cb)
+        if ros.get_param('camera_shm', ''):
+            sub6 = ros.Subscriber('image_color_shm', FrameDescriptor, self.frame_cb)
+        else:
+            sub6 = ros.Subscriber('image_color', Image, self.image_cb)
 
-        self.upcoming_red_light_pub = rospy.Publisher('/traffic_waypoint', Int32, queue_size=1)
+        self.upcoming_red_light_pub = ros.Publisher('traffic_waypoint', Int32, queue_size=1)
 
-        rospy.spin()
+        if bus is None:
+            rospy.spin()
 
     # Callback to receive topic /current_pose
     # msg   a Pose with reference coordinate frame and timestamp
@@ -131,6 +200,9 @@ class TLDetector(object):
     def pose_cb(self, msg):
         # Store waypoint data for later usage
         self.pose = msg
+        (roll, pitch, yaw) = self.get_roll_pitch_yaw(msg.pose.orientation)
+        position = msg.pose.position
+        self.pose_history.append(msg.header.stamp.to_sec(), position.x, position.y, position.z, yaw)
 #         redundant information - disabled
 #         rospy.loginfo('TLDetector rec: pose data (%.2f, %.2f, %.2f)',
 #             msg.pose.position.x, msg.pose.position.y, msg.pose.position.z)
@@ -200,10 +272,43 @@ class TLDetector(object):
     #         float64 z
     def waypoints_cb(self, waypoints):
         # Store waypoint data for later usage
-        self.waypoints = waypoints
-        rospy.loginfo('TLDetector is initialized with %i reference waypoints', len(self.waypoints.waypoints))
+        self.set_waypoints(self.lane_positions(waypoints))
         pass
 
+    # Callback to receive topic /base_waypoints_compact
+    #       msg.header    Header
+    #       msg.x, msg.y, msg.z, msg.yaw, msg.v float32[]
+    def waypoints_compact_cb(self, msg):
+        self.set_waypoints(self.lane_positions(msg))
+
+    def set_waypoints(self, xyz):
+        """Stores the waypoint positions (N x 3 array) for later usage"""
+        # the positions are read-only (see lane_positions)
+        self.waypoints = xyz
+        # distance of each waypoint to its predecessor
+        self.waypoint_segments = np.sqrt(np.sum((xyz - np.roll(xyz, 1, axis=0)) ** 2, axis=1))
+        rospy.loginfo('TLDetector is initialized with %i reference waypoints', len(self.waypoints))
+
+    # Callback to receive topic /base_waypoints_window (tiled mode)
+    #       msg.header    Header
+    #       msg.offset    index of msg.waypoints[0] in the complete route
+    #       msg.total     number of waypoints of the complete route
+    #       msg.waypoints Waypoint[]
+    def waypoints_window_cb(self, msg):
+        cur_wp_global_idx = self.to_global_idx(self.cur_wp_idx)
+        self.waypoints_offset = msg.offset
+        self.waypoints_total = msg.total
+        self.waypoints_cb(msg)
+        self.cur_wp_idx = (cur_wp_global_idx - msg.offset) % msg.total
+        if self.cur_wp_idx >= len(msg.waypoints):
+            self.cur_wp_idx = 0
+
+    def to_global_idx(self, local_idx):
+        """Maps an index into self.waypoints to an index into the complete route"""
+        if local_idx == -1 or self.waypoints_total is None:
+            return local_idx
+        return (local_idx + self.waypoints_offset) % self.waypoints_total
+
     # Callback to receive the (x, y, z) positions of all traffic lights
     # TrafficLightArray
     #       msg.header  Header
@@ -234,6 +339,30 @@ class TLDetector(object):
     #         float64 w
     def traffic_cb(self, msg):
         self.lights = msg.lights
+        self.light_positions = np.array([(l.pose.pose.position.x, l.pose.pose.position.y, l.pose.pose.position.z)
+                                         for l in msg.lights]).reshape(-1, 3)
+
+    # Callback to receive the calibration of the camera (only the first one is used)
+    #   uint32   height
+    #   uint32   width
+    #   string   distortion_model
+    #   float64[] D   distortion coefficients
+    #   float64[9] K  intrinsic camera matrix of the raw image
+    #   float64[9] R  rectification matrix
+    #   float64[12] P projection matrix of the rectified image
+    def camera_info_cb(self, msg):
+        if self.camera.calibrated:
+            return
+        if (msg.width != self.image_width) or (msg.height != self.image_height):
+            if not self.camera_info_ignored:
+                rospy.logwarn('TLDetector ignores the camera calibration for %ix%i images, '
+                              'traffic_light_config expects %ix%i', msg.width, msg.height,
+                              self.image_width, self.image_height)
+                self.camera_info_ignored = True
+            return
+        self.camera.calibrate(msg.K, msg.D, msg.R, msg.P, msg.width, msg.height)
+        rospy.loginfo('TLDetector uses the camera calibration: f (%.1f, %.1f), c (%.1f, %.1f)',
+                      self.camera.f_x, self.camera.f_y, self.camera.c_x, self.camera.c_y)
 
     # Callback to receive the camera image from the vehicle
     #   std_msgs/Header header
@@ -253,14 +382,28 @@ class TLDetector(object):
         """
         self.has_image = True
         self.camera_image = msg
+        self.camera_stamp = msg.header.stamp.to_sec()
         #initialize the values
         ligth_wp = self.last_wp
         state = self.state
+        self.camera_frame_torn = False
         light_wp, state = self.process_traffic_lights()
+        if self.camera_frame_torn:
+            # the bridge wrapped the ring before the crops were copied - they may
+            # come from a torn or newer frame, the classifier didn't see them
+            rospy.logwarn('TLDetector drops camera frame %i - overwritten while processing',
+                          self.camera_frame_slot[1])
+            return
+        # /traffic_waypoint refers to the complete route
+        light_wp = self.to_global_idx(light_wp)
+
+        if self.state_filter is not None:
+            self.publish_filtered(light_wp, state)
+            return
 
         '''
         Publish upcoming red lights at camera frequency.
-        Each predicted state has to occur `STATE_COUNT_THRESHOLD` number
+        Without ~state_filter each predicted state has to occur `STATE_COUNT_THRESHOLD` number
         of times till we start using it. Otherwise the previous stable state is
         used.
         '''
@@ -276,6 +419,123 @@ class TLDetector(object):
             self.upcoming_red_light_pub.publish(Int32(self.last_wp))
         self.state_count += 1
 
+    def publish_filtered(self, light_wp, state):
+        """Publishes the upcoming red light as soon as the posterior of its state is certain enough
+
+        A light with a state but no probabilities (ground truth) is fused as a
+        certain classification. A frame which doesn't observe a light (none found,
+        occluded, classifier not ready) keeps the last filtered red light until
+        its posterior of red is below the threshold or it was not observed for
+        HOLD_TIMEOUT seconds - a missed frame must not cancel a stop.
+        """
+        # frame time of the camera, receive time if the frame is not stamped
+        stamp = self.camera_stamp or rospy.get_time()
+        probabilities = self.light_probabilities
+        if probabilities is None and state in LIGHTS:
+            probabilities = np.eye(3)[LIGHTS.index(state)]
+        if light_wp != -1 and self.light_idx is not None and probabilities is not None:
+            label = self.state_filter.update(self.light_idx, probabilities, stamp)
+            state = TrafficLight.UNKNOWN if label is None else LIGHTS[label]
+            self.held_red = [self.light_idx, light_wp, stamp] if state == TrafficLight.RED else None
+        elif self.held_red is not None:
+            light, held_wp, seen = self.held_red
+            posterior = self.state_filter.posterior(light)
+            if (posterior is not None and stamp - seen <= HOLD_TIMEOUT and
+                posterior[LIGHTS.index(TrafficLight.RED)] >= self.state_filter.threshold):
+                light_wp, state = held_wp, TrafficLight.RED
+            else:
+                self.held_red = None
+        self.state = state
+        self.last_state = state
+        self.last_wp = light_wp if state == TrafficLight.RED else -1
+        self.upcoming_red_light_pub.publish(Int32(self.last_wp))
+
+    # Called by the TLClassifier once its model is loaded (light states are UNKNOWN before)
+    def classifier_ready_cb(self, classifier):
+        if classifier.ready:
+            rospy.loginfo('TLDetector classifier is ready after %.1fs', classifier.load_time)
+        else:
+            rospy.logerr('TLDetector failed to load the classifier: %s', classifier.error)
+        self.classifier_ready_pub.publish(Bool(classifier.ready))
+
+    # Service ~reload_classifier (std_srvs/Trigger)
+    # swaps in the checkpoint at ~classifier_path if it passes the validation
+    def reload_classifier_cb(self, request):
+        graph_path = self.get_param('~classifier_path', GRAPH_PATH)
+        success, message = self.light_classifier.swap(graph_path)
+        if success:
+            rospy.loginfo('TLDetector classifier %s', message)
+        else:
+            rospy.logwarn('TLDetector classifier %s', message)
+        return TriggerResponse(success, message)
+
+    def log_cascade_stats(self):
+        stats = self.light_classifier.cascade_stats
+        if self.light_classifier.cascade and stats['crops'] > 0 and stats['crops'] % 100 == 0:
+            rospy.loginfo('TLDetector cascade: %i crops, %.1f%% escalated to the CNN, '
+                          'agreement with the CNN on %i audited crops %.1f%%',
+                          stats['crops'], 100. * stats['escalated'] / stats['crops'], stats['audited'],
+                          100. * stats['agreed'] / max(stats['audited'], 1))
+
+    def get_checkpoint_version(self):
+        graph_path = self.get_param('~classifier_path', GRAPH_PATH)
+        index = graph_path + '.index'
+        return graph_path, os.path.getmtime(index) if os.path.exists(index) else None
+
+    def watch_classifier_cb(self, event):
+        version = self.get_checkpoint_version()
+        if version != self.watched_checkpoint and version[1] is not None and self.light_classifier.ready:
+            self.watched_checkpoint = version
+            self.reload_classifier_cb(None)
+
+    # Callback to receive topic /image_color_shm
+    # (descriptor of a camera frame in the shared memory ring of the bridge)
+    #       msg.header    Header
+    #       msg.ring      path of the ring file
+    #       msg.slot      slot of the frame in the ring
+    #       msg.sequence  write sequence number of the frame
+    #       msg.height, msg.width, msg.encoding
+    def frame_cb(self, msg):
+        if self.frame_ring is None or self.frame_ring.path != msg.ring:
+            self.frame_ring = FrameRing(msg.ring)
+        # the frame is used in place, only the light crops are copied (see copy_crops)
+        self.camera_frame = self.frame_ring.read(msg.slot, msg.sequence)
+        if self.camera_frame is None:
+            rospy.logwarn('TLDetector skips camera frame %i - overwritten before processing', msg.sequence)
+            return
+        self.camera_frame_slot = (msg.slot, msg.sequence)
+        try:
+            self.image_cb(msg)
+        finally:
+            self.camera_frame = None
+            self.camera_frame_slot = None
+
+    def camera_frame_intact(self):
+        """Returns False if the current frame of the shared memory ring was overwritten since it was mapped"""
+        return self.camera_frame_slot is None or self.frame_ring.valid(*self.camera_frame_slot)
+
+    def copy_crops(self, crops):
+        """Copies crops out of the camera frame before they are classified
+
+        Only the crops have to be consistent - the frame may be overwritten in
+        the ring afterwards.
+
+        Returns:
+            list: the copies, None if the frame was overwritten already (camera_frame_torn is set)
+
+        """
+        crops = [np.array(crop) for crop in crops]
+        if not self.camera_frame_intact():
+            self.camera_frame_torn = True
+            return None
+        return crops
+
+    def get_camera_rgb(self):
+        """Returns the current camera image as rgb8 array (read-only with /image_color_shm)"""
+        if self.camera_frame is not None:
+            return self.camera_frame
+        return self.bridge.imgmsg_to_cv2(self.camera_image, "rgb8")
+
     def get_closest_waypoint_from_pose(self):
         """Identifies the closest path waypoint to the current car position
             https://en.wikipedia.org/wiki/Closest_pair_of_points_problem
@@ -285,37 +545,27 @@ class TLDetector(object):
 
         """
         waypoint_index = None
-        if (self.pose and self.waypoints):
+        if (self.pose and (self.waypoints is not None)):
             # Calculate cur_wp_idx
-            min_dist = 100000.
-            min_idx  = self.cur_wp_idx
-            start_idx = self.cur_wp_idx - 2
-            if (start_idx < 0):
-                start_idx = start_idx + len(self.waypoints.waypoints)
-            for i in range(start_idx, start_idx + len(self.waypoints.waypoints)):
-                idx = i % len(self.waypoints.waypoints)
-                cur_dist = self.dist_3d(self.pose.pose.position, self.waypoints.waypoints[idx].pose.pose.position)
-                if (cur_dist < min_dist):
-                    min_dist = cur_dist
-                    min_idx  = idx
-                if (min_dist < 5 and cur_dist > 10 * min_dist):
-                    break
-            dx = self.waypoints.waypoints[min_idx].pose.pose.position.x - self.pose.pose.position.x
-            dy = self.waypoints.waypoints[min_idx].pose.pose.position.y - self.pose.pose.position.y
+            position = self.pose.pose.position
+            dist = np.sqrt(np.sum((self.waypoints - (position.x, position.y, position.z)) ** 2, axis=1))
+            min_idx = self.closest_ahead(dist, self.cur_wp_idx - 2)
+            dx = self.waypoints[min_idx][0] - position.x
+            dy = self.waypoints[min_idx][1] - position.y
             heading = np.arctan2(dy, dx)
             (roll, pitch, yaw) = self.get_roll_pitch_yaw(self.pose.pose.orientation)
             angle = np.abs(yaw - heading)
             angle = np.minimum(angle, 2.0 * np.pi - angle)
             if (angle > np.pi / 4.0):
-                self.cur_wp_idx = (min_idx + 1) % len(self.waypoints.waypoints)
+                self.cur_wp_idx = (min_idx + 1) % len(self.waypoints)
             else:
                 self.cur_wp_idx = min_idx
             if self.debugmode:
               waypoint_index = self.cur_wp_idx
-              waypoint_position = self.waypoints.waypoints[waypoint_index].pose.pose.position
+              waypoint_position = self.waypoints[waypoint_index]
             
               rospy.loginfo('TLDetector det: car waypoint idx %i: (%.2f, %.2f, %.2f)',
-                              waypoint_index, waypoint_position.x, waypoint_position.y, waypoint_position.z)
+                              waypoint_index, waypoint_position[0], waypoint_position[1], waypoint_position[2])
         return self.cur_wp_idx
 
     def get_closest_waypoint(self, light_idx):
@@ -329,26 +579,58 @@ class TLDetector(object):
         # List of positions that correspond to the line to stop in front of for a given intersection
         stop_line_position = self.config['stop_line_positions'][light_idx]
         waypoint_index = None
-        if (self.waypoints):
-            min_dist = 100000.
-            min_idx  = self.cur_wp_idx
-            for i in range(self.cur_wp_idx, self.cur_wp_idx + len(self.waypoints.waypoints)):
-                idx = i % len(self.waypoints.waypoints)
-                dx = stop_line_position[0] - self.waypoints.waypoints[idx].pose.pose.position.x
-                dy = stop_line_position[1] - self.waypoints.waypoints[idx].pose.pose.position.y
-                cur_dist = math.sqrt(dx**2 + dy**2)
-                if (cur_dist < min_dist):
-                    min_dist = cur_dist
-                    min_idx  = idx
-                if (min_dist < 5 and cur_dist > 10 * min_dist):
-                    break
+        min_idx  = self.cur_wp_idx
+        if (self.waypoints is not None):
+            dist = np.sqrt(np.sum((self.waypoints[:, :2] - stop_line_position[:2]) ** 2, axis=1))
+            min_idx = self.closest_ahead(dist, self.cur_wp_idx)
             if self.debugmode:
               waypoint_index = min_idx
-              waypoint_position = self.waypoints.waypoints[waypoint_index].pose.pose.position
+              waypoint_position = self.waypoints[waypoint_index]
               rospy.loginfo('TLDetector det: stop waypoint idx %i: (%.2f, %.2f, %.2f)',
-                            waypoint_index, waypoint_position.x, waypoint_position.y, waypoint_position.z)
+                            waypoint_index, waypoint_position[0], waypoint_position[1], waypoint_position[2])
         return min_idx
 
+    def closest_ahead(self, dist, start_idx):
+        """Finds the closest waypoint on the first pass ahead of start_idx - a
+            track passing the same place twice has a second minimum later on
+
+        Args:
+            dist: distance of each waypoint in self.waypoints [m]
+            start_idx: waypoint to start the search at (wraps around)
+
+        Returns:
+            int: index of the closest waypoint in self.waypoints
+
+        """
+        order = (start_idx + np.arange(len(dist))) % len(dist)
+        dist = dist[order]
+        # the search ends once a waypoint closer than 5m has been passed, i.e.
+        # the distance is 10 times the minimum so far
+        min_dist = np.minimum.accumulate(dist)
+        passed = np.flatnonzero((min_dist < 5) & (dist > 10 * min_dist))
+        end = passed[0] + 1 if len(passed) else len(dist)
+        return int(order[np.argmin(dist[:end])])
+
+    def find_light_ahead(self, waypoint_idx):
+        """Finds the first traffic light within 30 meter of the waypoints along
+            the next 120 meter ahead of waypoint_idx
+
+        Returns:
+            int: index of the light in self.lights (None if there is none)
+
+        """
+        if 0 == len(self.lights):
+            return None
+        # look ahead through the waypoints along the next 120 meter
+        ahead = (waypoint_idx + np.arange(len(self.waypoints))) % len(self.waypoints)
+        ahead = ahead[np.cumsum(self.waypoint_segments[ahead]) <= 120]
+        # check if a traffic light is in range of 30 meter
+        lights = self.light_positions
+        dist = np.sum((self.waypoints[ahead][:, np.newaxis, :] - lights[np.newaxis, :, :]) ** 2, axis=2)
+        in_range = np.argwhere(dist < 30 ** 2)
+        # argwhere is ordered by waypoint first, light second
+        return int(in_range[0][1]) if len(in_range) else None
+
     def get_light_state(self, light):
         """Determines the current color of the traffic light
 
@@ -378,130 +660,96 @@ class TLDetector(object):
 
         """
         light_idx = None
+        self.light_idx = None
+        self.light_probabilities = None
+        if self.light_localizer is not None:
+            return self.search_traffic_lights()
 
         # Find the closest visible traffic light (if one exists)
         waypoint_idx = self.get_closest_waypoint_from_pose()
-        if ( (self.waypoints != None) and (waypoint_idx != None) and
+        if ( (self.waypoints is not None) and (waypoint_idx != None) and
              (self.pose != None) and (self.camera_image != None) ):
-            # look ahead through the waypoints along the next 120 meter
-            travel_dist = 0
-            found_light = False
-            for i in range(waypoint_idx, waypoint_idx + len(self.waypoints.waypoints)):
-                idx = i % len(self.waypoints.waypoints)
-                last_idx = idx - 1
-                if (last_idx < 0):
-                    last_idx = last_idx + len(self.waypoints.waypoints)
-                last_pos = self.waypoints.waypoints[last_idx].pose.pose.position
-                this_pos = self.waypoints.waypoints[idx].pose.pose.position
-                travel_dist = travel_dist + self.dist_3d(last_pos, this_pos)
-                if (travel_dist > 120):
-                    break
-                # check if a traffic light is in range of 30 meter
-                for tli in range(len(self.lights)):
-                    wp_light_dist = self.dist_3d(self.lights[tli].pose.pose.position, self.waypoints.waypoints[idx].pose.pose.position)
-                    if (wp_light_dist < 30):
-                        found_light = True
-                        # calculate vector from vehicle to traffic light in vehicle coordinate system
-                        pose_light_dist = self.dist_3d(self.lights[tli].pose.pose.position, self.pose.pose.position)
-                        light_position = self.lights[tli].pose.pose.position
-                        dx_world = light_position.x - self.pose.pose.position.x
-                        dy_world = light_position.y - self.pose.pose.position.y
-                        dz_world = light_position.z - (self.pose.pose.position.z + self.camera_z)
-                        (roll, pitch, yaw) = self.get_roll_pitch_yaw(self.pose.pose.orientation)
-                        roll = 0.0  # value seems to be unreliable in bag file
-                        pitch = 0.0 # value seems to be unreliable in bag file
-                        s_y = math.sin(yaw)
-                        c_y = math.cos(yaw)
-                        s_p = math.sin(pitch)
-                        c_p = math.cos(pitch)
-                        s_r = math.sin(roll)
-                        c_r = math.cos(roll)
-                        rotation_matrix = \
-                            [[c_y*c_p, c_y*s_p*s_r - s_y*c_r, c_y*s_p*c_r + s_y*s_r], \
-                            [ s_y*c_p, s_y*s_p*s_r + c_y*c_r, s_y*s_p*c_r - c_y*s_r], \
-                            [    -s_p,     c_p*s_r,               c_p*c_r]]
-                        if np.linalg.matrix_rank(rotation_matrix) == 3:
-                            inv_rotation_matrix = np.linalg.inv(rotation_matrix)
-                            tmp = np.matmul(inv_rotation_matrix, [[dx_world], [dy_world], [dz_world]])
-                            dx_camera = -tmp[1][0]
-                            dy_camera = -tmp[2][0]
-                            dz_camera =  tmp[0][0]
-                            if self.debugmode:
-                              rospy.loginfo('TLDetector calc: dxyz_w (%.1f, %.1f, %.1f), dxyz_c (%.1f, %.1f, %.1f)',
-                                            dx_world, dy_world, dz_world, dx_camera, dy_camera, dz_camera)
-                            # check if traffic light is visible from vehicle
-                            cropped_edge_len = int(round(self.image_scale / dz_camera))
-                            cropped_x_center = int(round(self.camera_f_x * (dx_camera / dz_camera) + self.camera_c_x))
-                            cropped_y_center = int(round(self.camera_f_y * (dy_camera / dz_camera) + self.camera_c_y))
-                            cropped_x_from = cropped_x_center - (cropped_edge_len/2)
-                            cropped_y_from = cropped_y_center - (cropped_edge_len/2)
-                            cropped_x_to   = cropped_x_from   + cropped_edge_len
-                            cropped_y_to   = cropped_y_from   + cropped_edge_len
-                            if self.debugmode:
-                                cv2_rgb = self.bridge.imgmsg_to_cv2(self.camera_image, "rgb8")
-                                if ( (self.image_width != self.camera_image.width) or
-                                     (self.image_height != self.camera_image.height) ):
-                                    cv2_rgb = cv2.resize(cv2_rgb, (self.image_width, self.image_height))
-                                rospy.loginfo('TLDetector calc: image bbox(light) = [(%i, %i), (%i, %i)]',
-                                    cropped_x_from, cropped_y_from, cropped_x_to, cropped_y_to)
-                                # store complete image (for reference)
-                                if (self.next_image_idx != None):
-                                    #dump the tenth picture
-                                    if (self.internal_counter % 10 == 0):
-                                        filename = '{0}traffic_light_{1}.png'.format(IMAGE_DUMP_FOLDER, self.next_image_idx)
-                                        cv2.line(cv2_rgb, (self.image_width/2, self.image_height/2),
-                                            (cropped_x_center, cropped_y_center), (0, 0, 255), 3)
-                                        cv2.imwrite(filename, cv2.cvtColor(cv2_rgb, cv2.COLOR_RGB2BGR))
-                                        with open('{0}params.csv'.format(IMAGE_DUMP_FOLDER),'a') as file:
-                                            file.write(str(self.next_image_idx) + ','
-                                                + str(dx_camera) + ',' + str(dy_camera) + ','
-                                                + str(dz_camera) + ',' + str(self.lights[tli].state) + '\n')
-                                        self.next_image_idx += 1
-                                    
-                            if ( (cropped_x_to - cropped_x_from >= 32) and
-                                 (cropped_x_from >= 0) and (cropped_x_to < self.image_width) and
-                                 (cropped_y_from >= 0) and (cropped_y_to < self.image_height) ):
+            tli = self.find_light_ahead(waypoint_idx)
+            if tli is not None:
+                # project the light into the camera image with the pose at the time of the frame
+                x, y, z, yaw = self.get_pose_at(self.camera_stamp)
+                points, centers, boxes = self.camera.project(self.light_positions[[tli]], (x, y, z), yaw)
+                dx_camera, dy_camera, dz_camera = points[0]
+                cropped_x_center, cropped_y_center = (int(v) for v in centers[0])
+                cropped_x_from, cropped_y_from, cropped_x_to, cropped_y_to = (int(v) for v in boxes[0])
+                if self.debugmode:
+                    rospy.loginfo('TLDetector calc: dxyz_c (%.1f, %.1f, %.1f)', dx_camera, dy_camera, dz_camera)
+                    # copy, the reference line is drawn into the image
+                    cv2_rgb = np.array(self.get_camera_rgb())
+                    if ( (self.image_width != self.camera_image.width) or
+                         (self.image_height != self.camera_image.height) ):
+                        cv2_rgb = cv2.resize(cv2_rgb, (self.image_width, self.image_height))
+                    rospy.loginfo('TLDetector calc: image bbox(light) = [(%i, %i), (%i, %i)]',
+                        cropped_x_from, cropped_y_from, cropped_x_to, cropped_y_to)
+                    # store complete image (for reference)
+                    if (self.debug_writer != None):
+                        #dump the tenth picture
+                        if (self.internal_counter % 10 == 0):
+                            image_idx = self.debug_writer.take_index()
+                            cv2.line(cv2_rgb, (self.image_width/2, self.image_height/2),
+                                (cropped_x_center, cropped_y_center), (0, 0, 255), 3)
+                            self.debug_writer.write_sample(
+                                images=[('traffic_light_{0}.png'.format(image_idx),
+                                         cv2.cvtColor(cv2_rgb, cv2.COLOR_RGB2BGR))],
+                                rows=[('params.csv', (image_idx, dx_camera, dy_camera, dz_camera,
+                                                      self.lights[tli].state))])
                                 
-                                light_idx = tli
-                                if self.debugmode:
-                                  light_pos = self.lights[tli].pose.pose.position
-                                  rospy.loginfo('TLDetector det: light idx %i as visible: (%.2f, %.2f, %.2f)',
-                                                tli, light_pos.x, light_pos.y, light_pos.z)
-                                # convert image to cv2 format, crop and classify
-                                cv2_rgb = self.bridge.imgmsg_to_cv2(self.camera_image, "rgb8")
-                                if ( (self.image_width != self.camera_image.width) or
-                                     (self.image_height != self.camera_image.height) ):
-                                    cv2_rgb = cv2.resize(cv2_rgb, (self.image_width, self.image_height))
-                                cv2_rgb = cv2_rgb[cropped_y_from:cropped_y_to, cropped_x_from:cropped_x_to]
-                                state = self.light_classifier.get_classification(cv2_rgb) 
-                                if (state != self.lights[tli].state):
-                                    colorValue = [ "red", "yellow", "green", "", "unknown"]
-                                    rospy.logwarn("TLDetector misdetection of light {0} expected {1} got {2} - "\
-                                                  "total of {3} misclassifications"
-                                                  .format(tli, colorValue[self.lights[light_idx].state],\
-                                                          colorValue[ state], self.misclassification_counter+1))
-                                    filename = "./misclassified/mismatch_{0}{1}.jpg".\
-                                      format(colorValue[self.lights[light_idx].state], self.misclassification_counter)
-                                    self.misclassification_counter+=1
-                                    if self.debugmode:
-                                        cv2.imwrite(filename, cv2.cvtColor(cv2_rgb, cv2.COLOR_RGB2BGR))
-                                # write some output for training the classifier
-                                if (self.next_image_idx != None):
-                                    # cropped image (for training and/or classification)
-                                    filename = '{0}traffic_light_cropped{1}.png'.format(IMAGE_DUMP_FOLDER, self.next_image_idx) + '.png'
-                                    cv2.imwrite(filename, cv2.resize(cv2_rgb, (32, 32)))
-                                    with open('{0}light_state.csv'.format(IMAGE_DUMP_FOLDER),'a') as file:
-                                        file.write(str(self.next_image_idx) + ',' + str(self.lights[tli].state) + '\n')
-                                    self.next_image_idx = self.next_image_idx + 1
-                            else:
-                                light_pos = self.lights[tli].pose.pose.position
-                                if self.debugmode:
-                                  rospy.loginfo('TLDetector det: light idx %i as invisble: (%.2f, %.2f, %.2f)',
-                                                tli, light_pos.x, light_pos.y, light_pos.z)
-                        break
-                if (found_light):
-                  #early exit in case that we've detected a light
-                  break
+                if self.camera.visible(boxes, self.image_width, self.image_height)[0]:
+                            
+                    light_idx = tli
+                    self.light_idx = tli
+                    if self.debugmode:
+                      light_pos = self.lights[tli].pose.pose.position
+                      rospy.loginfo('TLDetector det: light idx %i as visible: (%.2f, %.2f, %.2f)',
+                                    tli, light_pos.x, light_pos.y, light_pos.z)
+                    # convert image to cv2 format, crop and classify
+                    cv2_rgb = self.get_camera_rgb()
+                    if ( (self.image_width != self.camera_image.width) or
+                         (self.image_height != self.camera_image.height) ):
+                        cv2_rgb = cv2.resize(cv2_rgb, (self.image_width, self.image_height))
+                    # rectified crop if the camera is calibrated
+                    cv2_rgb = self.camera.undistort_crop(
+                        cv2_rgb, (cropped_x_from, cropped_y_from, cropped_x_to, cropped_y_to))
+                    crops = self.copy_crops([cv2_rgb])
+                    if crops is None:
+                        return -1, TrafficLight.UNKNOWN
+                    cv2_rgb = crops[0]
+                    probabilities = self.light_classifier.get_classification_probabilities(cv2_rgb)
+                    if probabilities is None:
+                        state = TrafficLight.UNKNOWN
+                    else:
+                        state = LIGHTS[int(np.argmax(probabilities))]
+                        self.light_probabilities = probabilities
+                    self.log_cascade_stats()
+                    if (self.light_classifier.ready and state != self.lights[tli].state):
+                        colorValue = [ "red", "yellow", "green", "", "unknown"]
+                        rospy.logwarn("TLDetector misdetection of light {0} expected {1} got {2} - "\
+                                      "total of {3} misclassifications"
+                                      .format(tli, colorValue[self.lights[light_idx].state],\
+                                              colorValue[ state], self.misclassification_counter+1))
+                        filename = os.path.abspath("./misclassified/mismatch_{0}{1}.jpg".\
+                          format(colorValue[self.lights[light_idx].state], self.misclassification_counter))
+                        self.misclassification_counter+=1
+                        if self.debugmode:
+                            self.debug_writer.write_sample(images=[(filename, cv2.cvtColor(cv2_rgb, cv2.COLOR_RGB2BGR))])
+                    # write some output for training the classifier
+                    if (self.debug_writer != None):
+                        # cropped image (for training and/or classification)
+                        image_idx = self.debug_writer.take_index()
+                        self.debug_writer.write_sample(
+                            images=[('traffic_light_cropped{0}.png.png'.format(image_idx),
+                                     cv2.resize(cv2_rgb, (32, 32)))],
+                            rows=[('light_state.csv', (image_idx, self.lights[tli].state))])
+                else:
+                    light_pos = self.lights[tli].pose.pose.position
+                    if self.debugmode:
+                      rospy.loginfo('TLDetector det: light idx %i as invisble: (%.2f, %.2f, %.2f)',
+                                    tli, light_pos.x, light_pos.y, light_pos.z)
 
         if (light_idx != None):
             light_wp = self.get_closest_waypoint(light_idx)
@@ -513,9 +761,71 @@ class TLDetector(object):
         # self.waypoints = None
         return -1, TrafficLight.UNKNOWN
 
+    def search_traffic_lights(self):
+        """Searches the frame for lit traffic lights and classifies the candidates as one batch
+
+        The light is the one of the next stop line ahead, its state is the one
+        of the candidate the classifier is the most confident about.
+
+        Returns:
+            int: index of waypoint closes to the upcoming stop line for a traffic light (-1 if none exists)
+            int: ID of traffic light color (specified in styx_msgs/TrafficLight)
+
+        """
+        waypoint_idx = self.get_closest_waypoint_from_pose()
+        if (self.waypoints is None) or (waypoint_idx is None) or (self.camera_image is None):
+            return -1, TrafficLight.UNKNOWN
+        stop_idx = self.find_stop_line_ahead(waypoint_idx)
+        if stop_idx is None:
+            return -1, TrafficLight.UNKNOWN
+        cv2_rgb = self.get_camera_rgb()
+        if ( (self.image_width != self.camera_image.width) or
+             (self.image_height != self.camera_image.height) ):
+            cv2_rgb = cv2.resize(cv2_rgb, (self.image_width, self.image_height))
+        boxes = self.light_localizer.propose(cv2_rgb)
+        if 0 == len(boxes):
+            return -1, TrafficLight.UNKNOWN
+        crops = self.copy_crops([cv2_rgb[y_from:y_to, x_from:x_to] for x_from, y_from, x_to, y_to in boxes])
+        if crops is None:
+            return -1, TrafficLight.UNKNOWN
+        probabilities = self.light_classifier.get_classifications_probabilities(crops)
+        if probabilities is None:
+            return self.get_closest_waypoint(stop_idx), TrafficLight.UNKNOWN
+        best = int(np.argmax(np.max(probabilities, axis=1)))
+        self.light_idx = stop_idx
+        self.light_probabilities = probabilities[best]
+        if self.debugmode:
+            rospy.loginfo('TLDetector search: %i candidates, best %s', len(boxes), boxes[best])
+        return self.get_closest_waypoint(stop_idx), LIGHTS[int(np.argmax(probabilities[best]))]
+
+    def find_stop_line_ahead(self, waypoint_idx):
+        """Finds the first stop line within 30 meter of the waypoints along
+            the next 120 meter ahead of waypoint_idx
+
+        Returns:
+            int: index of the stop line in the traffic light config (None if there is none)
+
+        """
+        stop_lines = np.array(self.config['stop_line_positions'], dtype=np.float64).reshape(-1, 2)
+        if 0 == len(stop_lines):
+            return None
+        ahead = (waypoint_idx + np.arange(len(self.waypoints))) % len(self.waypoints)
+        ahead = ahead[np.cumsum(self.waypoint_segments[ahead]) <= 120]
+        dist = np.sum((self.waypoints[ahead][:, np.newaxis, :2] - stop_lines[np.newaxis, :, :]) ** 2, axis=2)
+        in_range = np.argwhere(dist < 30 ** 2)
+        return int(in_range[0][1]) if len(in_range) else None
+
     def dist_3d(self, a, b):
         return math.sqrt((a.x-b.x)**2 + (a.y-b.y)**2 + (a.z-b.z)**2)
 
+    def get_pose_at(self, stamp):
+        """Returns the vehicle pose (x, y, z, yaw) at a stamp, the latest pose for unstamped frames"""
+        if stamp and len(self.pose_history):
+            return self.pose_history.at(stamp)
+        position = self.pose.pose.position
+        (roll, pitch, yaw) = self.get_roll_pitch_yaw(self.pose.pose.orientation)
+        return position.x, position.y, position.z, yaw
+
     def get_roll_pitch_yaw(self, ros_quaternion):
         orientation_list = [ros_quaternion.x, ros_quaternion.y, ros_quaternion.z, ros_quaternion.w]
         return euler_from_quaternion(orientation_list) # returns (roll, pitch, yaw)
@@ -33,34 +33,37 @@ that we have created in the `__init__` function.
 '''
 
 class DBWNode(object):
-    def __init__(self):
-        rospy.init_node('dbw_node')
-
-        vehicle_mass = rospy.get_param('~vehicle_mass', 1736.35)
-        fuel_capacity = rospy.get_param('~fuel_capacity', 13.5)
-        brake_deadband = rospy.get_param('~brake_deadband', .1)
-        decel_limit = rospy.get_param('~decel_limit', -5)
-        accel_limit = rospy.get_param('~accel_limit', 1.)
-        wheel_radius = rospy.get_param('~wheel_radius', 0.2413)
-        wheel_base = rospy.get_param('~wheel_base', 2.8498)
-        steer_ratio = rospy.get_param('~steer_ratio', 14.8)
-        max_lat_accel = rospy.get_param('~max_lat_accel', 3.)
-        max_steer_angle = rospy.get_param('~max_steer_angle', 8.)
-
-        self.steer_pub = rospy.Publisher('/vehicle/steering_cmd',
-                                         SteeringCmd, queue_size=1)
-        self.throttle_pub = rospy.Publisher('/vehicle/throttle_cmd',
-                                            ThrottleCmd, queue_size=1)
-        self.brake_pub = rospy.Publisher('/vehicle/brake_cmd',
-                                         BrakeCmd, queue_size=1)
+    def __init__(self, bus=None):
+        # with a bus the node runs as component of composed_nodes.py
+        ros = rospy if bus is None else bus
+        if bus is None:
+            rospy.init_node('dbw_node')
+
+        vehicle_mass = ros.get_param('~vehicle_mass', 1736.35)
+        fuel_capacity = ros.get_param('~fuel_capacity', 13.5)
+        brake_deadband = ros.get_param('~brake_deadband', .1)
+        decel_limit = ros.get_param('~decel_limit', -5)
+        accel_limit = ros.get_param('~accel_limit', 1.)
+        wheel_radius = ros.get_param('~wheel_radius', 0.2413)
+        wheel_base = ros.get_param('~wheel_base', 2.8498)
+        steer_ratio = ros.get_param('~steer_ratio', 14.8)
+        max_lat_accel = ros.get_param('~max_lat_accel', 3.)
+        max_steer_angle = ros.get_param('~max_steer_angle', 8.)
+
+        self.steer_pub = ros.Publisher('vehicle/steering_cmd',
+                                       SteeringCmd, queue_size=1)
+        self.throttle_pub = ros.Publisher('vehicle/throttle_cmd',
+                                          ThrottleCmd, queue_size=1)
+        self.brake_pub = ros.Publisher('vehicle/brake_cmd',
+                                       BrakeCmd, queue_size=1)
 
         # Create `Controller` object
         self.controller = Controller(vehicle_mass, wheel_radius, wheel_base, steer_ratio, max_lat_accel, max_steer_angle)
 
         # Subscribe to all needed topics
-        rospy.Subscriber('/current_velocity', TwistStamped, self.current_velocity_cb)
-        rospy.Subscriber('/twist_cmd', TwistStamped, self.twist_cb)
-        rospy.Subscriber('/vehicle/dbw_enabled', Bool, self.dbw_enabled_cb)
+        ros.Subscriber('current_velocity', TwistStamped, self.current_velocity_cb)
+        ros.Subscriber('twist_cmd', TwistStamped, self.twist_cb)
+        ros.Subscriber('vehicle/dbw_enabled', Bool, self.dbw_enabled_cb)
 
         # Some helper data
         self.dbw_enabled = True
@@ -69,7 +72,9 @@ class DBWNode(object):
         self.proposed_lin_v = 0.0
         self.proposed_ang_v = 0.0
         
-        self.loop()
+        # as component the loop is started by composed_nodes.py
+        if bus is None:
+            self.loop()
 
     def loop(self):
         rate = rospy.Rate(50) # 50Hz (change to lower value for simulation if required - there seems to be some growing lag between controller and simulator)
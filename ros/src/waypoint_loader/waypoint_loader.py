@@ -1,26 +1,93 @@
 #!/usr/bin/env python
 
 import os
-import csv
-import math
+import json
 
-from geometry_msgs.msg import Quaternion
+import numpy as np
 
-from styx_msgs.msg import Lane, Waypoint
+from geometry_msgs.msg import PoseStamped
+from styx_msgs.msg import Lane, Waypoint, WaypointWindow
+from styx_msgs.srv import GetWaypoints, GetWaypointsResponse
+from styx_msgs.lane_compact import LaneCompactNumpy, array_to_compact
 
-import tf
 import rospy
 
 CSV_HEADER = ['x', 'y', 'z', 'yaw']
 MAX_DECEL = 1.0
 
+# Parsed routes are cached beside the csv as <csv>.cache.npz - bump the
+# version whenever the layout of the cached route array changes
+CACHE_SUFFIX = '.cache.npz'
+CACHE_VERSION = 1
+
+# Tiled mode: the route is stored as memory-mapped <csv>.tiles.npy and only a
+# window of tiles around the vehicle is published on base_waypoints_window
+TILES_SUFFIX = '.tiles.npy'
+TILE_SIZE = 500
+TILES_BEHIND = 1
+TILES_AHEAD = 2
+
+
+class RouteTiles(object):
+    """Route split into tiles of TILE_SIZE consecutive waypoints
+
+    The route rows (see WaypointLoader.load_route) stay in a memory-mapped
+    array, only the bounding boxes of the tiles are kept in memory.
+    """
+
+    def __init__(self, route, tile_size):
+        self.route = route
+        self.tile_size = tile_size
+        self.count = (len(route) + tile_size - 1) // tile_size
+        bounds = []
+        for tile in range(self.count):
+            xy = np.asarray(route[tile * tile_size:(tile + 1) * tile_size, :2])
+            bounds.append(np.concatenate((xy.min(axis=0), xy.max(axis=0))))
+        # min x, min y, max x, max y
+        self.bounds = np.array(bounds)
+
+    def closest(self, x, y):
+        """Returns the index of the waypoint closest to (x, y)"""
+        # distance of the point to the bounding box of each tile is a lower
+        # bound for the distance to the waypoints of that tile
+        dx = np.maximum(np.maximum(self.bounds[:, 0] - x, x - self.bounds[:, 2]), 0.)
+        dy = np.maximum(np.maximum(self.bounds[:, 1] - y, y - self.bounds[:, 3]), 0.)
+        lower_bounds = np.hypot(dx, dy)
+        best_dist, best_idx = np.inf, 0
+        for tile in np.argsort(lower_bounds):
+            if lower_bounds[tile] > best_dist:
+                break
+            start = tile * self.tile_size
+            xy = np.asarray(self.route[start:start + self.tile_size, :2])
+            dist = np.hypot(xy[:, 0] - x, xy[:, 1] - y)
+            idx = np.argmin(dist)
+            if dist[idx] < best_dist:
+                best_dist, best_idx = dist[idx], start + idx
+        return best_idx
+
+    def rows(self, start, count):
+        """Returns count rows starting at start, wrapping around at the end of the route"""
+        count = min(count, len(self.route))
+        return self.route[(start + np.arange(count)) % len(self.route)]
+
 
 class WaypointLoader(object):
 
     def __init__(self):
         rospy.init_node('waypoint_loader', log_level=rospy.DEBUG)
 
-        self.pub = rospy.Publisher('/base_waypoints', Lane, queue_size=1, latch=True)
+        self.tiled = rospy.get_param('~tiled', False)
+        if self.tiled:
+            self.window_pub = rospy.Publisher('base_waypoints_window', WaypointWindow, queue_size=1, latch=True)
+            self.tiles = None
+            self.window_first_tile = None
+        else:
+            self.pub = rospy.Publisher('base_waypoints', Lane, queue_size=1, latch=True)
+            # the array based route for consumers supporting styx_msgs/LaneCompact
+            self.compact_pub = None
+            if rospy.get_param('compact_lanes', False):
+                self.compact_pub = rospy.Publisher('base_waypoints_compact', LaneCompactNumpy,
+                                                   queue_size=1, latch=True)
 
         self.velocity = self.kmph2mps(rospy.get_param('~velocity'))
         self.new_waypoint_loader(rospy.get_param('~path'))
@@ -28,49 +95,106 @@ class WaypointLoader(object):
 
     def new_waypoint_loader(self, path):
         if os.path.isfile(path):
-            waypoints = self.load_waypoints(path)
-            self.publish(waypoints)
-            rospy.loginfo('Waypoint Loded')
+            if self.tiled:
+                self.tiles = RouteTiles(self.load_tiles(path), rospy.get_param('~tile_size', TILE_SIZE))
+                self.tiles_behind = rospy.get_param('~tiles_behind', TILES_BEHIND)
+                self.tiles_ahead = rospy.get_param('~tiles_ahead', TILES_AHEAD)
+                rospy.Subscriber('current_pose', PoseStamped, self.pose_cb)
+                rospy.Service('get_waypoints', GetWaypoints, self.get_waypoints_cb)
+                rospy.loginfo('Waypoint Loded: %i waypoints in %i tiles', len(self.tiles.route), self.tiles.count)
+            else:
+                route = self.load_route(path)
+                self.publish(self.create_waypoints(route))
+                if self.compact_pub is not None:
+                    self.publish_compact(route)
+                rospy.loginfo('Waypoint Loded')
         else:
             rospy.logerr('%s is not a file', path)
 
-    def quaternion_from_yaw(self, yaw):
-        return tf.transformations.quaternion_from_euler(0., 0., yaw)
+    def quaternions_from_yaw(self, yaw):
+        # same as tf.transformations.quaternion_from_euler(0., 0., yaw) for all yaws at once
+        q = np.zeros((len(yaw), 4))
+        q[:, 2] = np.sin(yaw / 2.)
+        q[:, 3] = np.cos(yaw / 2.)
+        return q
 
     def kmph2mps(self, velocity_kmph):
         return (velocity_kmph * 1000.) / (60. * 60.)
 
     def load_waypoints(self, fname):
+        return self.create_waypoints(self.load_route(fname))
+
+    def create_waypoints(self, route):
         waypoints = []
-        with open(fname) as wfile:
-            reader = csv.DictReader(wfile, CSV_HEADER)
-            for wp in reader:
-                p = Waypoint()
-                p.pose.pose.position.x = float(wp['x'])
-                p.pose.pose.position.y = float(wp['y'])
-                p.pose.pose.position.z = float(wp['z'])
-                q = self.quaternion_from_yaw(float(wp['yaw']))
-                p.pose.pose.orientation = Quaternion(*q)
-                p.twist.twist.linear.x = float(self.velocity)
-
-                waypoints.append(p)
-        return self.decelerate(waypoints)
-
-    def distance(self, p1, p2):
-        x, y, z = p1.x - p2.x, p1.y - p2.y, p1.z - p2.z
-        return math.sqrt(x*x + y*y + z*z)
-
-    def decelerate(self, waypoints):
-        last = waypoints[-1]
-        last.twist.twist.linear.x = 0.
-        for wp in waypoints[:-1][::-1]:
-            dist = self.distance(wp.pose.pose.position, last.pose.pose.position)
-            vel = math.sqrt(2 * MAX_DECEL * dist)
-            if vel < 1.:
-                vel = 0.
-            wp.twist.twist.linear.x = min(vel, wp.twist.twist.linear.x)
+        for x, y, z, qx, qy, qz, qw, v in route.tolist():
+            p = Waypoint()
+            position = p.pose.pose.position
+            position.x, position.y, position.z = x, y, z
+            orientation = p.pose.pose.orientation
+            orientation.x, orientation.y, orientation.z, orientation.w = qx, qy, qz, qw
+            p.twist.twist.linear.x = v
+            waypoints.append(p)
         return waypoints
 
+    def load_route(self, fname, cache=True):
+        """Returns the route as array of rows x, y, z, qx, qy, qz, qw, velocity
+
+        The result is cached beside the csv file and reused as long as the
+        modification time of the csv and the velocity don't change.
+        """
+        mtime = os.path.getmtime(fname)
+        cache = fname + CACHE_SUFFIX if cache else None
+        if cache is not None and os.path.isfile(cache):
+            try:
+                with np.load(cache) as cached:
+                    if ( (cached['version'] == CACHE_VERSION) and (cached['mtime'] == mtime) and
+                         (cached['velocity'] == self.velocity) ):
+                        rospy.logdebug('Waypoints loaded from cache %s', cache)
+                        return cached['route']
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+        with open(fname) as wfile:
+            text = wfile.read().replace('\r', '').strip()
+        # the csv may have more than the CSV_HEADER columns (e.g. churchlot_with_cars.csv)
+        columns = text.split('\n', 1)[0].count(',') + 1
+        values = np.fromstring(text.replace('\n', ','), sep=',').reshape(-1, columns)
+        xyz, yaw = values[:, :3], values[:, CSV_HEADER.index('yaw')]
+        route = np.column_stack((xyz, self.quaternions_from_yaw(yaw), self.decelerate(xyz)))
+
+        if cache is None:
+            return route
+        try:
+            np.savez(cache, version=CACHE_VERSION, mtime=mtime, velocity=self.velocity, route=route)
+        except (IOError, OSError) as e:
+            rospy.logwarn('Could not write waypoint cache %s: %s', cache, e)
+        return route
+
+    def load_tiles(self, fname):
+        """Returns the route memory-mapped from the tile store beside the csv"""
+        store = fname + TILES_SUFFIX
+        key = {'version': CACHE_VERSION, 'mtime': os.path.getmtime(fname), 'velocity': self.velocity}
+        try:
+            with open(store + '.json') as kfile:
+                if json.load(kfile) == key:
+                    return np.load(store, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            pass
+        # the tile store is the cache of the tiled mode - no need for the npz
+        np.save(store, self.load_route(fname, cache=False))
+        with open(store + '.json', 'w') as kfile:
+            json.dump(key, kfile)
+        return np.load(store, mmap_mode='r')
+
+    def decelerate(self, xyz):
+        # straight line distance of each waypoint to the last one
+        dist = np.sqrt(np.sum((xyz - xyz[-1]) ** 2, axis=1))
+        vel = np.sqrt(2 * MAX_DECEL * dist)
+        vel[vel < 1.] = 0.
+        vel = np.minimum(vel, self.velocity)
+        vel[-1] = 0.
+        return vel
+
     def publish(self, waypoints):
         lane = Lane()
         lane.header.frame_id = '/world'
@@ -78,6 +202,34 @@ class WaypointLoader(object):
         lane.waypoints = waypoints
         self.pub.publish(lane)
 
+    def publish_compact(self, route):
+        lane = array_to_compact(route[:, :3], 2. * np.arctan2(route[:, 5], route[:, 6]), route[:, 7])
+        lane.header.frame_id = '/world'
+        lane.header.stamp = rospy.Time(0)
+        self.compact_pub.publish(lane)
+
+    def create_window(self, start, count):
+        window = WaypointWindow()
+        window.header.frame_id = '/world'
+        window.header.stamp = rospy.Time.now()
+        window.offset = start % len(self.tiles.route)
+        window.total = len(self.tiles.route)
+        window.waypoints = self.create_waypoints(self.tiles.rows(start, count))
+        return window
+
+    def pose_cb(self, msg):
+        idx = self.tiles.closest(msg.pose.position.x, msg.pose.position.y)
+        first_tile = (idx // self.tiles.tile_size - self.tiles_behind) % self.tiles.count
+        if first_tile != self.window_first_tile:
+            # refresh the window only when the vehicle entered another tile
+            self.window_first_tile = first_tile
+            count = (self.tiles_behind + 1 + self.tiles_ahead) * self.tiles.tile_size
+            self.window_pub.publish(self.create_window(first_tile * self.tiles.tile_size, count))
+            rospy.logdebug('Waypoint window starts at tile %i of %i', first_tile, self.tiles.count)
+
+    def get_waypoints_cb(self, req):
+        return GetWaypointsResponse(self.create_window(req.start, req.count))
+
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import threading
+import traceback
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+import rospy
+import rospkg
+from styx_msgs.lane_compact import lane_positions
+
+'''
+This node runs tl_detector, waypoint_updater and dbw_node as components of one
+process (see styx.launch composed:=true) instead of three separate nodes.
+
+The components talk to ROS through a LocalBus:
+- every ROS topic the components subscribe to is subscribed only once and the
+  deserialized message is handed to all of them (e.g. /base_waypoints is
+  received and kept in memory once)
+- topics which are published and consumed by the components (LOCAL_TOPICS) are
+  delivered through in-memory queues, without serialization - they are still
+  published on ROS for outside tools (rostopic, rosbag, the C++ nodes)
+- the waypoint positions of a waypoint message are converted once into one
+  read-only numpy array, which the components get by waypoint_positions(msg)
+  instead of building their own copy
+
+The deserialized messages themselves are shared as well. waypoint_updater
+adjusts the velocities of the /base_waypoints Lane in place, so the other
+components read the waypoints only through waypoint_positions.
+
+Private parameters and services of a component live in ~<component>/<name>,
+e.g. ~dbw_node/vehicle_mass or ~tl_detector/reload_classifier.
+'''
+
+# topics which are published by one and subscribed by another component
+LOCAL_TOPICS = ('traffic_waypoint',)
+
+# latched topics are handed to components subscribing after their reception
+LATCHED_TOPICS = ('base_waypoints', 'base_waypoints_window', 'base_waypoints_compact')
+
+
+def invoke(callback, msg):
+    '''Calls a component callback - an error is logged and doesn't stop the delivery (like rospy)'''
+    try:
+        callback(msg)
+    except Exception:
+        rospy.logerr('ComposedNodes callback %s failed:\n%s', callback, traceback.format_exc())
+
+
+class LocalSubscriber(object):
+    '''Delivers the messages of a local topic from a queue in its own thread (like rospy)'''
+
+    def __init__(self, callback, queue_size):
+        self.callback = callback
+        self.queue = Queue(max(queue_size or 0, 0))
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def put(self, msg):
+        if self.queue.full():
+            # drop the oldest message as rospy does
+            try:
+                self.queue.get_nowait()
+            except Exception:
+                pass
+        self.queue.put(msg)
+
+    def run(self):
+        while not rospy.is_shutdown():
+            invoke(self.callback, self.queue.get())
+
+
+class LocalPublisher(object):
+    def __init__(self, bus, topic, data_class, queue_size):
+        self.bus = bus
+        self.topic = topic
+        self.publisher = rospy.Publisher(topic, data_class, queue_size=queue_size)
+
+    def publish(self, msg):
+        for subscriber in self.bus.local_subscribers.get(self.topic, []):
+            subscriber.put(msg)
+        # rospy skips the serialization if there is no subscriber
+        self.publisher.publish(msg)
+
+
+class LocalBus(object):
+    def __init__(self, local_topics=LOCAL_TOPICS, latched_topics=LATCHED_TOPICS):
+        self.local_topics = local_topics
+        self.latched_topics = latched_topics
+        self.lock = threading.Lock()
+        self.local_subscribers = {}
+        # one rospy.Subscriber, the component callbacks and the last message per ROS topic
+        self.subscribers = {}
+        self.callbacks = {}
+        self.last_msg = {}
+        # the last waypoint message and its positions
+        self.positions = (None, None)
+
+    def component(self, name):
+        return Component(self, name)
+
+    def subscribe(self, topic, data_class, callback, queue_size=None):
+        if topic in self.local_topics:
+            subscriber = LocalSubscriber(callback, queue_size)
+            self.local_subscribers.setdefault(topic, []).append(subscriber)
+            return subscriber
+        with self.lock:
+            self.callbacks.setdefault(topic, []).append(callback)
+            if topic not in self.subscribers:
+                self.subscribers[topic] = rospy.Subscriber(topic, data_class, self.dispatch, topic)
+            msg = self.last_msg.get(topic)
+        if msg is not None:
+            invoke(callback, msg)
+        return self.subscribers[topic]
+
+    def dispatch(self, msg, topic):
+        with self.lock:
+            if topic in self.latched_topics:
+                self.last_msg[topic] = msg
+            callbacks = list(self.callbacks[topic])
+        # the components share the message - they must not modify what the others read
+        for callback in callbacks:
+            invoke(callback, msg)
+
+    def waypoint_positions(self, msg):
+        '''Read-only N x 3 waypoint positions of a waypoint message, computed once for all components'''
+        with self.lock:
+            if self.positions[0] is not msg:
+                self.positions = (msg, lane_positions(msg))
+            return self.positions[1]
+
+    def publish(self, topic, data_class, queue_size=None, latch=False):
+        if topic in self.local_topics:
+            return LocalPublisher(self, topic, data_class, queue_size)
+        return rospy.Publisher(topic, data_class, queue_size=queue_size, latch=latch)
+
+
+class Component(object):
+    '''The part of the rospy interface a node uses, bound to the LocalBus'''
+
+    def __init__(self, bus, name):
+        self.bus = bus
+        self.name = name
+
+    def Subscriber(self, topic, data_class, callback, queue_size=None):
+        return self.bus.subscribe(topic, data_class, callback, queue_size)
+
+    def Publisher(self, topic, data_class, queue_size=None, latch=False):
+        return self.bus.publish(topic, data_class, queue_size, latch)
+
+    def Service(self, name, service_class, handler):
+        return rospy.Service(self.resolve(name), service_class, handler)
+
+    def Timer(self, period, callback):
+        return rospy.Timer(period, callback)
+
+    def waypoint_positions(self, msg):
+        return self.bus.waypoint_positions(msg)
+
+    def get_param(self, name, *default):
+        return rospy.get_param(self.resolve(name), *default)
+
+    def resolve(self, name):
+        '''Maps the private name ~<name> into the namespace of the component'''
+        if name.startswith('~'):
+            return '~{0}/{1}'.format(self.name, name[1:])
+        return name
+
+
+class ComposedNodes(object):
+    def __init__(self):
+        rospy.init_node('composed_nodes')
+
+        rospack = rospkg.RosPack()
+        for package in ('tl_detector', 'waypoint_updater', 'twist_controller'):
+            sys.path.insert(0, rospack.get_path(package))
+        # the classifier loads its model relative to the tl_detector package
+        os.chdir(rospack.get_path('tl_detector'))
+        from tl_detector import TLDetector
+        from waypoint_updater import WaypointUpdater
+        from dbw_node import DBWNode
+
+        bus = LocalBus()
+        self.tl_detector = TLDetector(bus.component('tl_detector'))
+        self.waypoint_updater = WaypointUpdater(bus.component('waypoint_updater'))
+        self.dbw_node = DBWNode(bus.component('dbw_node'))
+        rospy.loginfo('ComposedNodes runs tl_detector, waypoint_updater and dbw_node')
+
+        # the control loop of dbw_node takes over the main thread
+        self.dbw_node.loop()
+
+
+if __name__ == '__main__':
+    try:
+        ComposedNodes()
+    except rospy.ROSInterruptException:
+        rospy.logerr('Could not start composed nodes.')
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import rospy
+from styx_msgs.msg import Lane
+from styx_msgs.lane_compact import LaneCompactNumpy, compact_to_lane
+
+'''
+This node converts /final_waypoints_compact (styx_msgs/LaneCompact) back to
+/final_waypoints (styx_msgs/Lane) for the C++ pure_pursuit node. Only needed
+if the nodes run with the compact_lanes parameter set.
+'''
+
+class LaneCompactConverter(object):
+    def __init__(self):
+        rospy.init_node('lane_compact_converter')
+
+        self.lane_pub = rospy.Publisher('final_waypoints', Lane, queue_size=1)
+        rospy.Subscriber('final_waypoints_compact', LaneCompactNumpy, self.compact_cb)
+
+        rospy.spin()
+
+    def compact_cb(self, msg):
+        self.lane_pub.publish(compact_to_lane(msg))
+
+
+if __name__ == '__main__':
+    try:
+        LaneCompactConverter()
+    except rospy.ROSInterruptException:
+        rospy.logerr('Could not start lane compact converter node.')
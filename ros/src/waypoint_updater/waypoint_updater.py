@@ -2,7 +2,8 @@
 
 import rospy
 from geometry_msgs.msg import PoseStamped, Quaternion
-from styx_msgs.msg import Lane, Waypoint
+from styx_msgs.msg import Lane, Waypoint, WaypointWindow
+from styx_msgs.lane_compact import LaneCompactNumpy, array_to_compact, compact_to_array, compact_to_lane, lane_to_compact
 from std_msgs.msg import Int32
 
 import math
@@ -29,29 +30,53 @@ LOOKAHEAD_WPS = 200 # Number of waypoints we will publish. You can change this n
 DECELERATION = 2.0 # Absolute value of planned deceleration in m/s^2
 
 class WaypointUpdater(object):
-    def __init__(self):
-        rospy.init_node('waypoint_updater')
+    def __init__(self, bus=None):
+        # with a bus the node runs as component of composed_nodes.py
+        ros = rospy if bus is None else bus
+        if bus is None:
+            rospy.init_node('waypoint_updater')
 
         # Store the max velocity, already converted from km/h to m/s
-        self.c_max_velocity = rospy.get_param('waypoint_loader/velocity', 40.) / 3.6
+        self.c_max_velocity = ros.get_param('waypoint_loader/velocity', 40.) / 3.6
 
         # Subscribe to required topics
-        rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
-        rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
-        rospy.Subscriber('/traffic_waypoint', Int32, self.traffic_cb)
-        rospy.Subscriber('/obstacle_waypoint', Int32, self.obstacle_cb)
+        ros.Subscriber('current_pose', PoseStamped, self.pose_cb)
+        self.compact = ros.get_param('compact_lanes', False)
+        # in tiled mode the loader only publishes a window of the route
+        if ros.get_param('waypoint_loader/tiled', False):
+            ros.Subscriber('base_waypoints_window', WaypointWindow, self.waypoints_window_cb)
+        elif self.compact:
+            ros.Subscriber('base_waypoints_compact', LaneCompactNumpy, self.waypoints_compact_cb)
+        else:
+            ros.Subscriber('base_waypoints', Lane, self.waypoints_cb)
+        ros.Subscriber('traffic_waypoint', Int32, self.traffic_cb)
+        ros.Subscriber('obstacle_waypoint', Int32, self.obstacle_cb)
 
         # Set up publisher for final waypoints
-        self.final_waypoints_pub = rospy.Publisher('/final_waypoints', Lane, queue_size=1)
+        # (as styx_msgs/LaneCompact, lane_compact_converter.py provides the Lane for pure_pursuit)
+        if self.compact:
+            self.final_waypoints_pub = ros.Publisher('final_waypoints_compact', LaneCompactNumpy, queue_size=1)
+        else:
+            self.final_waypoints_pub = ros.Publisher('final_waypoints', Lane, queue_size=1)
         
         # Add other member variables
         self.waypoints_ref = None
         self.cur_wp_ref_idx = 0
+        # position of waypoints_ref in the complete route (tiled mode)
+        self.waypoints_offset = 0
+        self.waypoints_total = None
+        # compact mode: positions, yaw and (adjusted) velocity of waypoints_ref as arrays,
+        # /final_waypoints_compact is sliced from them
+        self.ref_xyz = None
+        self.ref_yaw = None
+        self.ref_v = None
         
         self.traffic_wp_idx = -1
+        self.traffic_wp_global_idx = -1
         self.waypoints_with_reduced_velocity = []
 
-        rospy.spin()
+        if bus is None:
+            rospy.spin()
 
     # Callback to receive topic /current_pose
     # msg   a Pose with reference coordinate frame and timestamp
@@ -131,6 +156,9 @@ class WaypointUpdater(object):
     def filter_and_send_waypoints(self):
       if None == self.waypoints_ref:
         return
+      if self.compact:
+        self.send_compact_waypoints()
+        return
       rWaypoints = Lane()
       pos = self.cur_wp_ref_idx
       wp = self.waypoints_ref.waypoints
@@ -140,6 +168,16 @@ class WaypointUpdater(object):
       if size < LOOKAHEAD_WPS:
         rWaypoints.waypoints += wp[:LOOKAHEAD_WPS-size]
       self.final_waypoints_pub.publish(rWaypoints)
+
+    #Same as filter_and_send_waypoints, but the LaneCompact is cut out of the
+    #reference arrays - no Waypoint objects are touched
+    def send_compact_waypoints(self):
+      pos = self.cur_wp_ref_idx
+      count = len(self.ref_v)
+      first = np.arange(pos, min(pos+LOOKAHEAD_WPS, count))
+      idx = np.concatenate((first, np.arange(min(LOOKAHEAD_WPS-len(first), count))))
+      self.final_waypoints_pub.publish(array_to_compact(self.ref_xyz[idx], self.ref_yaw[idx], self.ref_v[idx],
+                                                        self.waypoints_ref.header))
       
 
     # Callback to receive topic /base_waypoints
@@ -195,10 +233,53 @@ class WaypointUpdater(object):
           if self.get_waypoint_velocity(wp) > self.c_max_velocity:
             wp.twist.twist.linear.x = self.c_max_velocity
             counter += 1
+        if self.compact:
+          # once per reference lane instead of once per published lane
+          self.ref_xyz, self.ref_yaw, self.ref_v = compact_to_array(lane_to_compact(self.waypoints_ref))
         rospy.loginfo('WaypointUpdater is initialized with {0} reference waypoints'\
                       ' - total of {1} were adjusted in velocity'\
                       .format(len(self.waypoints_ref.waypoints), counter))
         pass
+
+    # Callback to receive topic /base_waypoints_compact (compact mode)
+    # The planning below works on Waypoint objects, they are created once here
+    def waypoints_compact_cb(self, msg):
+        self.waypoints_cb(compact_to_lane(msg))
+
+    # Callback to receive topic /base_waypoints_window (tiled mode)
+    #       msg.header    Header
+    #       msg.offset    index of msg.waypoints[0] in the complete route
+    #       msg.total     number of waypoints of the complete route
+    #       msg.waypoints Waypoint[]
+    def waypoints_window_cb(self, msg):
+        cur_wp_global_idx = None
+        if self.waypoints_ref is not None:
+            cur_wp_global_idx = self.to_global_idx(self.cur_wp_ref_idx)
+        lane = Lane()
+        lane.header = msg.header
+        lane.waypoints = msg.waypoints
+        self.waypoints_offset = msg.offset
+        self.waypoints_total = msg.total
+        # the new window comes with the original velocities
+        self.waypoints_with_reduced_velocity = []
+        self.waypoints_cb(lane)
+        if cur_wp_global_idx is not None:
+            self.cur_wp_ref_idx = max(0, self.to_local_idx(cur_wp_global_idx))
+        self.traffic_wp_idx = self.to_local_idx(self.traffic_wp_global_idx)
+        self.calc_waypoints_out()
+
+    # Waypoint indices on /traffic_waypoint refer to the complete route,
+    # waypoints_ref may only be a window of it (tiled mode)
+    def to_local_idx(self, global_idx):
+        if global_idx == -1 or self.waypoints_total is None:
+            return global_idx
+        local_idx = (global_idx - self.waypoints_offset) % self.waypoints_total
+        return local_idx if local_idx < len(self.waypoints_ref.waypoints) else -1
+
+    def to_global_idx(self, local_idx):
+        if local_idx == -1 or self.waypoints_total is None:
+            return local_idx
+        return (local_idx + self.waypoints_offset) % self.waypoints_total
         
     # Callback to receive topic /traffic_waypoint
     # (index of waypoint where to stop in front of the next red traffic light)
@@ -207,7 +288,8 @@ class WaypointUpdater(object):
         # Log status of incoming data
         rospy.loginfo('WaypointUpdater rec: traffic waypoint index %i', msg.data)
         self.no_traffic_count = 0
-        self.traffic_wp_idx = msg.data
+        self.traffic_wp_global_idx = msg.data
+        self.traffic_wp_idx = self.to_local_idx(msg.data)
         self.calc_waypoints_out()
         pass
 
@@ -289,6 +371,8 @@ class WaypointUpdater(object):
 
     def set_waypoint_velocity(self, waypoints, wp_idx, velocity):
         waypoints[wp_idx].twist.twist.linear.x = velocity
+        if self.compact:
+            self.ref_v[wp_idx] = velocity
         pass
         
     def next_waypoint(self, wp_idx):